@@ -0,0 +1,212 @@
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from app.model import SportZone
+from app.session import Session
+from app.util import MetricsKey
+
+# upper bounds in % of HRmax of RESTING .. ZONE_4, see SportZone.from_hr_percent
+HR_ZONE_EDGES = (50, 60, 70, 80, 90)
+HR_ZONES = (
+    SportZone.RESTING,
+    SportZone.ZONE_1,
+    SportZone.ZONE_2,
+    SportZone.ZONE_3,
+    SportZone.ZONE_4,
+    SportZone.ZONE_5,
+)
+# Coggan power levels in % of FTP
+POWER_ZONE_EDGES = (55, 75, 90, 105, 120, 150)
+
+NP_WINDOW_S = 30
+MIN_DECOUPLING_S = 120
+# dropouts up to this long hold the last value, longer ones count as missing
+MAX_FILL_S = 5
+
+
+def resample(times, values, t0: float, t1: float) -> np.ndarray:
+    """
+    Mean per second on the grid [t0, t1). Seconds without samples hold
+    the previous value for up to MAX_FILL_S seconds, then become NaN.
+    """
+    n = int(np.ceil(t1 - t0))
+    if n <= 0:
+        return np.empty(0)
+
+    t = np.frombuffer(times, dtype=np.float64)
+    v = np.frombuffer(values, dtype=np.float64)
+    idx = (t - t0).astype(np.int64)
+    inside = (idx >= 0) & (idx < n)
+    idx, v = idx[inside], v[inside]
+
+    counts = np.bincount(idx, minlength=n)
+    sums = np.bincount(idx, weights=v, minlength=n)
+    has = counts > 0
+    out = np.full(n, np.nan)
+    out[has] = sums[has] / counts[has]
+
+    seconds = np.arange(n)
+    last = np.maximum.accumulate(np.where(has, seconds, -1))
+    fill = ~has & (last >= 0) & (seconds - last <= MAX_FILL_S)
+    out[fill] = out[last[fill]]
+    return out
+
+
+def _trim(series: np.ndarray) -> np.ndarray:
+    """Drops the seconds before the first and after the last sample."""
+    valid = np.flatnonzero(~np.isnan(series))
+    if valid.size == 0:
+        return series[:0]
+    return series[valid[0] : valid[-1] + 1]
+
+
+def _stats(series: np.ndarray) -> dict:
+    valid = series[~np.isnan(series)]
+    if valid.size == 0:
+        return {"avg": None, "max": None, "seconds": 0}
+    return {
+        "avg": round(float(valid.mean()), 1),
+        "max": round(float(valid.max()), 1),
+        "seconds": int(valid.size),
+    }
+
+
+def normalized_power(power: np.ndarray) -> Optional[float]:
+    """4th-power mean of the 30 s rolling average, missing seconds count as 0 W."""
+    power = np.nan_to_num(_trim(power))
+    if power.size < NP_WINDOW_S:
+        return None
+    csum = np.concatenate(([0.0], np.cumsum(power)))
+    rolling = (csum[NP_WINDOW_S:] - csum[:-NP_WINDOW_S]) / NP_WINDOW_S
+    return float(np.mean(rolling**4) ** 0.25)
+
+
+def decoupling(power: np.ndarray, heart_rate: np.ndarray) -> dict:
+    """
+    Pa:HR decoupling (loss of watts per beat between the first and second
+    half) and HR drift over the seconds where both were recorded.
+    """
+    both = ~np.isnan(power) & ~np.isnan(heart_rate) & (heart_rate > 0)
+    p, hr = power[both], heart_rate[both]
+    if p.size < MIN_DECOUPLING_S:
+        return {"decoupling_percent": None, "hr_drift_percent": None}
+
+    half = p.size // 2
+    hr_1, hr_2 = hr[:half].mean(), hr[half:].mean()
+    ef_1, ef_2 = p[:half].mean() / hr_1, p[half:].mean() / hr_2
+    return {
+        "decoupling_percent": (
+            round(float((ef_1 - ef_2) / ef_1 * 100), 2) if ef_1 > 0 else None
+        ),
+        "hr_drift_percent": round(float((hr_2 - hr_1) / hr_1 * 100), 2),
+    }
+
+
+def time_in_hr_zones(heart_rate: np.ndarray, hr_max: Optional[float]) -> dict:
+    if not hr_max:
+        return {}
+    valid = heart_rate[~np.isnan(heart_rate)]
+    zones = np.digitize(valid / hr_max * 100, HR_ZONE_EDGES)
+    counts = np.bincount(zones, minlength=len(HR_ZONES))
+    return {zone.name: int(count) for zone, count in zip(HR_ZONES, counts)}
+
+
+def time_in_power_zones(power: np.ndarray, ftp: Optional[float]) -> dict:
+    if not ftp:
+        return {}
+    valid = power[~np.isnan(power)]
+    zones = np.digitize(valid / ftp * 100, POWER_ZONE_EDGES)
+    counts = np.bincount(zones, minlength=len(POWER_ZONE_EDGES) + 1)
+    return {f"Z{i + 1}": int(count) for i, count in enumerate(counts)}
+
+
+def total_distance(values) -> Optional[float]:
+    """Distance of a cumulative sensor value, a drop means the sensor reset."""
+    v = np.frombuffer(values, dtype=np.float64)
+    if v.size == 0:
+        return None
+    steps = np.diff(v)
+    return round(float(np.where(steps >= 0, steps, v[1:]).sum()), 1)
+
+
+def summarize(
+    session: Session, ftp: Optional[float] = None, hr_max: Optional[float] = None
+) -> dict:
+    t0 = session.started_at
+    t1 = session.ended_at if session.ended_at is not None else time.time()
+    grids = {
+        key: resample(*session.snapshot(key), t0, t1)
+        for key in (
+            MetricsKey.POWER,
+            MetricsKey.HEART_RATE,
+            MetricsKey.CADENCE,
+            MetricsKey.SPEED,
+        )
+    }
+    power = grids[MetricsKey.POWER]
+    heart_rate = grids[MetricsKey.HEART_RATE]
+
+    np_power = normalized_power(power)
+    intensity_factor = np_power / ftp if np_power is not None and ftp else None
+    tss = None
+    if intensity_factor is not None:
+        duration_s = _trim(power).size
+        tss = duration_s * np_power * intensity_factor / (ftp * 3600) * 100
+
+    return {
+        "session": session.to_dict(),
+        "ftp": ftp,
+        "hr_max": hr_max,
+        **{key.value: _stats(grid) for key, grid in grids.items()},
+        "distance_m": total_distance(session.snapshot(MetricsKey.DISTANCE)[1]),
+        "normalized_power": round(np_power, 1) if np_power is not None else None,
+        "intensity_factor": (
+            round(intensity_factor, 3) if intensity_factor is not None else None
+        ),
+        "tss": round(tss, 1) if tss is not None else None,
+        **decoupling(power, heart_rate),
+        "hr_zones_s": time_in_hr_zones(heart_rate, hr_max),
+        "power_zones_s": time_in_power_zones(power, ftp),
+    }
+
+
+class SummaryCache:
+    """
+    Summaries per session. A finished session never changes, so its
+    summary is computed once per FTP/HRmax; the running session is
+    recomputed at most every `active_ttl_s` seconds.
+    """
+
+    def __init__(self, active_ttl_s: float = 1.0):
+        self.active_ttl_s = active_ttl_s
+        self.lock = threading.Lock()
+        self._cache: dict[str, tuple[tuple, float, dict]] = {}
+
+    def summary(
+        self, session: Session, ftp: Optional[float], hr_max: Optional[float]
+    ) -> dict:
+        key = (session.version, session.ended_at, ftp, hr_max)
+        now = time.monotonic()
+        with self.lock:
+            cached = self._cache.get(session.id)
+        if cached is not None:
+            cached_key, computed_at, result = cached
+            if cached_key == key or (
+                session.is_active
+                and cached_key[1:] == key[1:]
+                and now - computed_at < self.active_ttl_s
+            ):
+                return result
+
+        result = summarize(session, ftp, hr_max)
+        with self.lock:
+            self._cache[session.id] = (key, now, result)
+        return result
+
+    def discard(self, keep_ids):
+        with self.lock:
+            for session_id in set(self._cache) - set(keep_ids):
+                del self._cache[session_id]
@@ -2,23 +2,69 @@ from datetime import datetime
 import logging
 import threading
 import time
-from typing import List
-from openant.easy.node import Node
-from openant.devices import ANTPLUS_NETWORK_KEY
-from openant.devices.bike_speed_cadence import (
-    BikeSpeedData,
-    BikeCadenceData,
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from app.channels import ChannelAllocation, DeviceKey
+from app.filters import FilterPipeline, build_pipelines
+from app.history import HistoryStore
+from app.model import (
+    MetricsModel,
+    MetricsSettingsModel,
+    MetricsState,
+    RawMetricsModel,
+    SportZone,
+)
+from app.nodes import (
+    BIKE_CADENCE,
+    BIKE_SPEED,
+    BIKE_SPEED_CADENCE,
+    HEART_RATE,
+    POWER_METER,
+    AntUsbBackend,
+    NodeBackend,
+    NodeWorker,
+    load_openant,
+)
+from app.pairing import PairedDevice, PairingCache
+from app.rules import EventFeed, RuleEngine
+from app.laps import Lap
+from app.session import Session, SessionStore
+from app.settings import SettingsSnapshot, SettingsStore
+from app.store import SessionDatabase
+from app.telemetry import DeviceTelemetry, TelemetryRegistry
+from app.util import (
+    ChangeNotifier,
+    CumulativeSumMap,
+    MetricsKey,
+    TimedMap,
+    TimedMovingAverage,
+)
+from app.virtual import VirtualRide
+from app.workout import Timer
+
+if TYPE_CHECKING:
+    from openant.devices.common import DeviceData
+
+SUPPORTED_DEVICE_TYPES = (
+    BIKE_CADENCE,
+    BIKE_SPEED,
+    BIKE_SPEED_CADENCE,
+    HEART_RATE,
+    POWER_METER,
 )
-from openant.devices.heart_rate import HeartRateData
-from openant.devices.power_meter import PowerData
-from openant.devices.common import AntPlusDevice, BatteryData, DeviceData
-from openant.devices.common import DeviceType
-from openant.devices.scanner import Scanner
 
-from openant.devices.utilities import auto_create_device
+# order in which the node states represent the whole pool
+_POOL_STATE_ORDER = (
+    MetricsState.RUNNING,
+    MetricsState.SCANNING,
+    MetricsState.STARTING,
+    MetricsState.ERROR,
+)
 
-from app.model import MetricsModel, MetricsSettingsModel, SportZone
-from app.util import CumulativeSumMap, MetricsKey, TimedMap, TimedMovingAverage
+# a speed sensor that sent data within this time wins over virtual speed
+WHEEL_SPEED_PRIORITY_S = 5.0
+# without power pages for this long the virtual bike rolls out unpowered
+POWER_TIMEOUT_S = 3.0
 
 
 class Metrics:
@@ -26,103 +72,289 @@ class Metrics:
         self,
         filter_device_ids: List[int] = [],
         metrics_settings: MetricsSettingsModel = MetricsSettingsModel(),
+        backoff_initial_s: float = 0.5,
+        backoff_max_s: float = 30.0,
+        adapter_poll_s: float = 2.0,
+        pairing: Optional[PairingCache] = None,
+        max_channels: int = 8,
+        idle_timeout_s: float = 30.0,
+        adapters: int = 1,
+        backend_factory: Callable[[int], NodeBackend] = AntUsbBackend,
+        stale_after_s: float = 5.0,
+        settings_store: Optional[SettingsStore] = None,
+        database: Optional[SessionDatabase] = None,
+        timer: Optional[Timer] = None,
     ):
         self.logger = logging.getLogger("app.metrics")
 
-        self.node = None
-        self.node_thread = None
         self.lock = threading.Lock()
-        self.devices: List[AntPlusDevice] = []
+        # serializes device placement so two scanners can't open the same device
+        self.assign_lock = threading.Lock()
+        self.workers: List[NodeWorker] = [
+            NodeWorker(
+                index,
+                backend_factory(index),
+                self,
+                max_channels=max_channels,
+                idle_timeout_s=idle_timeout_s,
+                backoff_initial_s=backoff_initial_s,
+                backoff_max_s=backoff_max_s,
+                adapter_poll_s=adapter_poll_s,
+            )
+            for index in range(max(adapters, 1))
+        ]
 
-        if metrics_settings is None:
-            self.metrics_settings: MetricsSettingsModel = MetricsSettingsModel()
-        else:
-            self.metrics_settings = metrics_settings
-        self.filter_device_ids = self.set_filter_device_ids(filter_device_ids)
+        if settings_store is None:
+            settings_store = SettingsStore(
+                defaults=metrics_settings or MetricsSettingsModel()
+            )
+        self.settings_store = settings_store
+        self.settings_store.add_listener(self._on_settings_changed)
+        self.pairing = pairing if pairing is not None else PairingCache()
+        self.sessions = SessionStore()
+        self.database = database
+        self.summaries = None  # SummaryCache, created on first use
+        self.history = HistoryStore()
+        # bumped for every data page, lets consumers wait instead of polling
+        self.changes = ChangeNotifier()
+        self._sample_listeners: list[Callable[[MetricsKey, float, float], None]] = []
+        self._raw_sample_listeners: list[
+            Callable[[MetricsKey, float, float], None]
+        ] = []
+        # interval names of the workout, used by interval specific rules
+        self.timer = timer
+        self.events = EventFeed()
+        self.rules = RuleEngine(self.events)
+        self.rules.compile(self.settings_store.current)
+        if filter_device_ids:
+            self.set_filter_device_ids(filter_device_ids)
         self._reset_metrics()
-        self.is_running = False
 
-    def set_metrics_settings(self, metrics_settings: MetricsSettingsModel):
+        self._stop_event = threading.Event()
+        self._stop_event.set()
+
+        self.telemetry = TelemetryRegistry(stale_after_s=stale_after_s)
+        self.housekeeping_interval_s = 1.0
+        self._last_housekeeping = 0.0
+
+    @property
+    def metrics_settings(self) -> MetricsSettingsModel:
+        return self.settings_store.current.model
+
+    def set_metrics_settings(
+        self, metrics_settings: MetricsSettingsModel
+    ) -> MetricsSettingsModel:
+        """
+        Persist and apply new settings. When `metrics_settings.version` is
+        set it must match the current version (SettingsConflictError).
+        """
         self.logger.debug(f"Setting metrics settings: {metrics_settings}")
         if metrics_settings is None:
             self.logger.warning("Received None for metrics settings, ignoring update")
             raise ValueError(
                 "Metrics settings must be a valid MetricsSettingsModel object"
             )
-        self.metrics_settings = metrics_settings
-        self.logger.debug(f"Updating metrics_settings: {self.metrics_settings}")
+        snapshot = self.settings_store.update(
+            metrics_settings, expected_version=metrics_settings.version
+        )
+        return snapshot.model
 
     def get_metrics_settings(self) -> MetricsSettingsModel:
-        return self.metrics_settings
+        self.settings_store.reload_if_changed()
+        return self.settings_store.current.model
+
+    def _on_settings_changed(self, old: SettingsSnapshot, new: SettingsSnapshot):
+        # filters keep state, only rebuild them when their config changed
+        if old.model.filters != new.model.filters:
+            self.pipelines = build_pipelines(new.model.filters)
+        # percentage thresholds depend on HRmax and FTP
+        if (old.model.rules, old.hr_max, old.ftp) != (
+            new.model.rules,
+            new.hr_max,
+            new.ftp,
+        ):
+            self.rules.compile(new)
+        self.logger.debug(
+            "Updating metrics_settings to version %s: %s", new.version, new.model
+        )
 
-    def set_filter_device_ids(self, filter_device_ids: List[int]):
+    def add_sample_listener(
+        self, listener: Callable[[MetricsKey, float, float], None], raw: bool = False
+    ):
+        """
+        `listener(key, value, t)` runs for every filtered sample (with `raw`
+        for every sample before the filters) on the ANT+ threads, it must
+        not block.
+        """
+        if raw:
+            self._raw_sample_listeners.append(listener)
+        else:
+            self._sample_listeners.append(listener)
+
+    def set_filter_device_ids(
+        self, filter_device_ids: List[int], deny_device_ids: List[int] = None
+    ):
+        if filter_device_ids is None:
+            filter_device_ids = []
+        if deny_device_ids is None:
+            deny_device_ids = []
 
         # Validate that all entries are integers
-        if not all(isinstance(id, int) for id in filter_device_ids):
+        if not all(
+            isinstance(id, int) for id in [*filter_device_ids, *deny_device_ids]
+        ):
             self.logger.warning(
-                "Invalid filter_device_ids: %s. All entries must be integers.",
+                "Invalid filter_device_ids: %s, deny_device_ids: %s. All entries must be integers.",
                 filter_device_ids,
+                deny_device_ids,
             )
             raise ValueError("All device IDs in filter_device_ids must be integers")
 
-        if filter_device_ids is None:
-            filter_device_ids = []
-
-        self.filter_device_ids = filter_device_ids
-        self.logger.debug("Updating filter_device_ids: %s", filter_device_ids)
-
-    def start(self):
-        with self.lock:  # acquire and release automatically
-            if self.is_running:
-                self.logger.warning("Metrics collection already running")
-                return
+        self.pairing.set_filter(filter_device_ids, deny_device_ids)
+        self.logger.debug(
+            "Updating filter_device_ids: %s, deny_device_ids: %s",
+            filter_device_ids,
+            deny_device_ids,
+        )
 
-            try:
-                self.devices: list[AntPlusDevice] = []
-                self.node = Node()
-                self.node.set_network_key(0x00, ANTPLUS_NETWORK_KEY)
+        # a narrower filter frees the channels of the devices it rejects now
+        for worker in self.workers:
+            for allocation in worker.channels.allocations():
+                if not self.pairing.accepts(*allocation.key):
+                    worker.close_device(allocation.key)
+
+        # a wider filter may need the scan that was skipped at startup
+        if self.pairing.needs_scan():
+            for worker in self.workers:
+                if worker.is_ready():
+                    worker.start_scanner()
+
+    @property
+    def filter_device_ids(self) -> List[int]:
+        return sorted(self.pairing.allow_device_ids)
+
+    @property
+    def deny_device_ids(self) -> List[int]:
+        return sorted(self.pairing.deny_device_ids)
+
+    def get_paired_devices(self) -> List[PairedDevice]:
+        return self.pairing.devices()
+
+    def pair_device(self, device_id: int, device_type: int, trans_type: int = 0):
+        """Remember a sensor and open its channel right away when running."""
+        if device_type not in SUPPORTED_DEVICE_TYPES:
+            raise ValueError(f"Unsupported device type {device_type}")
+
+        dev = self.pairing.pair(device_id, device_type, trans_type)
+        for worker in self.workers:
+            worker.channels.set_paired((device_id, device_type), True)
+        self._assign_device(device_id, device_type, trans_type)
+        return dev
+
+    def unpair_device(self, device_id: int) -> List[PairedDevice]:
+        removed = self.pairing.unpair(device_id)
+        for dev in removed:
+            key = (dev.device_id, dev.device_type)
+            for worker in self.workers:
+                worker.channels.set_paired(key, False)
+            if not self.pairing.accepts(*key):
+                # no longer allowed, free its channel
+                for worker in self.workers:
+                    worker.close_device(key)
+        return removed
+
+    @property
+    def state(self) -> MetricsState:
+        if not any(worker.is_alive() for worker in self.workers):
+            return MetricsState.IDLE
+        if self._stop_event.is_set():
+            return MetricsState.STOPPING
+        states = {worker.state for worker in self.workers}
+        for state in _POOL_STATE_ORDER:
+            if state in states:
+                return state
+        return MetricsState.STARTING
+
+    @property
+    def state_message(self) -> Optional[str]:
+        state = self.state
+        if state == MetricsState.STOPPING:
+            return "Closing ANT+ channels"
+        if len(self.workers) == 1:
+            return self.workers[0].state_message
+        return (
+            "; ".join(
+                f"node {w.index}: {w.state_message}"
+                for w in self.workers
+                if w.state_message
+            )
+            or None
+        )
 
-                self.scanner = Scanner(self.node, device_id=0, device_type=0)
-                self.scanner.on_found = self._scanner_on_found
+    @property
+    def is_running(self) -> bool:
+        return self.state.is_active()
 
-            except Exception as e:
+    def start(self) -> MetricsState:
+        """
+        Start metrics collection in the background and return immediately.
+        Progress is reported through `state` / `state_message`.
+        """
+        with self.lock:  # acquire and release automatically
+            state = self.state
+            if state != MetricsState.IDLE:
                 self.logger.warning(
-                    "Error initializing ANT+ node or scanner", exc_info=True
+                    "Metrics collection not idle (state=%s)", state.value
                 )
-                self.node.stop() if self.node else None
-                raise e
+                return state
 
-            self.node_thread = threading.Thread(target=self._run_node, daemon=True)
-            self.node_thread.start()
-            self.is_running = True
-
-    def stop(self):
+            self._reset_metrics()
+            self.telemetry.clear()
+            self.rules.reset(time.monotonic())
+            session = self.sessions.start(rider=self.metrics_settings.rider)
+            if self.database is not None:
+                self.database.start_session(
+                    session.id, session.started_at, session.rider
+                )
+            self._stop_event = threading.Event()
+            for worker in self.workers:
+                worker.start(self._stop_event)
+            return MetricsState.STARTING
+
+    def stop(self) -> MetricsState:
+        """
+        Request metrics collection to stop and return immediately. The node
+        supervisor threads close the channels and the nodes, then the pool
+        moves to idle. Use `join` to wait for it.
+        """
         with self.lock:
-            if not self.is_running:
-                self.logger.warning("Metrics collection already stopped")
-                return
-
-            self.is_running = False
-            self._cleanup_devices()
-
-            if self.node:
-                try:
-                    self.logger.debug("Stopping ANT+ node")
-                    self.node.stop()
-                except Exception:
-                    self.logger.warning("Error stopping ANT+ node", exc_info=True)
+            state = self.state
+            if not state.is_active():
+                self.logger.warning(
+                    "Metrics collection already stopped (state=%s)", state.value
+                )
+                return state
 
-            # Wait for thread but don’t block forever
-            if self.node_thread and self.node_thread.is_alive():
-                self.node_thread.join(timeout=1)  # short timeout
+            self._stop_event.set()
+            session = self.sessions.current
+            if session is not None and session.is_active:
+                self._store_lap(session, session.laps.close(time.time()))
+            self.sessions.end()
+            if self.database is not None and session is not None:
+                self.database.end_session(session.id, session.ended_at)
+            return MetricsState.STOPPING
 
-            self._reset_metrics()
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the node threads, returns True if all have finished."""
+        return all([worker.join(timeout) for worker in self.workers])
 
     def get_metrics(self) -> MetricsModel:
 
         if self.is_running is False:
             metrics = {
                 "is_running": False,
+                "state": self.state,
+                "state_message": self.state_message,
             }
             return MetricsModel(**metrics)
 
@@ -143,19 +375,16 @@ class Metrics:
         ma_distance = self.sum_map.sum(MetricsKey.DISTANCE)
 
         # heart rate & zone
+        settings = self.settings_store.current
         heart_rate = self.time_map.get(MetricsKey.HEART_RATE)
-        heart_rate_percent = SportZone.percent_from_age(
-            self.metrics_settings.age, heart_rate
-        )
-        zone = SportZone.from_hr_percent(heart_rate_percent)
+        heart_rate_percent = settings.hr_percent(heart_rate)
+        zone = settings.hr_zone(heart_rate)
         if zone == SportZone.UNKNOWN:
             zone = None
 
         ma_heart_rate = self.timed_moving_average.average(MetricsKey.HEART_RATE)
-        ma_heart_rate_percent = SportZone.percent_from_age(
-            self.metrics_settings.age, ma_heart_rate
-        )
-        ma_zone = SportZone.from_hr_percent(ma_heart_rate_percent)
+        ma_heart_rate_percent = settings.hr_percent(ma_heart_rate)
+        ma_zone = settings.hr_zone(ma_heart_rate)
         if ma_zone == SportZone.UNKNOWN:
             ma_zone = None
 
@@ -177,78 +406,234 @@ class Metrics:
             "zone_description": zone.value if zone else None,
             "ma_zone_description": ma_zone.value if ma_zone else None,
             "is_running": self.is_running,
+            "state": self.state,
+            "state_message": self.state_message,
             "last_sensor_update": self.last_sensor_update,
             "last_sensor_name": self.last_sensor_name,
         }
 
         return MetricsModel(**metrics)
 
+    def get_metrics_json(self) -> str:
+        return self.get_metrics().model_dump_json()
+
     def _reset_metrics(self):
 
         self.time_map = TimedMap(ttl=15)
         self.timed_moving_average = TimedMovingAverage(ttl=40)
         self.sum_map = CumulativeSumMap()
+        # unfiltered values, the maps above only see what passed the filters
+        self.raw_map = TimedMap(ttl=15)
+        self.pipelines: dict[MetricsKey, FilterPipeline] = build_pipelines(
+            self.settings_store.current.model.filters
+        )
 
         self.last_sensor_update = None
         self.last_sensor_name = None
 
+        self.virtual_ride = VirtualRide()
+        self._wheel_speed_at: Optional[float] = None
+        self._power: Optional[tuple[float, float]] = None  # (watts, monotonic)
+
+    def get_raw_metrics(self) -> RawMetricsModel:
+        raw = {key.value: self.raw_map.get(key) for key in MetricsKey}
+        raw["dropped"] = {key: p.dropped for key, p in self.pipelines.items()}
+        return RawMetricsModel(**raw)
+
+    def _filter(self, key: MetricsKey, value, now: float):
+        """
+        Records the raw value and returns the filtered one (None if
+        dropped). Both go to the history, filtered values also to the
+        current session.
+        """
+        self.raw_map.set(key, value)
+        if value is None:
+            return None
+        t = time.time()
+        self.history.record(key, value, t, raw=True)
+        for listener in self._raw_sample_listeners:
+            listener(key, value, t)
+        value = self.pipelines[key].apply(value, now)
+        if value is None:
+            return None
+        self.history.record(key, value, t)
+        for listener in self._sample_listeners:
+            listener(key, value, t)
+        session = self.sessions.current
+        if session is not None and session.is_active:
+            session.record(key, value, t)
+            if self.database is not None:
+                self.database.record(session.id, key, t, value)
+            self._store_lap(session, session.laps.record(self.timer, key, value, t))
+        # switches interval rules with the sample that crosses the interval
+        # boundary, like the laps, housekeeping only covers gaps in the data
+        self.rules.set_interval(self._interval_name(t), now)
+        self.rules.on_sample(key, value, now)
+        return value
+
+    def get_history(
+        self,
+        key: MetricsKey,
+        t_from: Optional[float] = None,
+        t_to: Optional[float] = None,
+        points: int = 500,
+        method: str = "lttb",
+        raw: bool = False,
+    ) -> dict:
+        return self.history.query(key, t_from, t_to, points, method, raw)
+
+    def _store_lap(self, session: Session, lap: Optional[Lap]):
+        if lap is not None and self.database is not None:
+            self.database.record_lap(session.id, lap.to_dict())
+
+    def get_current_lap(self) -> Optional[dict]:
+        session = self.sessions.current
+        if session is None or not session.is_active:
+            return None
+        return session.laps.current_dict()
+
+    def get_laps(self, session_id: str) -> Optional[List[dict]]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        return session.laps.to_list()
+
+    def get_events(self, after_seq: int = 0) -> List[dict]:
+        return self.events.since(after_seq)
+
+    def get_sessions(self) -> List[dict]:
+        return [session.to_dict() for session in self.sessions.list()]
+
+    def get_session_summary(self, session_id: str) -> Optional[dict]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        if self.summaries is None:
+            # NumPy is only needed here, keep it out of the startup path
+            from app.analytics import SummaryCache
+
+            self.summaries = SummaryCache()
+        self.summaries.discard(s.id for s in self.sessions.list())
+        settings = self.settings_store.current
+        return self.summaries.summary(session, settings.ftp, settings.hr_max)
+
     def get_devices(self):
-        return [
-            {
-                "device_id": dev.device_id,
-                "device_type": dev.device_type,
-                "name": dev.name,
-            }
-            for dev in self.devices
-        ]
+        now = time.time()
+        devices = []
+        for worker in self.workers:
+            for dev in worker.channels.devices():
+                device = {
+                    "device_id": dev.device_id,
+                    "device_type": dev.device_type,
+                    "name": dev.name,
+                    "node": worker.index,
+                }
+                telemetry = self.telemetry.get((dev.device_id, dev.device_type))
+                if telemetry is not None:
+                    device.update(telemetry.to_dict(now))
+                devices.append(device)
+        return devices
+
+    def get_channel_utilization(self) -> dict:
+        """Channel usage summed over all nodes."""
+        total = {
+            "capacity": 0,
+            "reserved": 0,
+            "used": 0,
+            "free": 0,
+            "rejected": 0,
+            "evicted": 0,
+            "devices": [],
+        }
+        for worker in self.workers:
+            utilization = worker.channels.utilization()
+            for key in ("capacity", "reserved", "used", "free", "rejected", "evicted"):
+                total[key] += utilization[key]
+            total["devices"].extend(
+                {**dev, "node": worker.index} for dev in utilization["devices"]
+            )
+        total["utilization"] = (
+            (total["used"] + total["reserved"]) / total["capacity"]
+            if total["capacity"]
+            else None
+        )
+        return total
+
+    def get_node_stats(self) -> List[dict]:
+        return [worker.stats() for worker in self.workers]
 
-    def _on_device_data(self, page: int, page_name: str, data: DeviceData):
+    def _on_device_data(
+        self,
+        page: int,
+        page_name: str,
+        data: DeviceData,
+        device_key: Optional[tuple[int, int]] = None,
+    ):
+        ant = load_openant()
+        # one consistent settings snapshot for the whole page
+        settings = self.settings_store.current
         try:
-            if isinstance(data, BikeCadenceData):
-                cadence = data.calculate_cadence()
+            now = time.monotonic()
+            if isinstance(data, ant.BikeCadenceData):
+                cadence = self._filter(
+                    MetricsKey.CADENCE, data.calculate_cadence(), now
+                )
                 self.time_map.set(MetricsKey.CADENCE, cadence)
                 self.timed_moving_average.add(MetricsKey.CADENCE, cadence)
                 self.logger.debug("cadence: %s", cadence)
 
-            if isinstance(data, HeartRateData):
-                heart_rate = int(round(data.heart_rate))
+            if isinstance(data, ant.HeartRateData):
+                heart_rate = self._filter(
+                    MetricsKey.HEART_RATE, int(round(data.heart_rate)), now
+                )
+                if heart_rate is not None:
+                    heart_rate = int(round(heart_rate))
+                if device_key is not None:
+                    self.telemetry.device(device_key).on_battery_percent(
+                        data.battery_percentage
+                    )
                 self.time_map.set(MetricsKey.HEART_RATE, heart_rate)
                 self.timed_moving_average.add(MetricsKey.HEART_RATE, heart_rate)
                 self.logger.debug("heart_rate: %s", heart_rate)
 
-            if isinstance(data, BikeSpeedData):
-                speed_wheel_circumference_m = (
-                    self.metrics_settings.speed_wheel_circumference_m
-                )
-                if (
-                    speed_wheel_circumference_m is not None
-                    and speed_wheel_circumference_m > 0
-                ):
-                    speed = data.calculate_speed(speed_wheel_circumference_m)
+            if isinstance(data, ant.BikeSpeedData):
+                speed_wheel_circumference_m = settings.speed_wheel_circumference_m
+                if speed_wheel_circumference_m is not None:
+                    speed = self._filter(
+                        MetricsKey.SPEED,
+                        data.calculate_speed(speed_wheel_circumference_m),
+                        now,
+                    )
                     self.time_map.set(MetricsKey.SPEED, speed)
                     self.timed_moving_average.add(MetricsKey.SPEED, speed)
+                    self._wheel_speed_at = now
                     self.logger.debug("speed: %s", speed)
 
-                distance_wheel_circumference = (
-                    self.metrics_settings.distance_wheel_circumference_m
-                )
-                if (
-                    distance_wheel_circumference is not None
-                    and distance_wheel_circumference > 0
-                ):
-                    distance = data.calculate_distance(distance_wheel_circumference)
+                distance_wheel_circumference = settings.distance_wheel_circumference_m
+                if distance_wheel_circumference is not None:
+                    distance = self._filter(
+                        MetricsKey.DISTANCE,
+                        data.calculate_distance(distance_wheel_circumference),
+                        now,
+                    )
                     self.time_map.set(MetricsKey.DISTANCE, distance)
                     self.sum_map.add(MetricsKey.DISTANCE, distance)
                     self.logger.debug("distance: %s", distance)
 
-            if isinstance(data, PowerData):
-                power = int(round(data.instantaneous_power))
+            if isinstance(data, ant.PowerData):
+                power = self._filter(
+                    MetricsKey.POWER, int(round(data.instantaneous_power)), now
+                )
+                if power is not None:
+                    power = int(round(power))
                 self.time_map.set(MetricsKey.POWER, power)
                 self.timed_moving_average.add(MetricsKey.POWER, power)
                 self.logger.debug("power: %s", power)
+                self._virtual_speed(settings, now, power)
 
             self.last_sensor_update = datetime.now().astimezone()
             self.last_sensor_name = page_name
+            self.changes.notify()
 
         except Exception:
             self.logger.warning("Error processing device data update", exc_info=True)
@@ -257,78 +642,168 @@ class Metrics:
         device_id, device_type, device_trans = device_tuple
 
         self.logger.debug(
-            "Found new device with device_id: %s, device_type: %s, device_trans:%s, filter_device_ids: %s",
+            "Found new device with device_id: %s, device_type: %s, device_trans:%s",
             device_id,
             device_type,
             device_trans,
-            self.filter_device_ids,
         )
 
-        if self.filter_device_ids is None or len(self.filter_device_ids) == 0:
-            self._create_sensor_device(device_id, device_type, device_trans)
+        if not self.pairing.accepts(device_id, device_type):
+            self.logger.debug("Ignoring filtered device_id: %s", device_id)
+            return
+
+        self._assign_device(device_id, device_type, device_trans)
+
+    def _owner(self, key: DeviceKey) -> Optional[NodeWorker]:
+        for worker in self.workers:
+            if worker.channels.has(key):
+                return worker
+        return None
+
+    def _assign_device(self, device_id, device_type, device_trans):
+        """Open the device on the least loaded node that has a free channel."""
+        if device_type not in SUPPORTED_DEVICE_TYPES:
+            return
+
+        key = (device_id, device_type)
+        paired = self.pairing.is_paired(device_id, device_type)
+        with self.assign_lock:
+            # the scanners may also report a device that already has a channel
+            if self._owner(key) is not None:
+                return
+
+            ready = sorted(
+                (w for w in self.workers if w.is_ready()), key=lambda w: w.load()
+            )
+            for worker in ready:
+                allocated, evicted = worker.channels.allocate(key, device_trans, paired)
+                if allocated:
+                    break
+            else:
+                if ready:
+                    self.logger.warning(
+                        "No free ANT+ channel for device_id: %s, device_type: %s",
+                        device_id,
+                        device_type,
+                    )
+                return
+
+        worker.open_device(key, device_trans, evicted)
+
+    def _assign_paired_devices(self):
+        for dev in self.pairing.devices():
+            if self.pairing.accepts(dev.device_id, dev.device_type):
+                self._assign_device(*dev)
+
+    def _on_node_ready(self, worker: NodeWorker):
+        # known sensors get dedicated channels without waiting for a scan
+        self._assign_paired_devices()
+        if self.pairing.needs_scan():
+            worker.start_scanner()
         else:
-            self._create_sensor_device(device_id, device_type, device_trans)
-
-    def _create_sensor_device(self, device_id, device_type, device_trans):
-        if DeviceType(device_type) in (
-            DeviceType.BikeCadence,
-            DeviceType.BikeSpeed,
-            DeviceType.BikeSpeedCadence,
-            DeviceType.HeartRate,
-            DeviceType.PowerMeter,
-        ):
-            try:
-                self.logger.info(
-                    "Creating new device with device_id: %s, device_type: %s",
-                    device_id,
-                    device_type,
-                )
-                dev: AntPlusDevice = auto_create_device(
-                    self.node, device_id, device_type, device_trans
-                )
+            self.logger.info("All allowed devices are paired, skipping scan")
 
-                # print(f"Created device {dev}, type {type(dev)}")
-                dev.on_device_data = lambda page, page_name, data: self._on_device_data(
-                    page, page_name, data
-                )
+    def _on_node_released(self, worker: NodeWorker):
+        # move paired sensors of a failed node to the remaining ones
+        if not self._stop_event.is_set():
+            self._assign_paired_devices()
 
-                # dev.on_battery = lambda data: self._on_device_battery(data)
-
-                self.devices.append(dev)
-            except Exception:
-                self.logger.warning("Could not auto create device", exc_info=True)
-
-    def _on_device_battery(self, data: BatteryData):
-        self.logger.debug("BatteryData: %s", data)
-
-    def _run_node(self):
-        retries = 0
-        while True:
-            try:
-                self.logger.debug("Starting ANT+ node")
-                self.is_running = True
-                self.node.start()  # blocking
-                self.logger.debug("Ant+ Node returns from blocking")
-                # exit loop
-                break
-            except Exception:
-                self.logger.warning("Node error", exc_info=True)
-                retries += 1
-                self.logger.warning("Try node restart (retry={retries})")
-                time.sleep(1)
-            finally:
-                self.is_running = False
-
-    def _cleanup_devices(self):
-        for dev in self.devices:
-            try:
-                self.logger.debug(
-                    "Closing channel for device_id: %s, device_type: %s",
-                    dev.device_id,
-                    dev.device_type,
-                )
-                dev.close_channel()
-            except Exception:
-                self.logger.warning("Could not close device channel", exc_info=True)
+    def _on_node_stopped(self, worker: NodeWorker):
+        pass
+
+    def _on_device_closed(self, allocation: ChannelAllocation):
+        for worker in self.workers:
+            worker.forget_found(allocation)
 
-        self.devices.clear()
+    def _housekeeping(self):
+        """Periodic checks, called from the node supervisor loops."""
+        now = time.time()
+        with self.lock:
+            if now - self._last_housekeeping < self.housekeeping_interval_s:
+                return
+            self._last_housekeeping = now
+
+        went_stale, recovered = self.telemetry.update_stale(now)
+        for telemetry in went_stale:
+            self._publish_sensor_event(telemetry, "stale", now)
+        for telemetry in recovered:
+            self._publish_sensor_event(telemetry, "recovered", now)
+        self.settings_store.reload_if_changed()
+
+        # closes the lap of an interval that ended without new samples
+        session = self.sessions.current
+        if session is not None and session.is_active:
+            self._store_lap(session, session.laps.update(self.timer, now))
+
+        monotonic_now = time.monotonic()
+        # keeps the virtual bike rolling out when the power stops
+        self._virtual_speed(self.settings_store.current, monotonic_now)
+        self.rules.set_interval(self._interval_name(), monotonic_now)
+        self.rules.check(monotonic_now)
+
+    def _publish_sensor_event(
+        self, telemetry: DeviceTelemetry, condition: str, now: float
+    ):
+        """Reports a sensor that went silent or is back on the event feed."""
+        device_id = telemetry.key[0]
+        if condition == "stale":
+            age = telemetry.age(now)
+            message = f"Sensor {telemetry.name} (device_id: {device_id}) silent for {age:.1f}s"
+        else:
+            age = None
+            message = f"Sensor {telemetry.name} (device_id: {device_id}) is back"
+        self.events.publish(
+            {
+                "timestamp": datetime.now().astimezone(),
+                "rule": "sensor",
+                "condition": condition,
+                "value": round(age, 1) if age is not None else None,
+                "threshold": self.telemetry.stale_after_s,
+                "device_id": device_id,
+                "message": message,
+            }
+        )
+
+    def _virtual_speed(
+        self, settings: SettingsSnapshot, now: float, power: Optional[float] = None
+    ):
+        """
+        Speed and distance from the power for trainers without speed sensor.
+        `power` is the filtered value of a new power page (0 W included),
+        without one the last page is used until it is POWER_TIMEOUT_S old.
+        """
+        if power is not None:
+            self._power = (power, now)
+        table = settings.speed_table
+        if table is None:
+            return
+        wheel_speed_at = self._wheel_speed_at
+        if wheel_speed_at is not None and now - wheel_speed_at < WHEEL_SPEED_PRIORITY_S:
+            return
+        ride = self.virtual_ride
+        last_power = self._power
+        if power is None and last_power is not None:
+            if now - last_power[1] < POWER_TIMEOUT_S:
+                power = last_power[0]
+        if power is None and ride.speed == 0:
+            ride.pause()
+            return
+        if not ride.advance(table, power or 0, now):
+            return
+
+        speed = self._filter(MetricsKey.SPEED, round(ride.speed_kmh, 2), now)
+        self.time_map.set(MetricsKey.SPEED, speed)
+        self.timed_moving_average.add(MetricsKey.SPEED, speed)
+        distance = self._filter(MetricsKey.DISTANCE, round(ride.distance, 2), now)
+        self.time_map.set(MetricsKey.DISTANCE, distance)
+        self.sum_map.add(MetricsKey.DISTANCE, distance)
+        self.logger.debug("virtual speed: %s, distance: %s", speed, distance)
+
+    def _interval_name(self, t: Optional[float] = None) -> Optional[str]:
+        if self.timer is None:
+            return None
+        position = self.timer.position(t)
+        if position is None:
+            return None
+        interval = self.timer.interval(position.index)
+        return interval.name if interval is not None else None
@@ -1,28 +1,53 @@
 import asyncio
+import os
 import pathlib
-import time
 import json
 import logging
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse, StreamingResponse
+from typing import Literal, Optional
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
 from app.ant import Metrics
 from contextlib import asynccontextmanager
 
-from app.core import setup_logging
+from app.core import get_data_dir, setup_logging
 from app.model import (
+    BestEffortModel,
+    ChannelUtilizationModel,
+    DeviceFilterModel,
+    EventModel,
+    HistoryModel,
     IntervalModel,
     IntervalProgressModel,
+    LapModel,
     MetricsModel,
     MetricsSettingsModel,
+    MetricsState,
+    NodeStatsModel,
+    PairedSensorModel,
+    RawMetricsModel,
     SensorModel,
+    SessionModel,
+    SessionSummaryModel,
+    StoredSampleModel,
+    StoredSessionModel,
+    TrendModel,
 )
-from app.workout import Timer
-
+from app.nodes import backend_factory_from_env
+from app.pairing import PairingCache
+from app.settings import SettingsConflictError, SettingsStore
+from app.shared import (
+    DEFAULT_NAME as DEFAULT_SHM_NAME,
+    CollectorUnavailableError,
+    SharedMetricsReader,
+    SharedWorkout,
+)
+from app.static import PrecompressedStaticFiles, precompress
+from app.store import SessionDatabase
+from app.util import MetricsKey
+from app.workout import Workout, WorkoutRunningError
 
-setup_logging()
 
 logger = logging.getLogger("app.api")
 
@@ -32,25 +57,52 @@ shutdown_event = asyncio.Event()  # shared shutdown flag
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # ---- startup ----
+    # configured at startup instead of import time, and only when
+    # uvicorn --log-config didn't do it already
+    if not logging.getLogger().handlers:
+        setup_logging()
     logging.info("Starting ANT+ Metrics Service...")
-    app.state.metrics = Metrics(
-        metrics_settings=MetricsSettingsModel(
-            age=45,
-            speed_wheel_circumference_m=0.141,
-            distance_wheel_circumference_m=0.141,
-        )
-    )
 
-    app.state.workout = []
-    app.state.timer = Timer(app.state.workout)
+    # ANT_MODE=reader serves the snapshot of a separate collector process
+    # (python -m app.collector) and may run with several workers
+    reader_mode = os.getenv("ANT_MODE", "standalone") == "reader"
+
+    app.state.database = SessionDatabase(get_data_dir() / "sessions.db")
+    app.state.database.start(writer=not reader_mode)
+
+    if reader_mode:
+        app.state.metrics = SharedMetricsReader(
+            os.getenv("ANT_SHM_NAME", DEFAULT_SHM_NAME),
+            settings_store=SettingsStore(get_data_dir() / "settings.json"),
+            database=app.state.database,
+        )
+        # the collector runs the timer, the workers only send commands
+        app.state.workout = SharedWorkout(app.state.metrics)
+    else:
+        app.state.workout = Workout()
+        # ANT_BACKEND=simulated runs without USB sticks, ANT_ADAPTERS shards
+        # the sensors over several sticks
+        app.state.metrics = Metrics(
+            settings_store=SettingsStore(get_data_dir() / "settings.json"),
+            database=app.state.database,
+            pairing=PairingCache(get_data_dir() / "pairing.json"),
+            adapters=int(os.getenv("ANT_ADAPTERS", "1")),
+            backend_factory=backend_factory_from_env(),
+            timer=app.state.workout.timer,
+        )
 
     yield
 
     # ---- shutdown ----
     logging.info("Shutting down ANT+ Metrics Service...")
     shutdown_event.set()  # signal shutdown to generators
-    if app.state.metrics:
-        await asyncio.to_thread(app.state.metrics.stop)
+    if reader_mode:
+        app.state.metrics.close()
+    elif app.state.metrics:
+        app.state.metrics.stop()
+        await asyncio.to_thread(app.state.metrics.join, 5)
+    # after the metrics so the end of the last session is written
+    await asyncio.to_thread(app.state.database.close)
 
 
 app = FastAPI(title="ANT+ Metrics Service", lifespan=lifespan)
@@ -63,16 +115,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.exception_handler(CollectorUnavailableError)
+async def collector_unavailable_handler(
+    request: Request, exc: CollectorUnavailableError
+):
+    # control endpoints hit an API worker of the multi-process mode
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
 # Path to frontend build folder inside app/
 build_path = pathlib.Path(__file__).parent / "dist"
 if build_path.exists() and build_path.is_dir():
+    # build the .br/.gz variants once, requests only pick one
+    precompress(build_path)
+
     # Serve "assets" folder
-    app.mount("/assets", StaticFiles(directory=build_path / "assets"), name="assets")
+    app.mount(
+        "/assets",
+        PrecompressedStaticFiles(directory=build_path / "assets"),
+        name="assets",
+    )
+
+    # Serve index.html at root, revalidated with ETag / 304
+    index_files = PrecompressedStaticFiles(directory=build_path)
 
-    # Serve index.html at root
     @app.get("/")
-    def root():
-        return FileResponse(build_path / "index.html")
+    async def root(request: Request):
+        return await index_files.get_response("index.html", request.scope)
 else:
     logger.warning(
         "Frontend build folder not found at %s, skipping frontend mount.", build_path
@@ -84,35 +154,32 @@ else:
 # -------------------------
 @app.post("/metrics/start")
 def start_metrics():
-    max_retries = 3
-    for attempt in range(1, max_retries + 1):
-        try:
-            app.state.metrics.start()
-            return {"message": "Metrics collection started"}
-        except Exception as e:
-            logging.warning(f"Failed to start metrics (attempt {attempt}): {str(e)}")
-            time.sleep(0.5)  # brief pause before retrying
-
-    # If all retries failed, raise HTTPException
-    raise HTTPException(
-        status_code=500, detail=f"Failed to start metrics after {max_retries} attempts"
-    )
+    metrics: Metrics = app.state.metrics
+    state = metrics.start()
+    if state == MetricsState.STOPPING:
+        raise HTTPException(
+            status_code=409, detail="Metrics collection is still stopping"
+        )
+    return {"message": f"Metrics collection {state.value}", "state": state}
 
 
 @app.post("/metrics/stop")
 def stop_metrics():
-    try:
-        app.state.metrics.stop()
-        return {"message": "Metrics collection stopped"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to stop metrics: {str(e)}")
+    metrics: Metrics = app.state.metrics
+    state = metrics.stop()
+    return {"message": f"Metrics collection {state.value}", "state": state}
 
 
 @app.post("/metrics/settings")
 def update_metrics_settings(payload: MetricsSettingsModel):
     try:
-        app.state.metrics.set_metrics_settings(payload)
-        return {"message": f"Metrics settings updated to {payload}"}
+        settings = app.state.metrics.set_metrics_settings(payload)
+        return {
+            "message": f"Metrics settings updated to {settings}",
+            "version": settings.version,
+        }
+    except SettingsConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to update: {str(e)}")
 
@@ -135,6 +202,25 @@ def get_metrics():
         raise HTTPException(status_code=500, detail=f"Failed to get metrics: {str(e)}")
 
 
+@app.get("/metrics/raw", response_model=RawMetricsModel)
+def get_raw_metrics():
+    return app.state.metrics.get_raw_metrics()
+
+
+@app.get("/metrics/history", response_model=HistoryModel)
+def get_metrics_history(
+    key: MetricsKey,
+    from_ts: Optional[float] = Query(None, alias="from"),
+    to_ts: Optional[float] = Query(None, alias="to"),
+    points: int = Query(500, ge=2, le=5000),
+    method: Literal["lttb", "minmax"] = "lttb",
+    raw: bool = Query(False, description="Values before the filter pipelines"),
+):
+    if from_ts is not None and to_ts is not None and from_ts >= to_ts:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    return app.state.metrics.get_history(key, from_ts, to_ts, points, method, raw)
+
+
 @app.get("/metrics/devices", response_model=list[SensorModel])
 def get_metrics_devices():
     try:
@@ -144,15 +230,70 @@ def get_metrics_devices():
         raise HTTPException(status_code=500, detail=f"Failed to get devices: {str(e)}")
 
 
+@app.get("/metrics/channels", response_model=ChannelUtilizationModel)
+def get_metrics_channels():
+    return ChannelUtilizationModel(**app.state.metrics.get_channel_utilization())
+
+
+@app.get("/metrics/nodes", response_model=list[NodeStatsModel])
+def get_metrics_nodes():
+    return [NodeStatsModel(**stats) for stats in app.state.metrics.get_node_stats()]
+
+
+@app.get("/metrics/pairing", response_model=list[PairedSensorModel])
+def get_paired_devices():
+    devices = app.state.metrics.get_paired_devices()
+    return [PairedSensorModel(**d._asdict()) for d in devices]
+
+
+@app.post("/metrics/pairing", response_model=PairedSensorModel)
+def pair_device(payload: PairedSensorModel):
+    try:
+        dev = app.state.metrics.pair_device(
+            payload.device_id, payload.device_type, payload.trans_type
+        )
+        return PairedSensorModel(**dev._asdict())
+    except CollectorUnavailableError:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to pair: {str(e)}")
+
+
+@app.delete("/metrics/pairing/{device_id}", response_model=list[PairedSensorModel])
+def unpair_device(device_id: int):
+    removed = app.state.metrics.unpair_device(device_id)
+    if not removed:
+        raise HTTPException(status_code=404, detail=f"Device {device_id} not paired")
+    return [PairedSensorModel(**d._asdict()) for d in removed]
+
+
+@app.get("/metrics/filter", response_model=DeviceFilterModel)
+def get_device_filter():
+    metrics: Metrics = app.state.metrics
+    return DeviceFilterModel(
+        allow_device_ids=metrics.filter_device_ids,
+        deny_device_ids=metrics.deny_device_ids,
+    )
+
+
+@app.post("/metrics/filter", response_model=DeviceFilterModel)
+def set_device_filter(payload: DeviceFilterModel):
+    try:
+        app.state.metrics.set_filter_device_ids(
+            payload.allow_device_ids, payload.deny_device_ids
+        )
+        return payload
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 async def metrics_event_generator():
     while not shutdown_event.is_set():
         try:
-            metrics: MetricsModel = await asyncio.to_thread(
-                app.state.metrics.get_metrics
-            )
-
-            # Convert to JSON string (Pydantic handles datetime automatically)
-            data = metrics.model_dump_json()
+            # serialized once by the collector in the multi-process mode
+            data = await asyncio.to_thread(app.state.metrics.get_metrics_json)
 
             # SSE format: `data: <payload>\n\n`
             yield f"data: {data}\n\n"
@@ -195,31 +336,143 @@ async def stream_devices():
     return StreamingResponse(device_event_generator(), media_type="text/event-stream")
 
 
+# -------------------------
+# Event endpoints
+# -------------------------
+@app.get("/events", response_model=list[EventModel])
+def get_events(after: int = Query(0, ge=0, description="Last sequence number seen")):
+    return app.state.metrics.get_events(after)
+
+
+async def rule_event_generator(last_seq: int):
+    metrics: Metrics = app.state.metrics
+    while not shutdown_event.is_set():
+        try:
+            # parses the snapshot's events blob in the multi-process mode
+            events = await asyncio.to_thread(metrics.get_events, last_seq)
+            for event in events:
+                last_seq = event["seq"]
+                data = EventModel(**event).model_dump_json()
+                # the id lets a reconnecting client resume with Last-Event-ID
+                yield f"id: {last_seq}\ndata: {data}\n\n"
+
+            await asyncio.sleep(0.25)
+        except asyncio.CancelledError:
+            break
+        except Exception as error:
+            logger.error("Error in rule_event_generator", exc_info=True)
+            yield f"data: {json.dumps({'error': str(error), 'type': type(error).__name__, 'cause': repr(error.__cause__)})}\n\n"
+            await asyncio.sleep(1)
+
+
+@app.get("/events/stream")
+async def stream_events(request: Request):
+    """
+    Stream rule events using SSE. New clients only get events from now on,
+    a reconnect with Last-Event-ID gets the ones it missed.
+    """
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        last_seq = int(last_event_id)
+    else:
+        last_seq = app.state.metrics.events.last_seq
+    return StreamingResponse(
+        rule_event_generator(last_seq), media_type="text/event-stream"
+    )
+
+
+# -------------------------
+# Session endpoints
+# -------------------------
+@app.get("/sessions", response_model=list[SessionModel])
+def get_sessions():
+    return app.state.metrics.get_sessions()
+
+
+@app.get("/sessions/{session_id}/summary", response_model=SessionSummaryModel)
+def get_session_summary(session_id: str):
+    summary = app.state.metrics.get_session_summary(session_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return summary
+
+
+@app.get("/sessions/{session_id}/laps", response_model=list[LapModel])
+def get_session_laps(session_id: str):
+    laps = app.state.metrics.get_laps(session_id)
+    if laps is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return laps
+
+
+# -------------------------
+# Stored history endpoints
+# -------------------------
+@app.get("/history/sessions", response_model=list[StoredSessionModel])
+async def get_stored_sessions(
+    rider: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = Query(50, ge=1, le=1000),
+):
+    return await app.state.database.list_sessions(rider, since, until, limit)
+
+
+@app.get("/history/sessions/{session_id}/laps", response_model=list[LapModel])
+async def get_stored_laps(session_id: str):
+    return await app.state.database.session_laps(session_id)
+
+
+@app.get(
+    "/history/sessions/{session_id}/samples", response_model=list[StoredSampleModel]
+)
+async def get_stored_samples(session_id: str, key: MetricsKey):
+    return await app.state.database.session_samples(session_id, key)
+
+
+@app.get("/history/best-efforts", response_model=list[BestEffortModel])
+async def get_best_efforts(
+    key: MetricsKey = MetricsKey.POWER,
+    duration_s: int = Query(1200, gt=0),
+    rider: Optional[str] = None,
+    since: Optional[float] = None,
+    limit: int = Query(10, ge=1, le=100),
+):
+    return await app.state.database.best_efforts(key, duration_s, rider, since, limit)
+
+
+@app.get("/history/trend", response_model=list[TrendModel])
+async def get_trend(
+    key: MetricsKey = MetricsKey.POWER,
+    period: Literal["day", "week", "month"] = "week",
+    rider: Optional[str] = None,
+    since: Optional[float] = None,
+):
+    return await app.state.database.trend(key, period, rider, since)
+
+
 @app.get("/workout", response_model=list[IntervalModel])
 def get_workout():
-    return app.state.workout
+    return app.state.workout.get_intervals()
 
 
 @app.post("/workout", response_model=list[IntervalModel])
 def set_workout(intervals: list[IntervalModel]):
-    timer: Timer = app.state.timer
-
-    if timer.is_running():
-        raise HTTPException(
-            status_code=400, detail="Cannot update workout while the timer is running"
-        )
-
-    app.state.workout = intervals
-    return app.state.workout
+    workout: Workout = app.state.workout
+    try:
+        return workout.set_intervals(intervals)
+    except WorkoutRunningError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/workout/start")
 def start_workout():
     try:
-        timer: Timer = app.state.timer
-        timer.set_intervak(app.state.workout)
-        timer.start()
+        workout: Workout = app.state.workout
+        workout.start()
         return {"message": "Workout started"}
+    except CollectorUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to start: {str(e)}")
 
@@ -227,21 +480,28 @@ def start_workout():
 @app.post("/workout/stop")
 def stop_workout():
     try:
-        timer: Timer = app.state.timer
-        timer.stop()
+        workout: Workout = app.state.workout
+        workout.stop()
         return {"message": "Workout stopped"}
+    except CollectorUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to stop pdate: {str(e)}")
 
 
-async def workout_event_generator():
-    timer: Timer = app.state.timer
+def workout_progress() -> Optional[IntervalProgressModel]:
+    progress = app.state.workout.progress()
+    if progress is not None:
+        lap = app.state.metrics.get_current_lap()
+        if lap is not None:
+            progress.lap = LapModel(**lap)
+    return progress
 
+
+async def workout_event_generator():
     while True:
         try:
-            progress: IntervalProgressModel = await asyncio.to_thread(
-                timer.current_interval
-            )
+            progress: IntervalProgressModel = await asyncio.to_thread(workout_progress)
             if progress:
                 data = progress.model_dump_json()
                 yield f"data: {data}\n\n"
@@ -0,0 +1,152 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+DeviceKey = tuple[int, int]  # (device_id, device_type)
+
+
+@dataclass
+class ChannelAllocation:
+    key: DeviceKey
+    trans_type: int
+    paired: bool
+    device: Any = None  # AntPlusDevice once the channel is open
+    opened_at: float = field(default_factory=time.monotonic)
+    last_seen: Optional[float] = None
+
+    def idle_seconds(self, now: float) -> float:
+        return now - (self.last_seen if self.last_seen is not None else self.opened_at)
+
+
+class ChannelManager:
+    """
+    Tracks which device owns which ANT+ channel of the adapter.
+
+    A device key can only be allocated once, so duplicate `on_found`
+    callbacks never open a second channel. When the adapter is full a
+    paired device may take the channel of the unpaired device that has
+    been silent the longest; unpaired devices silent for `idle_timeout_s`
+    are reported by `idle` so their channel can be closed.
+    """
+
+    def __init__(self, capacity: int = 8, idle_timeout_s: float = 30.0):
+        self.capacity = capacity
+        self.reserved = 0  # channels used by something else, e.g. the scanner
+        self.idle_timeout_s = idle_timeout_s
+        self.lock = threading.Lock()
+        self._allocations: dict[DeviceKey, ChannelAllocation] = {}
+        self.rejected = 0
+        self.evicted = 0
+
+    def free(self) -> int:
+        return self.capacity - self.reserved - len(self._allocations)
+
+    def allocate(
+        self, key: DeviceKey, trans_type: int = 0, paired: bool = False
+    ) -> tuple[bool, Optional[ChannelAllocation]]:
+        """
+        Reserve a channel for `key`. Returns (allocated, evicted) where
+        evicted is an allocation the caller must close to make room.
+        """
+        with self.lock:
+            if key in self._allocations:
+                return False, None
+
+            evicted = None
+            if self.free() <= 0:
+                if not paired:
+                    self.rejected += 1
+                    return False, None
+                evicted = self._eviction_candidate()
+                if evicted is None:
+                    self.rejected += 1
+                    return False, None
+                del self._allocations[evicted.key]
+                self.evicted += 1
+
+            self._allocations[key] = ChannelAllocation(key, trans_type, paired)
+            return True, evicted
+
+    def _eviction_candidate(self) -> Optional[ChannelAllocation]:
+        now = time.monotonic()
+        candidates = [a for a in self._allocations.values() if not a.paired]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda a: a.idle_seconds(now))
+
+    def attach(self, key: DeviceKey, device):
+        with self.lock:
+            allocation = self._allocations.get(key)
+            if allocation is not None:
+                allocation.device = device
+
+    def release(self, key: DeviceKey) -> Optional[ChannelAllocation]:
+        with self.lock:
+            return self._allocations.pop(key, None)
+
+    def release_all(self) -> list[ChannelAllocation]:
+        with self.lock:
+            allocations = list(self._allocations.values())
+            self._allocations.clear()
+            self.reserved = 0
+            return allocations
+
+    def has(self, key: DeviceKey) -> bool:
+        return key in self._allocations
+
+    def touch(self, key: DeviceKey, now: Optional[float] = None):
+        # called for every data page, a dict lookup without the lock is enough
+        allocation = self._allocations.get(key)
+        if allocation is not None:
+            allocation.last_seen = time.monotonic() if now is None else now
+
+    def set_paired(self, key: DeviceKey, paired: bool):
+        allocation = self._allocations.get(key)
+        if allocation is not None:
+            allocation.paired = paired
+
+    def idle(self, now: Optional[float] = None) -> list[ChannelAllocation]:
+        """Unpaired allocations without data for longer than idle_timeout_s."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return [
+                a
+                for a in self._allocations.values()
+                if not a.paired
+                and a.device is not None
+                and a.idle_seconds(now) > self.idle_timeout_s
+            ]
+
+    def devices(self) -> list:
+        with self.lock:
+            return [a.device for a in self._allocations.values() if a.device]
+
+    def allocations(self) -> list[ChannelAllocation]:
+        with self.lock:
+            return list(self._allocations.values())
+
+    def utilization(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            used = len(self._allocations)
+            return {
+                "capacity": self.capacity,
+                "reserved": self.reserved,
+                "used": used,
+                "free": max(self.capacity - self.reserved - used, 0),
+                "utilization": (
+                    (used + self.reserved) / self.capacity if self.capacity else None
+                ),
+                "rejected": self.rejected,
+                "evicted": self.evicted,
+                "devices": [
+                    {
+                        "device_id": a.key[0],
+                        "device_type": a.key[1],
+                        "paired": a.paired,
+                        "idle_seconds": round(a.idle_seconds(now), 1),
+                    }
+                    for a in self._allocations.values()
+                ],
+            }
@@ -1,55 +1,410 @@
+"""
+Command line tools, run with `python -m app.cli <command>`.
+
+  record     write the filtered samples of a live session to a CSV file
+  replay     play a recording back at N x speed and print its summary
+  dashboard  live metrics in the terminal, redrawn only when they change
+  bench      cost of the ingest path per sample
+
+Live commands wait on the change notifications of `Metrics` instead of
+polling. Recordings are `t,metric,value` lines, gzip compressed when the
+file name ends with .gz.
+"""
+
+import argparse
+import gzip
+import json
 import logging
-from time import sleep
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+
 from app.ant import Metrics
+from app.core import get_data_dir
+from app.laps import RunningStats
+from app.model import MetricsModel, MetricsSettingsModel, RuleModel
+from app.nodes import SIMULATED_SENSORS, SimulatedBackend, backend_factory_from_env
+from app.pairing import PairingCache
+from app.session import Session
+from app.settings import SettingsStore
+from app.util import MetricsKey
+
+RECORDING_HEADER = "t,metric,value\n"
+
+# metric, label, unit, decimals
+ROWS = (
+    (MetricsKey.POWER, "Power", "W", 0),
+    (MetricsKey.HEART_RATE, "Heart rate", "bpm", 0),
+    (MetricsKey.CADENCE, "Cadence", "rpm", 0),
+    (MetricsKey.SPEED, "Speed", "km/h", 1),
+    (MetricsKey.DISTANCE, "Distance", "m", 0),
+)
+
+
+def _open(path: Path, mode: str) -> TextIO:
+    if path.suffix == ".gz":
+        return gzip.open(path, mode + "t", newline="")
+    return open(path, mode, newline="", buffering=1 << 16)
+
+
+class Recorder:
+    """Appends every filtered sample to a recording file."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.file = _open(path, "w")
+        self.file.write(RECORDING_HEADER)
+
+    def on_sample(self, key: MetricsKey, value: float, t: float):
+        # runs on the ANT+ threads, a buffered write and nothing else
+        line = f"{t:.3f},{key.value},{value:.6g}\n"
+        with self.lock:
+            self.file.write(line)
+            self.samples += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def read_recording(path: Path) -> Iterator[tuple[float, MetricsKey, float]]:
+    with _open(path, "r") as fh:
+        if fh.readline() != RECORDING_HEADER:
+            raise ValueError(f"{path} is not a recording")
+        for line in fh:
+            t, metric, value = line.rstrip("\n").split(",")
+            yield float(t), MetricsKey(metric), float(value)
+
+
+class Dashboard:
+    """
+    Draws a block of lines in place. Nothing is written when the text is
+    the same as the last frame; without a terminal every new frame is
+    printed below the previous one.
+    """
+
+    def __init__(self, out: TextIO = sys.stdout, min_interval_s: float = 0.2):
+        self.out = out
+        self.tty = out.isatty()
+        self.min_interval_s = min_interval_s
+        self._last: Optional[str] = None
+        self._lines = 0
 
+    def draw(self, lines: list[str]) -> bool:
+        text = "\n".join(lines)
+        if text == self._last:
+            return False
+        if self.tty:
+            # back to the first line of the last frame and clear below it
+            up = f"\x1b[{self._lines}F" if self._lines else ""
+            self.out.write(f"{up}\x1b[J{text}\n")
+        else:
+            self.out.write(f"{text}\n\n")
+        self.out.flush()
+        self._last = text
+        self._lines = len(lines)
+        return True
 
-def stream_metrics(filter_device_ids=None):
-    """Stream metrics from sensors."""
-    filter_device_ids = filter_device_ids or []
 
-    metrics_collector = Metrics(filter_device_ids=filter_device_ids)
-    metrics_collector.start()
+def _fmt(value: Optional[float], decimals: int) -> str:
+    return "-" if value is None else f"{value:.{decimals}f}"
 
+
+def format_rows(
+    status: str, values: dict[MetricsKey, tuple[Optional[float], Optional[float]]]
+) -> list[str]:
+    """`values` maps a metric to (current, average)."""
+    lines = [status, f"{'':<12}{'now':>9}{'avg':>9}"]
+    for key, label, unit, decimals in ROWS:
+        value, average = values.get(key, (None, None))
+        lines.append(
+            f"{label:<12}{_fmt(value, decimals):>9}{_fmt(average, decimals):>9} {unit}"
+        )
+    return lines
+
+
+def metrics_lines(metrics: MetricsModel, sensors: int) -> list[str]:
+    state = metrics.state.value if metrics.state else "idle"
+    status = f"{state}  sensors: {sensors}"
+    if metrics.state_message:
+        status += f"  ({metrics.state_message})"
+    if metrics.zone_name:
+        status += f"  {metrics.zone_name.replace('_', ' ')}"
+    return format_rows(
+        status,
+        {
+            MetricsKey.POWER: (metrics.power, metrics.ma_power),
+            MetricsKey.HEART_RATE: (metrics.heart_rate, metrics.ma_heart_rate),
+            MetricsKey.CADENCE: (metrics.cadence, metrics.ma_cadence),
+            MetricsKey.SPEED: (metrics.speed, metrics.ma_speed),
+            # ma_distance is the total of this run
+            MetricsKey.DISTANCE: (metrics.ma_distance, None),
+        },
+    )
+
+
+def create_metrics(args: argparse.Namespace) -> Metrics:
+    if args.simulated:
+        backend_factory = lambda index: SimulatedBackend(SIMULATED_SENSORS)  # noqa: E731
+    else:
+        backend_factory = backend_factory_from_env()
+    metrics = Metrics(
+        # wheel sizes etc. of the service, the device filter stays in memory
+        settings_store=SettingsStore(get_data_dir() / "settings.json"),
+        pairing=PairingCache(),
+        adapters=args.adapters,
+        backend_factory=backend_factory,
+    )
+    if args.device_id or args.deny_device_id:
+        metrics.set_filter_device_ids(args.device_id, args.deny_device_id)
+    return metrics
+
+
+def _stop_event() -> threading.Event:
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+    return stop
+
+
+def run_live(
+    metrics: Metrics,
+    stop: threading.Event,
+    duration_s: Optional[float],
+    dashboard: Optional[Dashboard],
+):
+    """Runs until stopped or `duration_s` passed, redrawing on changes."""
+    deadline = time.monotonic() + duration_s if duration_s else None
+    metrics.start()
     try:
-        while True:
-            print(f"Devices : {metrics_collector.get_devices()}")
-            print(f"Metrics : {metrics_collector.get_metrics()}")
-            sleep(0.5)
-    except KeyboardInterrupt:
-        pass
+        version = 0
+        while not stop.is_set():
+            timeout = 1.0
+            if deadline is not None:
+                timeout = min(timeout, deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+            if dashboard is None:
+                stop.wait(timeout)
+                continue
+            version = metrics.changes.wait(version, timeout)
+            dashboard.draw(
+                metrics_lines(metrics.get_metrics(), len(metrics.get_devices()))
+            )
+            # changes during the pause are drawn together as one frame
+            stop.wait(dashboard.min_interval_s)
     finally:
-        metrics_collector.stop()
+        metrics.stop()
+        metrics.join(timeout=5)
 
 
-def get_device_filter():
-    return [10936, 10937, 10938]  # Example device IDs to filter
+def record(args: argparse.Namespace) -> int:
+    metrics = create_metrics(args)
+    recorder = Recorder(Path(args.output))
+    metrics.add_sample_listener(recorder.on_sample)
+    dashboard = Dashboard() if args.dashboard else None
+    try:
+        run_live(metrics, _stop_event(), args.duration, dashboard)
+    finally:
+        recorder.close()
+    print(f"Recorded {recorder.samples} samples to {recorder.path}")
+    return 0
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.WARNING)
-    logging.getLogger("app.ant").setLevel(logging.INFO)
-
-    options = {
-        "auto": lambda: stream_metrics(),
-        "a": lambda: stream_metrics(),
-        "custom": lambda: stream_metrics(get_device_filter()),
-        "c": lambda: stream_metrics(get_device_filter()),
-    }
-
-    user_choice = (
-        input(
-            "\nSelect mode:\n"
-            "  auto   - Auto detect sensors\n"
-            "  custom - Use predefined sensors\n"
-            "\nEnter choice: "
+def dashboard(args: argparse.Namespace) -> int:
+    metrics = create_metrics(args)
+    run_live(metrics, _stop_event(), args.duration, Dashboard())
+    return 0
+
+
+def replay(args: argparse.Namespace) -> int:
+    path = Path(args.recording)
+    samples = list(read_recording(path))
+    if not samples:
+        print(f"{path} has no samples")
+        return 1
+
+    stop = _stop_event()
+    board = None if args.no_dashboard else Dashboard()
+    session = Session(rider=path.stem)
+    session.started_at = samples[0][0]
+    stats = {key: RunningStats() for key in MetricsKey}
+    last: dict[MetricsKey, float] = {}
+    distance = 0.0
+
+    def draw(t: float):
+        values = {key: (last.get(key), stats[key].to_dict()["avg"]) for key in last}
+        if MetricsKey.DISTANCE in last:
+            values[MetricsKey.DISTANCE] = (distance, None)
+        board.draw(
+            format_rows(f"replay {args.speed:g}x  {t - samples[0][0]:.0f} s", values)
+        )
+
+    t0 = samples[0][0]
+    wall_start = time.monotonic()
+    next_draw = 0.0
+    for t, key, value in samples:
+        if stop.is_set():
+            break
+        if args.speed > 0:
+            delay = (t - t0) / args.speed - (time.monotonic() - wall_start)
+            if delay > 0:
+                stop.wait(delay)
+        if key == MetricsKey.DISTANCE and key in last:
+            step = value - last[key]
+            distance += step if step >= 0 else value
+        session.record(key, value, t)
+        stats[key].add(value)
+        last[key] = value
+        if board is not None and time.monotonic() >= next_draw:
+            draw(t)
+            next_draw = time.monotonic() + board.min_interval_s
+    if board is not None:
+        draw(t)
+    session.ended_at = t
+
+    # NumPy is only needed for the summary
+    from app.analytics import summarize
+
+    settings = SettingsStore(get_data_dir() / "settings.json").current
+    summary = summarize(session, settings.ftp, settings.hr_max)
+    print(json.dumps(summary, indent=2, default=str))
+    return 0
+
+
+def bench(args: argparse.Namespace) -> int:
+    """Times the ingest path (filters, history, session, rules, laps)."""
+    rules = [
+        RuleModel(
+            name=f"rule {i}",
+            metric=MetricsKey.POWER,
+            condition="above" if i % 2 else "below",
+            threshold=100 + i % 300,
+            duration_s=i % 10,
         )
-        .lower()
-        .strip()
+        for i in range(args.rules)
+    ]
+    metrics = Metrics(
+        settings_store=SettingsStore(
+            defaults=MetricsSettingsModel(age=45, rules=rules)
+        ),
+        backend_factory=lambda index: SimulatedBackend([]),
     )
+    metrics.sessions.start()
+    metrics.rules.reset(time.monotonic())
 
-    action = options.get(user_choice)
+    rng = random.Random(1)
+    samples = []
+    distance = 0.0
+    for i in range(args.samples):
+        key = (
+            MetricsKey.POWER,
+            MetricsKey.HEART_RATE,
+            MetricsKey.CADENCE,
+            MetricsKey.SPEED,
+            MetricsKey.DISTANCE,
+        )[i % 5]
+        if key == MetricsKey.POWER:
+            value = rng.gauss(220, 60)
+        elif key == MetricsKey.HEART_RATE:
+            value = rng.gauss(140, 10)
+        elif key == MetricsKey.CADENCE:
+            value = rng.gauss(90, 5)
+        elif key == MetricsKey.SPEED:
+            value = rng.gauss(30, 3)
+        else:
+            distance += 2.1
+            value = distance
+        samples.append((key, max(value, 0.0)))
 
-    if action:
-        action()
-    else:
-        print("Invalid option.")
+    def timed(label: str, fn, count: int):
+        start = time.perf_counter_ns()
+        fn()
+        per_op_us = (time.perf_counter_ns() - start) / count / 1000
+        print(f"{label:<28}{per_op_us:>10.2f} us")
+
+    print(f"{args.samples} samples, {args.rules} rules")
+
+    def ingest():
+        for key, value in samples:
+            metrics._filter(key, value, time.monotonic())
+
+    timed("ingest per sample", ingest, len(samples))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        recorder = Recorder(Path(tmp) / "bench.csv")
+        now = time.time()
+
+        def write():
+            for key, value in samples:
+                recorder.on_sample(key, value, now)
+
+        timed("recorder per sample", write, len(samples))
+        recorder.close()
+
+    def notify():
+        for _ in samples:
+            metrics.changes.notify()
+
+    timed("change notification", notify, len(samples))
+    return 0
+
+
+def _add_live_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--device-id", type=int, action="append", default=[], help="allow list"
+    )
+    parser.add_argument(
+        "--deny-device-id", type=int, action="append", default=[], help="deny list"
+    )
+    parser.add_argument("--adapters", type=int, default=1, help="ANT+ USB sticks")
+    parser.add_argument(
+        "--simulated", action="store_true", help="fake sensors, no USB stick"
+    )
+    parser.add_argument("--duration", type=float, help="stop after N seconds")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="ANT+ metrics command line tools")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_record = commands.add_parser("record", help="record a live session")
+    parser_record.add_argument("output", help="recording file, .csv or .csv.gz")
+    parser_record.add_argument(
+        "--dashboard", action="store_true", help="show the dashboard while recording"
+    )
+    _add_live_arguments(parser_record)
+    parser_record.set_defaults(func=record)
+
+    parser_dashboard = commands.add_parser("dashboard", help="live terminal dashboard")
+    _add_live_arguments(parser_dashboard)
+    parser_dashboard.set_defaults(func=dashboard)
+
+    parser_replay = commands.add_parser("replay", help="replay a recording")
+    parser_replay.add_argument("recording")
+    parser_replay.add_argument(
+        "--speed", type=float, default=1.0, help="N x real time, 0 = no waiting"
+    )
+    parser_replay.add_argument("--no-dashboard", action="store_true")
+    parser_replay.set_defaults(func=replay)
+
+    parser_bench = commands.add_parser("bench", help="time the ingest path")
+    parser_bench.add_argument("--samples", type=int, default=100_000)
+    parser_bench.add_argument("--rules", type=int, default=0)
+    parser_bench.set_defaults(func=bench)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
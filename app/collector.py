@@ -0,0 +1,191 @@
+"""
+Collector process of the multi-process deployment, run with
+`python -m app.collector`.
+
+Owns the ANT+ nodes, the aggregation and the session database and
+publishes a snapshot into shared memory a few times per second. The API
+is started separately with ANT_MODE=reader and as many uvicorn workers
+as needed, see app.shared. The workout timer runs here too, so laps and
+interval rules see it. Commands of the API workers (start/stop, workout)
+arrive on a Unix socket, see app.control.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+from typing import Optional
+
+from app.ant import Metrics
+from app.control import ControlServer, default_socket_path
+from app.core import get_data_dir, setup_logging
+from app.model import EventModel, IntervalModel
+from app.nodes import backend_factory_from_env
+from app.pairing import PairingCache
+from app.settings import SettingsStore
+from app.shared import DEFAULT_NAME, SERIES, SeriesKey, SharedSnapshotWriter
+from app.store import SessionDatabase
+from app.util import MetricsKey
+from app.workout import Workout
+
+# events in the snapshot, readers resume from their last sequence number
+SNAPSHOT_EVENTS = 100
+
+
+class SnapshotPublisher:
+    """
+    Collects the filtered and raw samples between two publishes and writes
+    them together with the current state into the shared snapshot.
+    """
+
+    def __init__(
+        self, metrics: Metrics, writer: SharedSnapshotWriter, workout: Workout
+    ):
+        self.metrics = metrics
+        self.writer = writer
+        self.workout = workout
+        self.lock = threading.Lock()
+        self.pending: dict[SeriesKey, list[tuple[float, float]]] = {
+            series_key: [] for series_key in SERIES
+        }
+        metrics.add_sample_listener(self._on_sample)
+        metrics.add_sample_listener(self._on_raw_sample, raw=True)
+
+    def _on_sample(self, key: MetricsKey, value: float, t: float):
+        with self.lock:
+            self.pending[key, False].append((t, value))
+
+    def _on_raw_sample(self, key: MetricsKey, value: float, t: float):
+        with self.lock:
+            self.pending[key, True].append((t, value))
+
+    def publish(self):
+        with self.lock:
+            samples = self.pending
+            self.pending = {series_key: [] for series_key in SERIES}
+
+        metrics = self.metrics
+        events = [
+            EventModel(**event).model_dump(mode="json")
+            for event in metrics.get_events()[-SNAPSHOT_EVENTS:]
+        ]
+        blobs = {
+            "metrics": metrics.get_metrics_json().encode(),
+            "raw": metrics.get_raw_metrics().model_dump_json().encode(),
+            "devices": json.dumps(metrics.get_devices()).encode(),
+            "events": json.dumps(events).encode(),
+            "lap": json.dumps(metrics.get_current_lap()).encode(),
+            "status": json.dumps(self._status()).encode(),
+            "workout": json.dumps(self._workout()).encode(),
+        }
+        self.writer.publish(blobs, samples)
+
+    def _workout(self) -> Optional[dict]:
+        progress = self.workout.progress()
+        return progress.model_dump(mode="json") if progress else None
+
+    def _status(self) -> dict:
+        """Node, channel and pairing state, rarely changes but is cheap."""
+        metrics = self.metrics
+        session = metrics.sessions.current
+        return {
+            "nodes": metrics.get_node_stats(),
+            "channels": metrics.get_channel_utilization(),
+            "pairing": [dev._asdict() for dev in metrics.get_paired_devices()],
+            "allow_device_ids": metrics.filter_device_ids,
+            "deny_device_ids": metrics.deny_device_ids,
+            "session_id": (
+                session.id if session is not None and session.is_active else None
+            ),
+        }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="ANT+ collector process")
+    parser.add_argument(
+        "--name",
+        default=os.getenv("ANT_SHM_NAME", DEFAULT_NAME),
+        help="shared memory segment, the same ANT_SHM_NAME as the API workers",
+    )
+    parser.add_argument(
+        "--interval-s", type=float, default=0.25, help="time between snapshots"
+    )
+    parser.add_argument(
+        "--control",
+        default=None,
+        help="command socket, the same ANT_CONTROL_SOCKET as the API workers",
+    )
+    parser.add_argument(
+        "--start",
+        action="store_true",
+        help="start collecting right away instead of waiting for /metrics/start",
+    )
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    logger = logging.getLogger("app.collector")
+
+    database = SessionDatabase(get_data_dir() / "sessions.db")
+    database.start()
+    workout = Workout()
+    metrics = Metrics(
+        settings_store=SettingsStore(get_data_dir() / "settings.json"),
+        database=database,
+        pairing=PairingCache(get_data_dir() / "pairing.json"),
+        adapters=int(os.getenv("ANT_ADAPTERS", "1")),
+        backend_factory=backend_factory_from_env(),
+        timer=workout.timer,
+    )
+    writer = SharedSnapshotWriter(args.name)
+    publisher = SnapshotPublisher(metrics, writer, workout)
+    control = ControlServer(
+        args.control or default_socket_path(),
+        {
+            "start": lambda: metrics.start().value,
+            "stop": lambda: metrics.stop().value,
+            "get_workout": lambda: [
+                i.model_dump(mode="json") for i in workout.get_intervals()
+            ],
+            "set_workout": lambda intervals: [
+                i.model_dump(mode="json")
+                for i in workout.set_intervals([IntervalModel(**i) for i in intervals])
+            ],
+            "start_workout": workout.start,
+            "stop_workout": workout.stop,
+        },
+    )
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    logger.info(
+        "Collector publishing to shared memory %s, commands on %s",
+        args.name,
+        control.path,
+    )
+    control.start()
+    if args.start:
+        metrics.start()
+    try:
+        while not stop.wait(args.interval_s):
+            try:
+                publisher.publish()
+            except Exception:
+                logger.warning("Could not publish snapshot", exc_info=True)
+    finally:
+        control.close()
+        metrics.stop()
+        metrics.join(5)
+        publisher.publish()  # readers see the idle state until we are gone
+        writer.close()
+        database.close()
+        logger.info("Collector stopped")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+"""
+Command channel of the multi-process deployment. The collector serves a
+few commands (start/stop, workout) on a Unix socket, an API worker sends
+one JSON line per connection and waits for the JSON reply. Errors are
+sent back with their type name so the worker can raise them again, see
+app.collector and app.shared.
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from app.core import get_data_dir
+
+TIMEOUT_S = 5.0
+MAX_REQUEST = 1024 * 1024
+
+
+def default_socket_path() -> Path:
+    return Path(os.getenv("ANT_CONTROL_SOCKET", get_data_dir() / "collector.sock"))
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server: ControlServer = self.server
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST))
+            command = server.commands[request["command"]]
+            reply = {"result": command(**request.get("args", {}))}
+        except Exception as e:
+            server.logger.debug("Control command failed", exc_info=True)
+            reply = {"error": str(e), "type": type(e).__name__}
+        self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Runs `commands[name](**args)` for every request on its own thread, the
+    commands must be thread safe and return something JSON serializable.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: Path, commands: dict[str, Callable[..., Any]]):
+        self.logger = logging.getLogger("app.control")
+        self.path = Path(path)
+        self.commands = commands
+        self.thread: Optional[threading.Thread] = None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # left over from a collector that didn't shut down cleanly
+        self.path.unlink(missing_ok=True)
+        super().__init__(str(self.path), _Handler)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.serve_forever, name="collector-control", daemon=True
+        )
+        self.thread.start()
+
+    def close(self):
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+        self.path.unlink(missing_ok=True)
+
+
+class ControlClient:
+    """
+    Sends commands to the ControlServer. An error reply is raised as the
+    matching exception of `errors` (RuntimeError for unknown types), a
+    collector that can't be reached as ConnectionError.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        errors: Optional[dict[str, type[Exception]]] = None,
+        timeout_s: float = TIMEOUT_S,
+    ):
+        self.path = Path(path) if path else default_socket_path()
+        self.errors = errors or {}
+        self.timeout_s = timeout_s
+
+    def call(self, command: str, **args) -> Any:
+        request = json.dumps({"command": command, "args": args}).encode() + b"\n"
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout_s)
+                sock.connect(str(self.path))
+                sock.sendall(request)
+                with sock.makefile("rb") as fh:
+                    data = fh.readline()
+        except OSError as e:
+            raise ConnectionError(f"Collector not reachable at {self.path}: {e}")
+        if not data:
+            raise ConnectionError("Collector closed the connection")
+
+        reply = json.loads(data)
+        if "error" in reply:
+            raise self.errors.get(reply["type"], RuntimeError)(reply["error"])
+        return reply["result"]
@@ -27,3 +27,11 @@ def setup_logging():
 
     # Fallback
     logging.basicConfig(level=logging.INFO)
+
+
+def get_data_dir() -> Path:
+    """Directory for persisted state, DATA_DIR or ./data by default."""
+    env_path = os.getenv("DATA_DIR")
+    path = Path(env_path) if env_path else Path.cwd() / "data"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
@@ -0,0 +1,58 @@
+import numpy as np
+
+
+def lttb(times, values, points: int) -> np.ndarray:
+    """
+    Largest-triangle-three-buckets: keeps first and last sample and from
+    each bucket in between the one with the largest triangle to the
+    previously kept sample and the next bucket's mean.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    n = times.size
+    if points >= n or points < 3:
+        return np.column_stack((times, values))
+
+    every = (n - 2) / (points - 2)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        lo = int(i * every) + 1
+        hi = int((i + 1) * every) + 1
+        next_hi = min(int((i + 2) * every) + 1, n)
+        avg_t = times[hi:next_hi].mean()
+        avg_v = values[hi:next_hi].mean()
+        area = np.abs(
+            (times[a] - avg_t) * (values[lo:hi] - values[a])
+            - (times[a] - times[lo:hi]) * (avg_v - values[a])
+        )
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return np.column_stack((times[selected], values[selected]))
+
+
+def min_max(times, mins, maxs, points: int) -> np.ndarray:
+    """Minimum and maximum of each of points / 2 buckets, in time order."""
+    times = np.asarray(times, dtype=np.float64)
+    mins = np.asarray(mins, dtype=np.float64)
+    maxs = np.asarray(maxs, dtype=np.float64)
+    n = times.size
+    if n == 0:
+        return np.empty((0, 2))
+
+    buckets = max(min(points // 2, n), 1)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    result = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if hi <= lo:
+            continue
+        i_min = lo + int(np.argmin(mins[lo:hi]))
+        i_max = lo + int(np.argmax(maxs[lo:hi]))
+        if i_min == i_max and mins[i_min] == maxs[i_max]:
+            result.append((times[i_min], mins[i_min]))
+            continue
+        for i, value in sorted(((i_min, mins[i_min]), (i_max, maxs[i_max]))):
+            result.append((times[i], value))
+    return np.array(result)
@@ -0,0 +1,240 @@
+import bisect
+import threading
+from collections import deque
+from typing import Optional
+
+from app.model import FilterStepModel
+from app.util import MetricsKey
+
+
+class SampleFilter:
+    """
+    One step of a filter pipeline. `apply` gets a value and its timestamp
+    and returns the value to pass on, or None to drop the sample.
+    """
+
+    def apply(self, value: float, t: float) -> Optional[float]:
+        raise NotImplementedError
+
+    def reset(self):
+        pass
+
+
+class RangeFilter(SampleFilter):
+    """Drops physically implausible values, O(1)."""
+
+    def __init__(
+        self, min_value: Optional[float] = None, max_value: Optional[float] = None
+    ):
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def apply(self, value: float, t: float) -> Optional[float]:
+        if self.min_value is not None and value < self.min_value:
+            return None
+        if self.max_value is not None and value > self.max_value:
+            return None
+        return value
+
+
+class _SortedWindow:
+    """Last k values kept both in arrival order and sorted, O(k) per push."""
+
+    def __init__(self, k: int):
+        self.k = k
+        self.values = deque()
+        self.sorted = []
+
+    def push(self, value: float):
+        if len(self.values) == self.k:
+            old = self.values.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, old)]
+        self.values.append(value)
+        bisect.insort(self.sorted, value)
+
+    def median(self) -> float:
+        n = len(self.sorted)
+        mid = n // 2
+        if n % 2:
+            return self.sorted[mid]
+        return (self.sorted[mid - 1] + self.sorted[mid]) / 2
+
+    def __len__(self):
+        return len(self.values)
+
+    def clear(self):
+        self.values.clear()
+        self.sorted.clear()
+
+
+class MedianFilter(SampleFilter):
+    """Median of the last k samples, O(k)."""
+
+    def __init__(self, k: int = 3):
+        self.window = _SortedWindow(k)
+
+    def apply(self, value: float, t: float) -> Optional[float]:
+        self.window.push(value)
+        return self.window.median()
+
+    def reset(self):
+        self.window.clear()
+
+
+class HampelFilter(SampleFilter):
+    """
+    Replaces a sample with the window median when it is more than
+    `n_sigmas` robust standard deviations (1.4826 * MAD) away from it.
+    Median and MAD ignore a single corrupt page, while a real step change
+    passes once it fills half the window. O(k log k) for the small k used.
+    """
+
+    MAD_SCALE = 1.4826
+
+    def __init__(self, k: int = 7, n_sigmas: float = 3.0, min_deviation: float = 0.0):
+        self.window = _SortedWindow(k)
+        self.n_sigmas = n_sigmas
+        # floor for the threshold, a perfectly steady signal has MAD 0
+        self.min_deviation = min_deviation
+
+    def apply(self, value: float, t: float) -> Optional[float]:
+        window = self.window
+        window.push(value)
+        if len(window) < window.k // 2 + 1:
+            return value
+
+        median = window.median()
+        mad = _median(sorted(abs(v - median) for v in window.sorted))
+        threshold = max(self.n_sigmas * self.MAD_SCALE * mad, self.min_deviation)
+        if abs(value - median) > threshold:
+            return median
+        return value
+
+    def reset(self):
+        self.window.clear()
+
+
+class ExponentialSmoothing(SampleFilter):
+    """s = alpha * x + (1 - alpha) * s, O(1)."""
+
+    def __init__(self, alpha: float = 0.3):
+        self.alpha = alpha
+        self.state: Optional[float] = None
+
+    def apply(self, value: float, t: float) -> Optional[float]:
+        if self.state is None:
+            self.state = value
+        else:
+            self.state = self.alpha * value + (1 - self.alpha) * self.state
+        return self.state
+
+    def reset(self):
+        self.state = None
+
+
+class RateLimitFilter(SampleFilter):
+    """Limits the change to `max_rate` units per second, O(1)."""
+
+    def __init__(self, max_rate: float):
+        self.max_rate = max_rate
+        self.last_value: Optional[float] = None
+        self.last_t: Optional[float] = None
+
+    def apply(self, value: float, t: float) -> Optional[float]:
+        if self.last_value is not None:
+            max_delta = self.max_rate * max(t - self.last_t, 0.0)
+            delta = value - self.last_value
+            if delta > max_delta:
+                value = self.last_value + max_delta
+            elif delta < -max_delta:
+                value = self.last_value - max_delta
+        self.last_value = value
+        self.last_t = t
+        return value
+
+    def reset(self):
+        self.last_value = None
+        self.last_t = None
+
+
+class FilterPipeline:
+    """Runs a value through the steps in order, stops at the first drop."""
+
+    def __init__(self, steps: list[SampleFilter]):
+        self.steps = steps
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def apply(self, value: Optional[float], t: float) -> Optional[float]:
+        if value is None:
+            return None
+        with self.lock:
+            for step in self.steps:
+                value = step.apply(value, t)
+                if value is None:
+                    self.dropped += 1
+                    return None
+        return value
+
+    def reset(self):
+        with self.lock:
+            for step in self.steps:
+                step.reset()
+
+
+def _median(sorted_values: list[float]) -> float:
+    n = len(sorted_values)
+    mid = n // 2
+    if n % 2:
+        return sorted_values[mid]
+    return (sorted_values[mid - 1] + sorted_values[mid]) / 2
+
+
+# plausibility limits plus a Hampel filter so one corrupt page (cadence 250,
+# speed 300 km/h) never reaches the display or the moving averages
+DEFAULT_FILTERS: dict[MetricsKey, list[FilterStepModel]] = {
+    MetricsKey.POWER: [
+        FilterStepModel(type="range", min_value=0, max_value=2500),
+        FilterStepModel(type="hampel", k=7, n_sigmas=3, min_deviation=50),
+    ],
+    MetricsKey.CADENCE: [
+        FilterStepModel(type="range", min_value=0, max_value=200),
+        FilterStepModel(type="hampel", k=5, n_sigmas=3, min_deviation=10),
+    ],
+    MetricsKey.SPEED: [
+        FilterStepModel(type="range", min_value=0, max_value=100),
+        FilterStepModel(type="hampel", k=5, n_sigmas=3, min_deviation=5),
+    ],
+    MetricsKey.HEART_RATE: [
+        FilterStepModel(type="range", min_value=30, max_value=230),
+        FilterStepModel(type="median", k=3),
+    ],
+    MetricsKey.DISTANCE: [],
+}
+
+
+def build_filter(step: FilterStepModel) -> SampleFilter:
+    """Creates a filter from a FilterStepModel."""
+    if step.type == "range":
+        return RangeFilter(step.min_value, step.max_value)
+    if step.type == "median":
+        return MedianFilter(step.k)
+    if step.type == "hampel":
+        return HampelFilter(step.k, step.n_sigmas, step.min_deviation)
+    if step.type == "ema":
+        return ExponentialSmoothing(step.alpha)
+    if step.type == "rate_limit":
+        return RateLimitFilter(step.max_rate)
+    raise ValueError(f"Unknown filter type {step.type}")
+
+
+def build_pipeline(steps: Optional[list[FilterStepModel]]) -> FilterPipeline:
+    return FilterPipeline([build_filter(step) for step in steps or []])
+
+
+def build_pipelines(
+    filters: Optional[dict[MetricsKey, list[FilterStepModel]]],
+) -> dict[MetricsKey, FilterPipeline]:
+    """One pipeline per metric, configured metrics replace the defaults."""
+    steps = {**DEFAULT_FILTERS, **(filters or {})}
+    return {key: build_pipeline(steps.get(key)) for key in MetricsKey}
@@ -0,0 +1,198 @@
+import bisect
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from app.util import MetricsKey
+
+# (bucket size in seconds, buckets kept): 2 h of 1 s, 24 h of 10 s, 7 d of 1 min
+ROLLUP_TIERS = ((1, 2 * 3600), (10, 24 * 360), (60, 7 * 24 * 60))
+RAW_RETENTION_S = 15 * 60
+# a source is used when it has at most this many points per requested point
+MAX_SOURCE_FACTOR = 8
+
+
+class RollupTier:
+    """
+    Fixed-size time buckets with count/sum/min/max, updated in O(1) per
+    sample. The columns are plain lists with a moving start offset so
+    range lookups can bisect them; the dropped prefix is deleted in
+    chunks to keep trimming amortized O(1).
+    """
+
+    def __init__(self, resolution_s: int, capacity: int):
+        self.resolution_s = resolution_s
+        self.capacity = capacity
+        self.start = 0
+        self.trimmed = False  # True once the oldest buckets were dropped
+        self.buckets: list[int] = []
+        self.counts: list[int] = []
+        self.sums: list[float] = []
+        self.mins: list[float] = []
+        self.maxs: list[float] = []
+
+    def add(self, t: float, value: float):
+        bucket = int(t // self.resolution_s)
+        if len(self.buckets) > self.start and self.buckets[-1] == bucket:
+            self.counts[-1] += 1
+            self.sums[-1] += value
+            if value < self.mins[-1]:
+                self.mins[-1] = value
+            if value > self.maxs[-1]:
+                self.maxs[-1] = value
+            return
+        if len(self.buckets) > self.start and bucket < self.buckets[-1]:
+            return  # clock went backwards, keep the series ordered
+
+        self.buckets.append(bucket)
+        self.counts.append(1)
+        self.sums.append(value)
+        self.mins.append(value)
+        self.maxs.append(value)
+        if len(self.buckets) - self.start > self.capacity:
+            self.start += 1
+            self.trimmed = True
+            if self.start >= self.capacity:
+                for column in self._columns():
+                    del column[: self.start]
+                self.start = 0
+
+    def _columns(self):
+        return (self.buckets, self.counts, self.sums, self.mins, self.maxs)
+
+    def __len__(self):
+        return len(self.buckets) - self.start
+
+    def covers(self, t: float) -> bool:
+        return not self.trimmed or self.buckets[self.start] * self.resolution_s <= t
+
+    def _range(self, t_from: float, t_to: float) -> tuple[int, int]:
+        lo = bisect.bisect_left(
+            self.buckets, int(t_from // self.resolution_s), lo=self.start
+        )
+        hi = bisect.bisect_right(
+            self.buckets, int(t_to // self.resolution_s), lo=self.start
+        )
+        return lo, hi
+
+    def count(self, t_from: float, t_to: float) -> int:
+        lo, hi = self._range(t_from, t_to)
+        return hi - lo
+
+    def query(self, t_from: float, t_to: float) -> tuple[list, ...]:
+        """Bucket centres, means, mins and maxs in the range."""
+        lo, hi = self._range(t_from, t_to)
+        res = self.resolution_s
+        half = res / 2
+        return (
+            [bucket * res + half for bucket in self.buckets[lo:hi]],
+            [
+                total / count
+                for total, count in zip(self.sums[lo:hi], self.counts[lo:hi])
+            ],
+            self.mins[lo:hi],
+            self.maxs[lo:hi],
+        )
+
+
+class MetricHistory:
+    """Raw samples of the last RAW_RETENTION_S plus the rollup tiers."""
+
+    def __init__(self, raw_retention_s: float = RAW_RETENTION_S):
+        self.raw_retention_s = raw_retention_s
+        self.lock = threading.Lock()
+        self.raw: deque[tuple[float, float]] = deque()
+        self.raw_trimmed = False
+        self.tiers = [RollupTier(res, capacity) for res, capacity in ROLLUP_TIERS]
+
+    def add(self, t: float, value: float):
+        with self.lock:
+            raw = self.raw
+            raw.append((t, value))
+            limit = t - self.raw_retention_s
+            while raw[0][0] < limit:
+                raw.popleft()
+                self.raw_trimmed = True
+            for tier in self.tiers:
+                tier.add(t, value)
+
+    def query(
+        self, t_from: float, t_to: float, points: int
+    ) -> tuple[int, list, list, list, list]:
+        """
+        Picks the finest source that covers the range without having more
+        than MAX_SOURCE_FACTOR * points samples in it. Returns the source
+        resolution (0 for raw samples) and its times, values, mins and maxs.
+        """
+        budget = points * MAX_SOURCE_FACTOR
+        with self.lock:
+            raw = self.raw
+            if not self.raw_trimmed or (raw and raw[0][0] <= t_from):
+                samples = list(raw)
+                times = [t for t, _ in samples]
+                lo = bisect.bisect_left(times, t_from)
+                hi = bisect.bisect_right(times, t_to)
+                if hi - lo <= budget:
+                    values = [v for _, v in samples[lo:hi]]
+                    return 0, times[lo:hi], values, values, values
+
+            tier = self.tiers[-1]
+            for candidate in self.tiers:
+                if candidate.covers(t_from) and candidate.count(t_from, t_to) <= budget:
+                    tier = candidate
+                    break
+            return (tier.resolution_s, *tier.query(t_from, t_to))
+
+
+class HistoryStore:
+    """
+    History of all metrics, filled from the ingest path. The values before
+    the filter pipelines are kept separately (`raw`) to compare the two.
+    """
+
+    def __init__(self):
+        self._metrics = {key: MetricHistory() for key in MetricsKey}
+        self._raw = {key: MetricHistory() for key in MetricsKey}
+
+    def record(
+        self,
+        key: MetricsKey,
+        value: float,
+        t: Optional[float] = None,
+        raw: bool = False,
+    ):
+        series = self._raw if raw else self._metrics
+        series[key].add(time.time() if t is None else t, value)
+
+    def query(
+        self,
+        key: MetricsKey,
+        t_from: Optional[float] = None,
+        t_to: Optional[float] = None,
+        points: int = 500,
+        method: str = "lttb",
+        raw: bool = False,
+    ) -> dict:
+        # NumPy is only needed for queries, keep it out of the startup path
+        from app.downsample import lttb, min_max
+
+        t_to = time.time() if t_to is None else t_to
+        t_from = t_to - 1800 if t_from is None else t_from
+        history = self._raw if raw else self._metrics
+        resolution_s, times, values, mins, maxs = history[key].query(
+            t_from, t_to, points
+        )
+        if method == "minmax":
+            series = min_max(times, mins, maxs, points)
+        else:
+            series = lttb(times, values, points)
+        return {
+            "key": key,
+            "from_ts": t_from,
+            "to_ts": t_to,
+            "resolution_s": resolution_s,
+            "method": method,
+            "raw": raw,
+            "points": series.round(3).tolist(),
+        }
@@ -0,0 +1,87 @@
+"""
+Import time budget check, run with `python -m app.importtime`.
+
+Imports the service in a fresh interpreter with `-X importtime` and fails
+when the import takes longer than the budget or when one of the modules
+that must only be loaded on first use shows up.
+"""
+
+import argparse
+import subprocess
+import sys
+from typing import NamedTuple
+
+DEFAULT_MODULE = "app.api"
+DEFAULT_BUDGET_MS = 1000
+
+# loaded on the first /metrics/start or the first analytics query
+LAZY_MODULES = ("numpy", "openant", "usb")
+
+
+class ImportRecord(NamedTuple):
+    name: str
+    depth: int
+    self_us: int
+    cumulative_us: int
+
+
+def measure(module: str) -> list[ImportRecord]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr}")
+
+    records = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        if not self_us.strip().isdigit():
+            continue  # header line
+        depth = (len(name) - len(name.lstrip())) // 2
+        records.append(
+            ImportRecord(name.strip(), depth, int(self_us), int(cumulative_us))
+        )
+    return records
+
+
+def total_ms(records: list[ImportRecord]) -> float:
+    # top level imports include everything they pull in
+    return sum(r.cumulative_us for r in records if r.depth == 0) / 1000
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Import time budget check")
+    parser.add_argument("--module", default=DEFAULT_MODULE)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument(
+        "--runs", type=int, default=3, help="best of N runs, imports are noisy"
+    )
+    parser.add_argument("--top", type=int, default=10, help="slowest modules shown")
+    args = parser.parse_args(argv)
+
+    runs = [measure(args.module) for _ in range(max(args.runs, 1))]
+    records = min(runs, key=total_ms)
+    total = total_ms(records)
+
+    print(f"import {args.module}: {total:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    for record in sorted(records, key=lambda r: r.self_us, reverse=True)[: args.top]:
+        print(f"  {record.self_us / 1000:8.1f} ms  {record.name}")
+
+    failed = False
+    packages = {r.name.split(".")[0] for r in records}
+    eager = sorted(packages.intersection(LAZY_MODULES))
+    if eager:
+        print(f"FAIL: lazily loaded modules imported at startup: {', '.join(eager)}")
+        failed = True
+    if total > args.budget_ms:
+        print("FAIL: import time over budget")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+import threading
+import time
+from typing import Optional
+
+from app.util import MetricsKey
+from app.workout import Timer, TimerPosition
+
+
+class RunningStats:
+    """Average and maximum of a stream of values, O(1) per value."""
+
+    __slots__ = ("count", "sum", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def to_dict(self) -> dict:
+        return {
+            "avg": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "samples": self.count,
+        }
+
+
+class Lap:
+    """One interval of one round of the workout."""
+
+    def __init__(self, number: int, position: TimerPosition, name: Optional[str]):
+        self.number = number
+        self.round_number = position.round_number
+        self.interval_index = position.index
+        self.name = name
+        self.started_at = position.started_at
+        self.ended_at: Optional[float] = None
+        self.stats = {key: RunningStats() for key in MetricsKey}
+        self.distance = 0.0
+
+    def to_dict(self, now: Optional[float] = None) -> dict:
+        end = self.ended_at
+        if end is None:
+            end = time.time() if now is None else now
+        distance = self.stats[MetricsKey.DISTANCE]
+        return {
+            "number": self.number,
+            "round_number": self.round_number,
+            "interval_index": self.interval_index,
+            "name": self.name,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "duration_s": round(max(end - self.started_at, 0.0), 1),
+            "distance": round(self.distance, 1) if distance.count else None,
+            "metrics": {
+                key.value: stats.to_dict() for key, stats in self.stats.items()
+            },
+        }
+
+
+class LapTracker:
+    """
+    Splits the samples of a session into laps, one per workout interval
+    and round. Every sample asks the timer for its position, a new
+    position closes the current lap and opens the next one, so interval
+    transitions are detected on the server with the sample that crosses
+    them (or by `update` from the housekeeping loop when no data arrives).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.laps: list[Lap] = []
+        self.current: Optional[Lap] = None
+        self._last_distance: Optional[float] = None
+
+    def record(
+        self, timer: Optional[Timer], key: MetricsKey, value: float, t: float
+    ) -> Optional[Lap]:
+        """Adds a sample to its lap, returns the lap that was closed, if any."""
+        position = timer.position(t) if timer is not None else None
+        with self.lock:
+            closed = self._move(timer, position, t)
+            lap = self.current
+            if lap is not None:
+                lap.stats[key].add(value)
+            if key == MetricsKey.DISTANCE:
+                # the sensor reports the total, a drop means it was reset
+                last = self._last_distance
+                self._last_distance = value
+                if lap is not None and last is not None:
+                    step = value - last
+                    lap.distance += step if step >= 0 else value
+        return closed
+
+    def update(self, timer: Optional[Timer], t: float) -> Optional[Lap]:
+        position = timer.position(t) if timer is not None else None
+        with self.lock:
+            return self._move(timer, position, t)
+
+    def close(self, t: float) -> Optional[Lap]:
+        with self.lock:
+            return self._move(None, None, t)
+
+    def current_dict(self, now: Optional[float] = None) -> Optional[dict]:
+        lap = self.current
+        return lap.to_dict(now) if lap is not None else None
+
+    def to_list(self, now: Optional[float] = None) -> list[dict]:
+        with self.lock:
+            laps = list(self.laps)
+        return [lap.to_dict(now) for lap in laps]
+
+    def _move(
+        self, timer: Optional[Timer], position: Optional[TimerPosition], t: float
+    ) -> Optional[Lap]:
+        lap = self.current
+        if lap is not None and position is not None:
+            if (lap.round_number, lap.interval_index, lap.started_at) == position:
+                return None  # still in the same lap, the common case
+
+        closed = None
+        if lap is not None:
+            lap.ended_at = position.started_at if position is not None else t
+            closed = lap
+            self.current = None
+        if position is not None:
+            interval = timer.interval(position.index)
+            self.current = Lap(
+                len(self.laps) + 1, position, interval.name if interval else None
+            )
+            self.laps.append(self.current)
+        return closed
@@ -1,9 +1,11 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic import BaseModel, Field
 
+from app.util import MetricsKey
+
 
 class SportZone(str, Enum):
     """Defines sport zones based on heart rate percentage of HRmax.
@@ -34,10 +36,17 @@ class SportZone(str, Enum):
         Returns heart rate percentage of estimated HRmax.
         Returns None if inputs are invalid.
         """
+        return SportZone.percent_from_hrmax(SportZone.hrmax_from_age(age), heart_rate)
+
+    @staticmethod
+    def percent_from_hrmax(hrmax: float, heart_rate: float) -> float:
+        """
+        Returns heart rate percentage of a known HRmax.
+        Returns None if inputs are invalid.
+        """
         if heart_rate is None:
             return None
 
-        hrmax = SportZone.hrmax_from_age(age)
         if hrmax is None or hrmax <= 0:
             return None
 
@@ -84,6 +93,67 @@ class SportZone(str, Enum):
         return formatted_name, self.value
 
 
+class MetricsState(str, Enum):
+    """Lifecycle states of the ANT+ metrics collection.
+
+    idle -> starting -> scanning -> running -> stopping -> idle
+    Any active state may move to error, from where the node is restarted
+    with exponential backoff until it is stopped.
+    """
+
+    IDLE = "idle"
+    STARTING = "starting"  # opening the ANT+ USB adapter
+    SCANNING = "scanning"  # node is up, waiting for the first sensor data
+    RUNNING = "running"  # sensor data is being received
+    STOPPING = "stopping"  # node and channels are being closed
+    ERROR = "error"  # node failed or adapter unplugged, waiting to restart
+
+    def is_active(self) -> bool:
+        """Returns True while the collection is (trying to be) running."""
+        return self in (
+            MetricsState.STARTING,
+            MetricsState.SCANNING,
+            MetricsState.RUNNING,
+            MetricsState.ERROR,
+        )
+
+
+class FilterStepModel(BaseModel):
+    type: Literal["range", "median", "hampel", "ema", "rate_limit"]
+    min_value: Optional[float] = Field(None, description="range: lowest valid value")
+    max_value: Optional[float] = Field(None, description="range: highest valid value")
+    k: int = Field(5, ge=1, le=31, description="median/hampel: window size")
+    n_sigmas: float = Field(3.0, gt=0, description="hampel: outlier threshold")
+    min_deviation: float = Field(
+        0.0, ge=0, description="hampel: smallest deviation counted as outlier"
+    )
+    alpha: float = Field(0.3, gt=0, le=1, description="ema: smoothing factor")
+    max_rate: float = Field(
+        100.0, gt=0, description="rate_limit: max change per second"
+    )
+
+
+class RuleModel(BaseModel):
+    name: str = Field(..., min_length=1, max_length=64)
+    metric: MetricsKey
+    condition: Literal["above", "below", "silent"]
+    threshold: Optional[float] = Field(
+        None, description="above/below: limit, in percent when percent_of is set"
+    )
+    percent_of: Optional[Literal["hr_max", "ftp"]] = Field(
+        None, description="Threshold is a percentage of HRmax or FTP"
+    )
+    duration_s: float = Field(
+        0.0, ge=0, description="How long the condition must hold (silent: gap)"
+    )
+    interval: Optional[str] = Field(
+        None, description="Only evaluated during workout intervals with this name"
+    )
+    cooldown_s: float = Field(
+        30.0, ge=0, description="Minimum time between two events of this rule"
+    )
+
+
 class MetricsSettingsModel(BaseModel):
     speed_wheel_circumference_m: Optional[float] = Field(
         None, gt=0, description="Wheel circumference in meters (speed sensor)"
@@ -92,12 +162,115 @@ class MetricsSettingsModel(BaseModel):
         None, gt=0, description="Wheel circumference in meters (distance sensor)"
     )
     age: Optional[int] = Field(None, gt=0, description="User age in years")
+    rider: Optional[str] = Field(
+        None, max_length=64, description="Rider name, stored with the sessions"
+    )
+    ftp: Optional[int] = Field(
+        None, gt=0, description="Functional threshold power in watts"
+    )
+    hr_max: Optional[int] = Field(
+        None, gt=0, description="Maximum heart rate, estimated from age if not set"
+    )
+    version: Optional[int] = Field(
+        None,
+        description="Set by the service, send it back to reject concurrent changes",
+    )
+    filters: Optional[dict[MetricsKey, list[FilterStepModel]]] = Field(
+        None,
+        description="Filter pipeline per metric, metrics not listed use the defaults",
+    )
+    rules: Optional[list[RuleModel]] = Field(
+        None, description="Alert rules evaluated on the incoming samples"
+    )
+    virtual_speed: bool = Field(
+        False,
+        description="Speed and distance from power while no speed sensor sends data",
+    )
+    system_mass_kg: float = Field(
+        85.0, gt=0, description="Rider plus bike mass, virtual speed"
+    )
+    cda_m2: float = Field(0.32, gt=0, description="Drag area in m², virtual speed")
+    crr: float = Field(
+        0.004, ge=0, description="Rolling resistance coefficient, virtual speed"
+    )
+    grade_percent: float = Field(
+        0.0, ge=-25, le=25, description="Road grade in percent, virtual speed"
+    )
+
+    def effective_hr_max(self) -> Optional[float]:
+        if self.hr_max is not None:
+            return self.hr_max
+        return SportZone.hrmax_from_age(self.age)
 
 
 class SensorModel(BaseModel):
     device_id: int
     device_type: int
     name: str
+    node: Optional[int] = None
+
+    # telemetry
+    last_seen_age_s: Optional[float] = None
+    pages_per_second_10s: Optional[float] = None
+    pages_per_second_60s: Optional[float] = None
+    pages_total: Optional[int] = None
+    gaps: Optional[int] = None
+    longest_gap_s: Optional[float] = None
+    battery_status: Optional[str] = None
+    battery_voltage: Optional[float] = None
+    battery_percent: Optional[int] = None
+    rssi: Optional[int] = None
+    stale: Optional[bool] = None
+
+
+class PairedSensorModel(BaseModel):
+    device_id: int = Field(..., ge=0, le=0xFFFF, description="ANT+ device number")
+    device_type: int = Field(..., ge=0, le=0xFF, description="ANT+ device type")
+    trans_type: int = Field(
+        0, ge=0, le=0xFF, description="Transmission type (0 = wildcard)"
+    )
+
+
+class DeviceFilterModel(BaseModel):
+    allow_device_ids: list[int] = Field(
+        default_factory=list, description="Only open these devices (empty = all)"
+    )
+    deny_device_ids: list[int] = Field(
+        default_factory=list, description="Never open these devices"
+    )
+
+
+class ChannelDeviceModel(BaseModel):
+    node: int = 0
+    device_id: int
+    device_type: int
+    paired: bool
+    idle_seconds: float
+
+
+class ChannelUtilizationModel(BaseModel):
+    capacity: int
+    reserved: int
+    used: int
+    free: int
+    utilization: Optional[float] = None
+    rejected: int = 0
+    evicted: int = 0
+    devices: list[ChannelDeviceModel] = []
+
+
+class NodeStatsModel(BaseModel):
+    index: int
+    backend: str
+    state: MetricsState
+    state_message: Optional[str] = None
+    restarts: int = 0
+    pages_total: int = 0
+    pages_per_second: float = 0.0
+    last_page_age_s: Optional[float] = None
+    capacity: int
+    reserved: int
+    used: int
 
 
 class MetricsModel(BaseModel):
@@ -126,15 +299,138 @@ class MetricsModel(BaseModel):
     ma_zone_description: Optional[str] = None
 
     is_running: Optional[bool] = None
+    state: Optional[MetricsState] = None
+    state_message: Optional[str] = None
     last_sensor_update: Optional[datetime] = None
     last_sensor_name: Optional[str] = None
 
 
+class RawMetricsModel(BaseModel):
+    power: Optional[int] = None
+    speed: Optional[float] = None
+    cadence: Optional[float] = None
+    distance: Optional[float] = None
+    heart_rate: Optional[int] = None
+    dropped: dict[MetricsKey, int] = {}
+
+
+class HistoryModel(BaseModel):
+    key: MetricsKey
+    from_ts: float
+    to_ts: float
+    resolution_s: int = Field(description="Bucket size of the source, 0 for raw")
+    method: Literal["lttb", "minmax"]
+    raw: bool = Field(False, description="Values before the filter pipelines")
+    points: list[tuple[float, float]] = Field(
+        description="(unix timestamp, value) pairs"
+    )
+
+
+class SessionModel(BaseModel):
+    id: str
+    rider: Optional[str] = None
+    started_at: datetime
+    ended_at: Optional[datetime] = None
+    duration_s: float
+    samples: int
+    is_active: bool
+
+
+class MetricSummaryModel(BaseModel):
+    avg: Optional[float] = None
+    max: Optional[float] = None
+    seconds: int = 0
+
+
+class SessionSummaryModel(BaseModel):
+    session: SessionModel
+    ftp: Optional[int] = None
+    hr_max: Optional[float] = None
+
+    power: MetricSummaryModel
+    heart_rate: MetricSummaryModel
+    cadence: MetricSummaryModel
+    speed: MetricSummaryModel
+    distance_m: Optional[float] = None
+
+    normalized_power: Optional[float] = None
+    intensity_factor: Optional[float] = None
+    tss: Optional[float] = None
+    decoupling_percent: Optional[float] = None
+    hr_drift_percent: Optional[float] = None
+
+    hr_zones_s: dict[str, int] = {}
+    power_zones_s: dict[str, int] = {}
+
+
+class StoredSessionModel(BaseModel):
+    id: str
+    rider: Optional[str] = None
+    started_at: datetime
+    ended_at: Optional[datetime] = None
+    aggregates: dict[MetricsKey, MetricSummaryModel] = {}
+
+
+class StoredSampleModel(BaseModel):
+    ts: int
+    avg: float
+    min: float
+    max: float
+
+
+class BestEffortModel(BaseModel):
+    session_id: str
+    rider: Optional[str] = None
+    started_at: datetime
+    duration_s: int
+    value: float
+
+
+class TrendModel(BaseModel):
+    period: str
+    avg: Optional[float] = None
+    max: Optional[float] = None
+    sessions: int
+    seconds: int
+
+
+class EventModel(BaseModel):
+    seq: int
+    timestamp: datetime
+    rule: str
+    condition: str
+    # None for the stale/recovered events of a sensor, see device_id
+    metric: Optional[MetricsKey] = None
+    value: Optional[float] = None
+    threshold: Optional[float] = None
+    interval: Optional[str] = None
+    device_id: Optional[int] = None
+    message: str
+
+
 class IntervalModel(BaseModel):
     seconds: int
     name: str
 
 
+class LapMetricModel(BaseModel):
+    avg: Optional[float] = None
+    max: Optional[float] = None
+    samples: int = 0
+
+
+class LapModel(BaseModel):
+    number: int
+    round_number: int
+    interval_index: int
+    name: Optional[str] = None
+    started_at: datetime
+    ended_at: Optional[datetime] = None
+    duration_s: float
+    distance: Optional[float] = None
+    metrics: dict[MetricsKey, LapMetricModel] = {}
+
+
 class IntervalProgressModel(BaseModel):
     interval: Optional[IntervalModel] = None
     time_spent: Optional[float] = None
@@ -142,3 +438,4 @@ class IntervalProgressModel(BaseModel):
     total_time_spent: Optional[float] = None
     round_number: Optional[int] = None
     is_running: Optional[bool] = None
+    lap: Optional[LapModel] = None
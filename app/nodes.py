@@ -0,0 +1,660 @@
+import logging
+import math
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import TYPE_CHECKING, Callable, Optional
+
+from app.channels import ChannelAllocation, ChannelManager, DeviceKey
+from app.model import MetricsState
+from app.telemetry import DeviceTelemetry
+from app.util import RateCounter
+
+if TYPE_CHECKING:
+    from app.ant import Metrics
+
+
+# USB vendor/product ids of the ANTUSB2 and ANTUSB-m sticks
+ANT_USB_IDS = ((0x0FCF, 0x1008), (0x0FCF, 0x1009))
+
+_usb_open_lock = threading.Lock()
+
+# ANT+ device profile numbers, the values of openant's DeviceType
+POWER_METER = 11
+HEART_RATE = 120
+BIKE_SPEED_CADENCE = 121
+BIKE_CADENCE = 122
+BIKE_SPEED = 123
+
+# (device_id, device_type, trans_type) of the simulated sensors
+SIMULATED_SENSORS = [
+    (1001, POWER_METER, 5),
+    (1002, HEART_RATE, 1),
+    (1003, BIKE_CADENCE, 1),
+    (1004, BIKE_SPEED, 1),
+]
+
+_openant: Optional[SimpleNamespace] = None
+_openant_lock = threading.Lock()
+
+
+def load_openant() -> SimpleNamespace:
+    """
+    The openant classes used by the service, imported on first use. openant
+    pulls in pyusb and every device profile, which takes seconds on a Pi,
+    so this only happens once a node is opened.
+    """
+    global _openant
+    if _openant is None:
+        with _openant_lock:
+            if _openant is None:
+                from openant.devices import ANTPLUS_NETWORK_KEY
+                from openant.devices.bike_speed_cadence import (
+                    BikeCadenceData,
+                    BikeSpeedData,
+                )
+                from openant.devices.common import DeviceType
+                from openant.devices.heart_rate import HeartRateData
+                from openant.devices.power_meter import PowerData
+                from openant.devices.scanner import Scanner
+                from openant.devices.utilities import auto_create_device
+                from openant.easy.node import Node
+
+                _openant = SimpleNamespace(
+                    ANTPLUS_NETWORK_KEY=ANTPLUS_NETWORK_KEY,
+                    BikeCadenceData=BikeCadenceData,
+                    BikeSpeedData=BikeSpeedData,
+                    DeviceType=DeviceType,
+                    HeartRateData=HeartRateData,
+                    PowerData=PowerData,
+                    Scanner=Scanner,
+                    auto_create_device=auto_create_device,
+                    Node=Node,
+                )
+    return _openant
+
+
+def find_usb_adapters() -> list:
+    """All plugged in ANT+ USB sticks, in bus order."""
+    try:
+        import usb.core
+    except ImportError:
+        return []
+
+    adapters = []
+    for vendor, product in ANT_USB_IDS:
+        adapters.extend(
+            usb.core.find(find_all=True, idVendor=vendor, idProduct=product)
+        )
+    return sorted(adapters, key=lambda d: (d.bus, d.address))
+
+
+class NodeBackend:
+    """Opens nodes and creates scanners and devices on them."""
+
+    name = "base"
+
+    def open_node(self):
+        raise NotImplementedError
+
+    def max_channels(self, node) -> int:
+        return getattr(node, "max_channels", 8)
+
+    def create_scanner(self, node, on_found: Callable):
+        raise NotImplementedError
+
+    def create_device(self, node, device_id: int, device_type: int, trans_type: int):
+        raise NotImplementedError
+
+    def adapter_present(self, node) -> bool:
+        return True
+
+
+class AntUsbBackend(NodeBackend):
+    """openant node on the `adapter_index`-th ANT+ USB stick."""
+
+    name = "ant"
+
+    def __init__(self, adapter_index: int = 0):
+        self.adapter_index = adapter_index
+
+    def open_node(self):
+        ant = load_openant()
+        if self.adapter_index == 0:
+            node = ant.Node()
+        else:
+            node = self._open_indexed_node()
+        node.set_network_key(0x00, ant.ANTPLUS_NETWORK_KEY)
+        return node
+
+    def _open_indexed_node(self):
+        import usb.core
+
+        adapters = find_usb_adapters()
+        if len(adapters) <= self.adapter_index:
+            raise RuntimeError(f"ANT+ USB adapter #{self.adapter_index} not found")
+        adapter = adapters[self.adapter_index]
+
+        # openant always opens the first stick it finds, so route its
+        # single device lookup to the adapter of this backend
+        with _usb_open_lock:
+            find = usb.core.find
+
+            def find_adapter(*args, **kwargs):
+                if kwargs.get("find_all"):
+                    return find(*args, **kwargs)
+                if (kwargs.get("idVendor"), kwargs.get("idProduct")) == (
+                    adapter.idVendor,
+                    adapter.idProduct,
+                ):
+                    return adapter
+                return None
+
+            usb.core.find = find_adapter
+            try:
+                return load_openant().Node()
+            finally:
+                usb.core.find = find
+
+    def create_scanner(self, node, on_found: Callable):
+        scanner = load_openant().Scanner(node, device_id=0, device_type=0)
+        scanner.on_found = on_found
+        return scanner
+
+    def create_device(self, node, device_id: int, device_type: int, trans_type: int):
+        return load_openant().auto_create_device(
+            node, device_id, device_type, trans_type
+        )
+
+    def adapter_present(self, node) -> bool:
+        """Checks whether the USB stick used by the node is still plugged in."""
+        driver = getattr(getattr(node, "ant", None), "_driver", None)
+        dev = getattr(driver, "dev", None)
+        if dev is None:
+            # serial drivers can't be probed
+            return True
+        try:
+            return any(
+                (a.bus, a.address) == (dev.bus, dev.address)
+                for a in find_usb_adapters()
+            )
+        except Exception:
+            # don't tear down a working node because the bus could not be probed
+            return True
+
+
+class SimulatedDevice:
+    def __init__(self, node: "SimulatedNode", device_id: int, device_type: int):
+        self.node = node
+        self.device_id = device_id
+        self.device_type = device_type
+        self.name = f"sim_{load_openant().DeviceType(device_type).name.lower()}"
+        self._revolutions = 0.0
+        # (event time, cumulative count) of the last completed revolution
+        self._last_event: Optional[tuple[float, int]] = None
+
+    @staticmethod
+    def on_device_data(page: int, page_name: str, data):
+        pass
+
+    def close_channel(self):
+        self.node.remove_device(self)
+
+    def _revolution_event(self, per_second: float, now: float) -> tuple[list, list]:
+        """
+        Advances the wheel or crank by one page interval and returns the
+        (event times, revolution counts) pairs of the previous and the
+        current page, like a sensor that reports the time of the last
+        completed revolution.
+        """
+        self._revolutions += per_second * self.node.page_interval_s
+        count = int(self._revolutions)
+        previous = self._last_event
+        if previous is None or count > previous[1]:
+            # when the last whole revolution was completed
+            event_time = now - (self._revolutions - count) / per_second
+            self._last_event = (event_time, count)
+        if previous is None:
+            previous = self._last_event
+        return [previous[0], self._last_event[0]], [previous[1], self._last_event[1]]
+
+    def emit(self, now: float):
+        ant = load_openant()
+        phase = math.sin(now / 10 + self.device_id)
+        device_type = self.device_type
+        if device_type == POWER_METER:
+            self.on_device_data(
+                16, "power", ant.PowerData(instantaneous_power=int(180 + 60 * phase))
+            )
+        elif device_type == HEART_RATE:
+            self.on_device_data(
+                4, "heart_rate", ant.HeartRateData(heart_rate=int(130 + 20 * phase))
+            )
+        elif device_type == BIKE_CADENCE:
+            event_time, revolutions = self._revolution_event(
+                (85 + 10 * phase) / 60, now
+            )
+            self.on_device_data(
+                0,
+                "cadence",
+                ant.BikeCadenceData(
+                    bike_cadence_event_time=event_time,
+                    cumulative_cadence_revolution=revolutions,
+                ),
+            )
+        elif device_type in (BIKE_SPEED, BIKE_SPEED_CADENCE):
+            event_time, revolutions = self._revolution_event(4 + phase, now)
+            self.on_device_data(
+                0,
+                "speed",
+                ant.BikeSpeedData(
+                    bike_speed_event_time=event_time,
+                    cumulative_speed_revolution=revolutions,
+                ),
+            )
+
+
+class SimulatedScanner:
+    def __init__(self, on_found: Callable):
+        self.on_found = on_found
+        self.found = set()
+
+
+class SimulatedNode:
+    """
+    Stand-in for an openant Node: `start` blocks and sends one data page
+    per open device every `page_interval_s`, the scanner reports the
+    simulated sensors that have not been found yet.
+    """
+
+    def __init__(
+        self,
+        sensors: list[tuple[int, int, int]],
+        max_channels: int,
+        page_interval_s: float,
+    ):
+        self.sensors = sensors
+        self.max_channels = max_channels
+        self.page_interval_s = page_interval_s
+        self.scanner: Optional[SimulatedScanner] = None
+        self.devices: list[SimulatedDevice] = []
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def remove_device(self, device: SimulatedDevice):
+        with self.lock:
+            if device in self.devices:
+                self.devices.remove(device)
+
+    def start(self):
+        while not self._stopped.is_set():
+            now = time.time()
+            scanner = self.scanner
+            if scanner is not None:
+                for sensor in self.sensors:
+                    if sensor not in scanner.found:
+                        scanner.found.add(sensor)
+                        scanner.on_found(sensor)
+            with self.lock:
+                devices = list(self.devices)
+            for device in devices:
+                device.emit(now)
+            self._stopped.wait(self.page_interval_s)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class SimulatedBackend(NodeBackend):
+    """Fake sensors for tests and demos without an ANT+ USB stick."""
+
+    name = "simulated"
+
+    def __init__(
+        self,
+        sensors: list[tuple[int, int, int]],
+        max_channels: int = 8,
+        page_interval_s: float = 0.25,
+    ):
+        self.sensors = sensors
+        self.max_channels_per_node = max_channels
+        self.page_interval_s = page_interval_s
+
+    def open_node(self):
+        return SimulatedNode(
+            self.sensors, self.max_channels_per_node, self.page_interval_s
+        )
+
+    def create_scanner(self, node: SimulatedNode, on_found: Callable):
+        node.scanner = SimulatedScanner(on_found)
+        return node.scanner
+
+    def create_device(
+        self, node: SimulatedNode, device_id: int, device_type: int, trans_type: int
+    ):
+        device = SimulatedDevice(node, device_id, device_type)
+        with node.lock:
+            node.devices.append(device)
+        return device
+
+
+def backend_factory_from_env() -> Callable[[int], NodeBackend]:
+    """
+    ANT_BACKEND=simulated runs without USB sticks, otherwise every node
+    opens the ANT+ stick with its index.
+    """
+    if os.getenv("ANT_BACKEND", "ant") == "simulated":
+        return lambda index: SimulatedBackend(SIMULATED_SENSORS)
+    return AntUsbBackend
+
+
+class NodeWorker:
+    """
+    One ANT+ node: its supervisor thread, channel budget and throughput.
+
+    The supervisor opens the node, runs its blocking reader loop in a
+    separate thread and watches adapter presence. On failure or unplug the
+    node is released and reopened with exponential backoff, which also
+    picks the stick up again once it is replugged. Device data pages are
+    handed to the owning `Metrics` which merges all nodes.
+    """
+
+    def __init__(
+        self,
+        index: int,
+        backend: NodeBackend,
+        metrics: "Metrics",
+        max_channels: int = 8,
+        idle_timeout_s: float = 30.0,
+        backoff_initial_s: float = 0.5,
+        backoff_max_s: float = 30.0,
+        adapter_poll_s: float = 2.0,
+    ):
+        self.logger = logging.getLogger(f"app.metrics.node{index}")
+        self.index = index
+        self.backend = backend
+        self.metrics = metrics
+
+        self.lock = threading.Lock()
+        self.node = None
+        self.scanner = None
+        self.thread: Optional[threading.Thread] = None
+        self.max_channels = max_channels
+        self.channels = ChannelManager(max_channels, idle_timeout_s)
+
+        self.state = MetricsState.IDLE
+        self.state_message: Optional[str] = None
+        self.restarts = 0
+        self.pages = RateCounter(window_s=10)
+        self.last_page: Optional[float] = None
+
+        self.backoff_initial_s = backoff_initial_s
+        self.backoff_max_s = backoff_max_s
+        self.adapter_poll_s = adapter_poll_s
+        self.node_join_timeout_s = 2.0
+
+    def start(self, stop_event: threading.Event):
+        self.thread = threading.Thread(
+            target=self._run_node,
+            args=(stop_event,),
+            name=f"ant-node{self.index}-supervisor",
+            daemon=True,
+        )
+        self.thread.start()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        thread = self.thread
+        if thread is None:
+            return True
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def is_alive(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def is_ready(self) -> bool:
+        return self.node is not None and self.state in (
+            MetricsState.SCANNING,
+            MetricsState.RUNNING,
+        )
+
+    def load(self) -> float:
+        """Share of the usable channels that are allocated."""
+        usable = self.channels.capacity - self.channels.reserved
+        if usable <= 0:
+            return math.inf
+        return len(self.channels.allocations()) / usable
+
+    def stats(self) -> dict:
+        now = time.time()
+        utilization = self.channels.utilization()
+        return {
+            "index": self.index,
+            "backend": self.backend.name,
+            "state": self.state,
+            "state_message": self.state_message,
+            "restarts": self.restarts,
+            "pages_total": self.pages.total,
+            "pages_per_second": self.pages.rate(now),
+            "last_page_age_s": (
+                now - self.last_page if self.last_page is not None else None
+            ),
+            "capacity": utilization["capacity"],
+            "reserved": utilization["reserved"],
+            "used": utilization["used"],
+        }
+
+    # ---- devices ----
+
+    def start_scanner(self):
+        node = self.node
+        if node is None or self.scanner is not None:
+            return
+        self.scanner = self.backend.create_scanner(node, self._on_found)
+        self.channels.reserved = 1
+
+    def _on_found(self, device_tuple):
+        self.metrics._scanner_on_found(device_tuple)
+
+    def open_device(
+        self,
+        key: DeviceKey,
+        trans_type: int,
+        evicted: Optional[ChannelAllocation] = None,
+    ):
+        """Open the channel for an allocation made on this node's manager."""
+        if evicted is not None:
+            self.logger.info("Evicting device %s to free a channel", evicted.key)
+            self.close_allocation(evicted)
+
+        device_id, device_type = key
+        try:
+            self.logger.info(
+                "Creating new device with device_id: %s, device_type: %s",
+                device_id,
+                device_type,
+            )
+            dev = self.backend.create_device(
+                self.node, device_id, device_type, trans_type
+            )
+            telemetry = self.metrics.telemetry.device(key, dev.name)
+            dev.on_device_data = lambda page, page_name, data: self._on_device_data(
+                page, page_name, data, key, telemetry
+            )
+            dev.on_battery = telemetry.on_battery
+            dev.on_update = telemetry.on_raw
+            self.channels.attach(key, dev)
+        except Exception:
+            self.channels.release(key)
+            self.logger.warning("Could not auto create device", exc_info=True)
+
+    def close_device(self, key: DeviceKey) -> bool:
+        allocation = self.channels.release(key)
+        if allocation is None:
+            return False
+        self.close_allocation(allocation)
+        return True
+
+    def close_allocation(self, allocation: ChannelAllocation):
+        self.metrics._on_device_closed(allocation)
+
+        if allocation.device is None:
+            return
+        try:
+            self.logger.debug(
+                "Closing channel for device_id: %s, device_type: %s",
+                *allocation.key,
+            )
+            allocation.device.close_channel()
+        except Exception:
+            self.logger.warning("Could not close device channel", exc_info=True)
+
+    def forget_found(self, allocation: ChannelAllocation):
+        # let the scanner report the device again
+        scanner = self.scanner
+        if scanner is not None:
+            scanner.found.discard((*allocation.key, allocation.trans_type))
+
+    def _close_idle_devices(self):
+        for allocation in self.channels.idle():
+            self.logger.info(
+                "Closing channel of silent device_id: %s, device_type: %s",
+                *allocation.key,
+            )
+            self.channels.release(allocation.key)
+            self.close_allocation(allocation)
+
+    def _on_device_data(
+        self,
+        page: int,
+        page_name: str,
+        data,
+        key: DeviceKey,
+        telemetry: DeviceTelemetry,
+    ):
+        now = time.time()
+        self.last_page = now
+        self.pages.add(now)
+        self.channels.touch(key)
+        telemetry.on_page(now)
+
+        if self.state == MetricsState.SCANNING:
+            with self.lock:
+                if self.state == MetricsState.SCANNING:
+                    self._set_state(MetricsState.RUNNING, "Receiving sensor data")
+
+        self.metrics._on_device_data(page, page_name, data, key)
+
+    # ---- supervision ----
+
+    def _set_state(self, state: MetricsState, message: Optional[str] = None):
+        # caller must hold self.lock
+        if state != self.state:
+            self.logger.info("Node state %s -> %s", self.state.value, state.value)
+        self.state = state
+        self.state_message = message
+
+    def _open_node(self):
+        node = self.backend.open_node()
+        try:
+            self.channels.capacity = min(
+                self.max_channels, self.backend.max_channels(node)
+            )
+            with self.lock:
+                self.node = node
+        except Exception:
+            self.logger.warning("Error initializing ANT+ node", exc_info=True)
+            self._release_node(node, None)
+            raise
+        return node
+
+    def _release_node(self, node, reader: Optional[threading.Thread]):
+        with self.lock:
+            if self.node is node:
+                self.node = None
+
+        if node is None:
+            return
+
+        for allocation in self.channels.release_all():
+            self.close_allocation(allocation)
+        self.scanner = None
+
+        try:
+            self.logger.debug("Stopping ANT+ node")
+            node.stop()
+        except Exception:
+            self.logger.warning("Error stopping ANT+ node", exc_info=True)
+
+        if reader is not None and reader.is_alive():
+            reader.join(timeout=self.node_join_timeout_s)
+
+        self.metrics._on_node_released(self)
+
+    def _backoff_delay(self, retries: int) -> float:
+        return min(
+            self.backoff_max_s, self.backoff_initial_s * (2 ** max(retries - 1, 0))
+        )
+
+    def _run_node(self, stop_event: threading.Event):
+        retries = 0
+        while not stop_event.is_set():
+            node = None
+            reader = None
+            delay = 0.0
+            try:
+                with self.lock:
+                    if stop_event.is_set():
+                        break
+                    self._set_state(MetricsState.STARTING, "Opening ANT+ adapter")
+
+                self.logger.debug("Starting ANT+ node")
+                node = self._open_node()
+                reader = threading.Thread(
+                    target=node.start, name=f"ant-node{self.index}-reader", daemon=True
+                )
+                reader.start()
+
+                with self.lock:
+                    if not stop_event.is_set():
+                        self._set_state(
+                            MetricsState.SCANNING, "Searching for ANT+ sensors"
+                        )
+                self.metrics._on_node_ready(self)
+                retries = 0
+
+                while not stop_event.wait(self.adapter_poll_s):
+                    if not reader.is_alive():
+                        raise RuntimeError("ANT+ node stopped unexpectedly")
+                    if not self.backend.adapter_present(node):
+                        raise RuntimeError("ANT+ USB adapter disconnected")
+                    self._close_idle_devices()
+                    self.metrics._housekeeping()
+
+                self.logger.debug("Ant+ Node stop requested")
+            except Exception as e:
+                retries += 1
+                self.restarts += 1
+                delay = self._backoff_delay(retries)
+                self.logger.warning(
+                    "Node error, try node restart in %.1fs (retry=%s)",
+                    delay,
+                    retries,
+                    exc_info=True,
+                )
+                with self.lock:
+                    if not stop_event.is_set():
+                        self._set_state(
+                            MetricsState.ERROR,
+                            f"{e} (retry {retries} in {delay:.1f}s)",
+                        )
+            finally:
+                self._release_node(node, reader)
+
+            if delay > 0:
+                stop_event.wait(delay)
+
+        with self.lock:
+            self._set_state(MetricsState.IDLE)
+        self.metrics._on_node_stopped(self)
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+
+class PairedDevice(NamedTuple):
+    device_id: int
+    device_type: int
+    trans_type: int = 0  # 0 is the ANT+ wildcard transmission type
+
+
+class PairingCache:
+    """
+    Known sensors plus allow/deny lists of device ids, persisted as JSON.
+
+    Lookups use sets/dicts so they are cheap enough to run on every scanner
+    callback. Without a path the cache only lives in memory.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.logger = logging.getLogger("app.pairing")
+        self.path = Path(path) if path else None
+        self.lock = threading.Lock()
+        self._devices: dict[tuple[int, int], PairedDevice] = {}
+        self._allow: frozenset[int] = frozenset()
+        self._deny: frozenset[int] = frozenset()
+        self.load()
+
+    def load(self):
+        if self.path is None or not self.path.is_file():
+            return
+        try:
+            with open(self.path, "r") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            self.logger.warning("Could not read pairing cache %s", self.path)
+            return
+
+        with self.lock:
+            self._devices = {}
+            for entry in data.get("devices", []):
+                dev = PairedDevice(
+                    int(entry["device_id"]),
+                    int(entry["device_type"]),
+                    int(entry.get("trans_type", 0)),
+                )
+                self._devices[(dev.device_id, dev.device_type)] = dev
+            self._allow = frozenset(int(i) for i in data.get("allow_device_ids", []))
+            self._deny = frozenset(int(i) for i in data.get("deny_device_ids", []))
+        self.logger.info(
+            "Loaded %s paired devices from %s", len(self._devices), self.path
+        )
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            data = {
+                "devices": [dev._asdict() for dev in self._devices.values()],
+                "allow_device_ids": sorted(self._allow),
+                "deny_device_ids": sorted(self._deny),
+            }
+        # write to a temp file and swap so a crash never leaves half a file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(data, fh, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def pair(self, device_id: int, device_type: int, trans_type: int = 0):
+        dev = PairedDevice(device_id, device_type, trans_type)
+        with self.lock:
+            self._devices[(device_id, device_type)] = dev
+            # pairing wins over an earlier deny
+            self._deny = self._deny - {device_id}
+        self.save()
+        return dev
+
+    def unpair(self, device_id: int) -> list[PairedDevice]:
+        with self.lock:
+            removed = [d for d in self._devices.values() if d.device_id == device_id]
+            for dev in removed:
+                del self._devices[(dev.device_id, dev.device_type)]
+        if removed:
+            self.save()
+        return removed
+
+    def devices(self) -> list[PairedDevice]:
+        with self.lock:
+            return list(self._devices.values())
+
+    def is_paired(self, device_id: int, device_type: int) -> bool:
+        return (device_id, device_type) in self._devices
+
+    def set_filter(self, allow: Iterable[int], deny: Iterable[int]):
+        with self.lock:
+            self._allow = frozenset(allow)
+            self._deny = frozenset(deny)
+        self.save()
+
+    @property
+    def allow_device_ids(self) -> frozenset[int]:
+        return self._allow
+
+    @property
+    def deny_device_ids(self) -> frozenset[int]:
+        return self._deny
+
+    def accepts(self, device_id: int, device_type: int) -> bool:
+        """
+        Deny always wins. Otherwise paired devices are accepted, and all
+        other devices only if there is no allow list or they are on it.
+        """
+        if device_id in self._deny:
+            return False
+        if (device_id, device_type) in self._devices:
+            return True
+        return not self._allow or device_id in self._allow
+
+    def needs_scan(self) -> bool:
+        """
+        A full scan can be skipped when an allow list is set and every
+        allowed device is already paired (and so opened directly).
+        """
+        if not self._allow:
+            return True
+        paired_ids = {dev.device_id for dev in self._devices.values()}
+        return not self._allow <= paired_ids
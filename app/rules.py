@@ -0,0 +1,349 @@
+import bisect
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+from app.model import RuleModel
+from app.settings import SettingsSnapshot
+from app.util import MetricsKey
+
+
+class CompiledRule:
+    """A rule with its absolute threshold and its evaluation state."""
+
+    __slots__ = (
+        "model",
+        "threshold",
+        "description",
+        "active_since",
+        "token",
+        "fired",
+        "last_event",
+    )
+
+    def __init__(self, model: RuleModel, threshold: Optional[float], description: str):
+        self.model = model
+        self.threshold = threshold
+        self.description = description
+        self.active_since: Optional[float] = None  # condition holds since
+        self.token = 0  # bumped when the condition clears, invalidates the heap entry
+        self.fired = False  # already reported for the current period
+        self.last_event: Optional[float] = None
+
+    def clear(self):
+        self.active_since = None
+        self.token += 1
+        self.fired = False
+
+
+def compile_rule(
+    model: RuleModel, settings: SettingsSnapshot
+) -> Optional[CompiledRule]:
+    """Resolves percentages against the settings, None if that isn't possible."""
+    if model.condition == "silent":
+        return CompiledRule(
+            model, None, f"no {model.metric.value} data for {model.duration_s:g} s"
+        )
+    if model.threshold is None:
+        return None
+
+    threshold = model.threshold
+    limit = f"{threshold:g}"
+    if model.percent_of is not None:
+        base = settings.hr_max if model.percent_of == "hr_max" else settings.ftp
+        if not base:
+            return None
+        threshold = threshold * base / 100
+        limit = f"{model.threshold:g}% of {model.percent_of} ({threshold:.0f})"
+
+    description = f"{model.metric.value} {model.condition} {limit}"
+    if model.duration_s > 0:
+        description += f" for {model.duration_s:g} s"
+    if model.interval is not None:
+        description += f" during {model.interval}"
+    return CompiledRule(model, threshold, description)
+
+
+class _ThresholdIndex:
+    """
+    The rules of one metric and direction, sorted by threshold. The rules
+    whose condition holds are always a prefix (above) or a suffix (below)
+    of that list, so a new value costs one bisect and only touches the
+    rules between the old and the new position.
+    """
+
+    def __init__(self, rules: list[CompiledRule], above: bool):
+        self.above = above
+        self.rules = sorted(rules, key=lambda r: r.threshold)
+        self.thresholds = [r.threshold for r in self.rules]
+        self.reset()
+
+    def reset(self):
+        self.position = 0 if self.above else len(self.rules)
+
+    def holding(self) -> list[CompiledRule]:
+        if self.above:
+            return self.rules[: self.position]
+        return self.rules[self.position :]
+
+    def update(self, value: float) -> tuple[list, list]:
+        """Returns the rules that started and stopped to hold."""
+        old = self.position
+        if self.above:
+            # value > threshold holds for all thresholds left of the position
+            self.position = bisect.bisect_left(self.thresholds, value)
+            if self.position > old:
+                return self.rules[old : self.position], []
+            return [], self.rules[self.position : old]
+
+        # value < threshold holds for all thresholds right of the position
+        self.position = bisect.bisect_right(self.thresholds, value)
+        if self.position < old:
+            return self.rules[self.position : old], []
+        return [], self.rules[old : self.position]
+
+
+class TokenBucket:
+    """Allows bursts of `burst` events, refilled with `rate_per_s`."""
+
+    def __init__(self, rate_per_s: float = 1.0, burst: int = 5):
+        self.rate_per_s = rate_per_s
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated: Optional[float] = None
+
+    def allow(self, now: float) -> bool:
+        if self.updated is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate_per_s
+            )
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class EventFeed:
+    """The last `maxlen` events, numbered so readers can ask for newer ones."""
+
+    def __init__(self, maxlen: int = 200):
+        self.lock = threading.Lock()
+        self._events: deque[dict] = deque(maxlen=maxlen)
+        self.last_seq = 0
+
+    def publish(self, event: dict) -> dict:
+        with self.lock:
+            self.last_seq += 1
+            event["seq"] = self.last_seq
+            self._events.append(event)
+        return event
+
+    def since(self, seq: int = 0) -> list[dict]:
+        if seq >= self.last_seq:
+            return []  # the common case for a polling reader, no lock needed
+        with self.lock:
+            return [event for event in self._events if event["seq"] > seq]
+
+
+class RuleEngine:
+    """
+    Evaluates the configured rules on every filtered sample.
+
+    Rules are compiled once per settings version into sorted threshold
+    indexes per (interval name, metric). A sample only looks at the index
+    of its metric for the rules without interval and the ones of the
+    current interval, so its cost is a bisect plus the rules that change
+    state, not the number of configured rules. Rules with a duration wait
+    in a heap ordered by their deadline. Silent sensor rules are checked
+    from the housekeeping loop. Events go through a per rule cooldown and
+    a global token bucket so a flapping value can't flood the clients.
+    """
+
+    def __init__(self, feed: EventFeed, limiter: Optional[TokenBucket] = None):
+        self.logger = logging.getLogger("app.rules")
+        self.lock = threading.Lock()
+        self.feed = feed
+        self.limiter = limiter if limiter is not None else TokenBucket()
+        self.suppressed = 0
+        self.interval: Optional[str] = None
+        self._partitions: dict[
+            Optional[str], dict[MetricsKey, list[_ThresholdIndex]]
+        ] = {}
+        self._silent: list[CompiledRule] = []
+        self._rule_count = 0
+        self._pending: list[tuple[float, int, int, CompiledRule]] = []
+        self._order = itertools.count()
+        self._last_value: dict[MetricsKey, float] = {}
+        self._last_seen: dict[MetricsKey, float] = {}
+        self._started: Optional[float] = None
+
+    def compile(self, settings: SettingsSnapshot):
+        grouped: dict[tuple[Optional[str], MetricsKey, bool], list[CompiledRule]] = {}
+        silent = []
+        for model in settings.model.rules or []:
+            rule = compile_rule(model, settings)
+            if rule is None:
+                self.logger.warning(
+                    "Rule %r skipped, threshold or its base value is missing",
+                    model.name,
+                )
+            elif model.condition == "silent":
+                silent.append(rule)
+            else:
+                key = (model.interval, model.metric, model.condition == "above")
+                grouped.setdefault(key, []).append(rule)
+
+        partitions: dict[Optional[str], dict[MetricsKey, list[_ThresholdIndex]]] = {}
+        for (interval, metric, above), rules in grouped.items():
+            partitions.setdefault(interval, {}).setdefault(metric, []).append(
+                _ThresholdIndex(rules, above)
+            )
+
+        with self.lock:
+            self._partitions = partitions
+            self._silent = silent
+            self._rule_count = len(silent) + sum(len(r) for r in grouped.values())
+            self._pending = []
+            # the new indexes start empty, catch up with the last values
+            if self._started is not None:
+                now = time.monotonic()
+                for interval in {None, self.interval}:
+                    self._replay(interval, now)
+        self.logger.info("Compiled %s rules", self._rule_count)
+
+    def reset(self, now: float):
+        """Forget all state, called when a new run starts."""
+        with self.lock:
+            for partition in self._partitions.values():
+                for indexes in partition.values():
+                    for index in indexes:
+                        index.reset()
+                        for rule in index.rules:
+                            rule.clear()
+                            rule.last_event = None
+            for rule in self._silent:
+                rule.clear()
+                rule.last_event = None
+            self._pending = []
+            self._last_value.clear()
+            self._last_seen.clear()
+            self.interval = None
+            self._started = now
+
+    def set_interval(self, name: Optional[str], now: float):
+        """Switches the interval specific rules to the ones of `name`."""
+        if name == self.interval:
+            return
+        with self.lock:
+            for indexes in self._partitions.get(self.interval, {}).values():
+                for index in indexes:
+                    for rule in index.holding():
+                        rule.clear()
+                    index.reset()
+            self.interval = name
+            self._replay(name, now)
+
+    def on_sample(self, key: MetricsKey, value: float, now: float):
+        with self.lock:
+            self._last_value[key] = value
+            self._last_seen[key] = now
+            self._apply(None, key, value, now)
+            if self.interval is not None:
+                self._apply(self.interval, key, value, now)
+            if self._pending and self._pending[0][0] <= now:
+                self._fire_due(now)
+
+    def check(self, now: float):
+        """Rules that fire without a new sample, called periodically."""
+        with self.lock:
+            if self._pending and self._pending[0][0] <= now:
+                self._fire_due(now)
+            for rule in self._silent:
+                model = rule.model
+                if model.interval is not None and model.interval != self.interval:
+                    continue
+                last_seen = self._last_seen.get(model.metric, self._started)
+                if last_seen is None:
+                    continue
+                gap = now - last_seen
+                if gap < model.duration_s:
+                    rule.fired = False
+                elif not rule.fired:
+                    self._fire(rule, now, value=round(gap, 1))
+
+    def _replay(self, interval: Optional[str], now: float):
+        for key in self._partitions.get(interval, {}):
+            value = self._last_value.get(key)
+            if value is not None:
+                self._apply(interval, key, value, now)
+
+    def _apply(
+        self, interval: Optional[str], key: MetricsKey, value: float, now: float
+    ):
+        partition = self._partitions.get(interval)
+        if not partition:
+            return
+        for index in partition.get(key, ()):
+            started, stopped = index.update(value)
+            for rule in stopped:
+                rule.clear()
+            for rule in started:
+                rule.active_since = now
+                if rule.model.duration_s <= 0:
+                    self._fire(rule, now, value)
+                else:
+                    heapq.heappush(
+                        self._pending,
+                        (
+                            now + rule.model.duration_s,
+                            next(self._order),
+                            rule.token,
+                            rule,
+                        ),
+                    )
+
+        # cleared rules leave their entries behind, drop them now and then
+        if len(self._pending) > 4 * self._rule_count + 64:
+            self._pending = [
+                entry
+                for entry in self._pending
+                if entry[2] == entry[3].token and entry[3].active_since is not None
+            ]
+            heapq.heapify(self._pending)
+
+    def _fire_due(self, now: float):
+        while self._pending and self._pending[0][0] <= now:
+            _, _, token, rule = heapq.heappop(self._pending)
+            if token == rule.token and rule.active_since is not None and not rule.fired:
+                self._fire(rule, now, self._last_value.get(rule.model.metric))
+
+    def _fire(self, rule: CompiledRule, now: float, value: Optional[float]):
+        # set even when suppressed, a holding condition is reported only once
+        rule.fired = True
+        model = rule.model
+        if rule.last_event is not None and now - rule.last_event < model.cooldown_s:
+            self.suppressed += 1
+            return
+        if not self.limiter.allow(now):
+            self.suppressed += 1
+            return
+        rule.last_event = now
+        self.feed.publish(
+            {
+                "timestamp": datetime.now().astimezone(),
+                "rule": model.name,
+                "condition": model.condition,
+                "metric": model.metric,
+                "value": value,
+                "threshold": rule.threshold,
+                "interval": self.interval,
+                "message": f"{model.name}: {rule.description}",
+            }
+        )
+        self.logger.info("Rule %r fired: %s", model.name, rule.description)
@@ -0,0 +1,106 @@
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from typing import Optional
+
+from app.laps import LapTracker
+from app.util import MetricsKey
+
+
+class Session:
+    """
+    Filtered samples of one metrics run. Every metric is kept as two
+    compact float arrays (timestamps and values) so a long ride stays
+    small and can be handed to NumPy without copying element by element.
+    """
+
+    def __init__(self, session_id: Optional[str] = None, rider: Optional[str] = None):
+        self.id = session_id or uuid.uuid4().hex[:12]
+        self.rider = rider
+        self.started_at = time.time()
+        self.ended_at: Optional[float] = None
+        self.lock = threading.Lock()
+        self.series: dict[MetricsKey, tuple[array, array]] = {
+            key: (array("d"), array("d")) for key in MetricsKey
+        }
+        # bumped on every sample, used to invalidate cached summaries
+        self.version = 0
+        self.laps = LapTracker()
+
+    def record(self, key: MetricsKey, value: float, t: Optional[float] = None):
+        if value is None:
+            return
+        t = time.time() if t is None else t
+        times, values = self.series[key]
+        with self.lock:
+            times.append(t)
+            values.append(value)
+            self.version += 1
+
+    def end(self):
+        if self.ended_at is None:
+            self.ended_at = time.time()
+
+    @property
+    def is_active(self) -> bool:
+        return self.ended_at is None
+
+    def duration(self) -> float:
+        end = self.ended_at if self.ended_at is not None else time.time()
+        return end - self.started_at
+
+    def samples(self) -> int:
+        return sum(len(times) for times, _ in self.series.values())
+
+    def snapshot(self, key: MetricsKey) -> tuple[array, array]:
+        """Copies of the timestamps and values recorded so far."""
+        times, values = self.series[key]
+        with self.lock:
+            return array("d", times), array("d", values)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "rider": self.rider,
+            "started_at": self.started_at,
+            "ended_at": self.ended_at,
+            "duration_s": round(self.duration(), 1),
+            "samples": self.samples(),
+            "is_active": self.is_active,
+        }
+
+
+class SessionStore:
+    """The last `max_sessions` sessions, oldest are dropped first."""
+
+    def __init__(self, max_sessions: int = 20):
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self.current: Optional[Session] = None
+
+    def start(self, rider: Optional[str] = None) -> Session:
+        session = Session(rider=rider)
+        with self.lock:
+            if self.current is not None:
+                self.current.end()
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+            self.current = session
+        return session
+
+    def end(self):
+        with self.lock:
+            if self.current is not None:
+                self.current.end()
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self.lock:
+            return self._sessions.get(session_id)
+
+    def list(self) -> list[Session]:
+        with self.lock:
+            return list(self._sessions.values())
@@ -0,0 +1,220 @@
+import bisect
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+from app.model import MetricsSettingsModel, SportZone
+from app.virtual import SpeedTable
+
+try:
+    import fcntl
+except ImportError:  # Windows, updates are only serialized within the process
+    fcntl = None
+
+# used until the first settings are saved
+DEFAULT_SETTINGS = MetricsSettingsModel(
+    age=45,
+    speed_wheel_circumference_m=0.141,
+    distance_wheel_circumference_m=0.141,
+)
+
+# lower bounds in % of HRmax of ZONE_1 .. ZONE_5, see SportZone.from_hr_percent
+_HR_ZONE_PERCENTS = (50, 60, 70, 80, 90)
+_HR_ZONES = (
+    SportZone.RESTING,
+    SportZone.ZONE_1,
+    SportZone.ZONE_2,
+    SportZone.ZONE_3,
+    SportZone.ZONE_4,
+    SportZone.ZONE_5,
+)
+
+
+class SettingsConflictError(ValueError):
+    """The settings were changed since the version the client has seen."""
+
+
+@dataclass(frozen=True)
+class SettingsSnapshot:
+    """
+    One version of the settings plus the values derived from it. Snapshots
+    are never modified, a change swaps in a new one, so a reader that
+    takes the reference once sees consistent values without a lock.
+    """
+
+    version: int
+    model: MetricsSettingsModel
+    hr_max: Optional[float]
+    hr_zone_bpm: tuple[float, ...]  # lower bounds of ZONE_1 .. ZONE_5
+    speed_wheel_circumference_m: Optional[float]
+    distance_wheel_circumference_m: Optional[float]
+    ftp: Optional[int]
+    speed_table: Optional[SpeedTable]  # None unless virtual speed is enabled
+
+    @classmethod
+    def build(cls, model: MetricsSettingsModel, version: int) -> "SettingsSnapshot":
+        model = model.model_copy(update={"version": version}, deep=True)
+        hr_max = model.effective_hr_max()
+        if hr_max is not None and hr_max <= 0:
+            hr_max = None
+        return cls(
+            version=version,
+            model=model,
+            hr_max=hr_max,
+            hr_zone_bpm=(
+                tuple(hr_max * p / 100 for p in _HR_ZONE_PERCENTS) if hr_max else ()
+            ),
+            speed_wheel_circumference_m=_positive(model.speed_wheel_circumference_m),
+            distance_wheel_circumference_m=_positive(
+                model.distance_wheel_circumference_m
+            ),
+            ftp=model.ftp,
+            speed_table=SpeedTable.from_settings(model),
+        )
+
+    def hr_percent(self, heart_rate: Optional[float]) -> Optional[float]:
+        if heart_rate is None or not self.hr_max:
+            return None
+        return heart_rate / self.hr_max * 100
+
+    def hr_zone(self, heart_rate: Optional[float]) -> SportZone:
+        """Same zones as SportZone.from_hr_percent, one bisect per call."""
+        if heart_rate is None or heart_rate < 0 or not self.hr_max:
+            return SportZone.UNKNOWN
+        if heart_rate > self.hr_max:
+            return SportZone.UNKNOWN
+        return _HR_ZONES[bisect.bisect_right(self.hr_zone_bpm, heart_rate)]
+
+
+def _positive(value: Optional[float]) -> Optional[float]:
+    return value if value is not None and value > 0 else None
+
+
+class SettingsStore:
+    """
+    Metrics settings persisted as JSON. Every update gets the next version
+    number and is written to a temp file that replaces the old one. The
+    file is re-read when it was changed by someone else (`reload_if_changed`).
+    Updates hold an exclusive lock on a `.lock` file next to it, so processes
+    sharing the file (the API workers of the multi-process mode) can't both
+    write the same version. Without a path the settings only live in memory.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        defaults: Optional[MetricsSettingsModel] = None,
+    ):
+        self.logger = logging.getLogger("app.settings")
+        self.path = Path(path) if path else None
+        self.lock = threading.Lock()
+        self._listeners: list[Callable[[SettingsSnapshot, SettingsSnapshot], None]] = []
+        self._mtime: Optional[float] = None
+        self.current = SettingsSnapshot.build(defaults or DEFAULT_SETTINGS, 0)
+        self.load()
+
+    def add_listener(
+        self, listener: Callable[[SettingsSnapshot, SettingsSnapshot], None]
+    ):
+        """`listener(old, new)` runs after every swap."""
+        self._listeners.append(listener)
+
+    def load(self) -> bool:
+        loaded = self._read()
+        if loaded is None:
+            return False
+        mtime, model, version = loaded
+        with self.lock:
+            self._mtime = mtime
+            self._swap(SettingsSnapshot.build(model, version))
+        self.logger.info("Loaded settings version %s from %s", version, self.path)
+        return True
+
+    def _read(self) -> Optional[tuple[float, MetricsSettingsModel, int]]:
+        if self.path is None or not self.path.is_file():
+            return None
+        try:
+            mtime = self.path.stat().st_mtime
+            with open(self.path, "r") as fh:
+                data = json.load(fh)
+            model = MetricsSettingsModel(**data.get("settings", {}))
+            version = int(data.get("version", 0))
+        except (OSError, ValueError):
+            self.logger.warning("Could not read settings %s", self.path, exc_info=True)
+            return None
+        return mtime, model, version
+
+    def reload_if_changed(self) -> bool:
+        if self.path is None:
+            return False
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            return False
+        if mtime == self._mtime:
+            return False
+        return self.load()
+
+    def update(
+        self, model: MetricsSettingsModel, expected_version: Optional[int] = None
+    ) -> SettingsSnapshot:
+        with self.lock, self._file_lock():
+            # another process may have saved a newer version meanwhile
+            loaded = self._read()
+            if loaded is not None and loaded[2] != self.current.version:
+                mtime, model_on_disk, version = loaded
+                self._mtime = mtime
+                self._swap(SettingsSnapshot.build(model_on_disk, version))
+
+            current = self.current
+            if expected_version is not None and expected_version != current.version:
+                raise SettingsConflictError(
+                    f"Settings version is {current.version}, not {expected_version}"
+                )
+            snapshot = SettingsSnapshot.build(model, current.version + 1)
+            self._save(snapshot)
+            self._swap(snapshot)
+        return snapshot
+
+    @contextmanager
+    def _file_lock(self):
+        if self.path is None or fcntl is None:
+            yield
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # not the settings file itself, os.replace swaps it for a new inode
+        with open(self.path.with_suffix(self.path.suffix + ".lock"), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _save(self, snapshot: SettingsSnapshot):
+        if self.path is None:
+            return
+        data = {
+            "version": snapshot.version,
+            "settings": snapshot.model.model_dump(mode="json", exclude={"version"}),
+        }
+        # write to a temp file and swap so a crash never leaves half a file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "w") as fh:
+            json.dump(data, fh, indent=2)
+        os.replace(tmp_path, self.path)
+        self._mtime = self.path.stat().st_mtime
+
+    def _swap(self, snapshot: SettingsSnapshot):
+        old = self.current
+        self.current = snapshot  # a single reference assignment, atomic for readers
+        for listener in self._listeners:
+            try:
+                listener(old, snapshot)
+            except Exception:
+                self.logger.warning("Settings listener failed", exc_info=True)
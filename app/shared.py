@@ -0,0 +1,550 @@
+"""
+Shared memory snapshot for the multi-process deployment.
+
+One collector process (`python -m app.collector`) owns the ANT+ nodes and
+publishes the latest state into a shared memory segment. Any number of
+API worker processes started with ANT_MODE=reader attach to it and serve
+the read endpoints from there, so the ANT+ parsing and the HTTP/JSON work
+no longer share a GIL and only one process opens the USB sticks.
+
+The segment is guarded by a sequence lock: the writer makes the sequence
+odd, writes and makes it even again. A reader copies what it needs and
+retries when the sequence was odd or changed meanwhile. Readers never
+block the writer and never see half a snapshot.
+
+Layout: header (magic, layout version, sequence, publish time), then one
+slot per JSON blob (length + bytes, serialized once by the collector and
+sent as-is by the workers), then two rings of (timestamp, value) doubles
+per metric holding the recent filtered and raw series.
+"""
+
+import json
+import logging
+import struct
+import time
+from array import array
+from collections import OrderedDict
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Optional
+
+from app.control import ControlClient
+from app.model import (
+    IntervalModel,
+    IntervalProgressModel,
+    MetricsModel,
+    MetricsSettingsModel,
+    MetricsState,
+)
+from app.pairing import PairedDevice
+from app.session import Session
+from app.settings import SettingsStore
+from app.store import SessionDatabase
+from app.util import MetricsKey
+from app.workout import WorkoutRunningError
+
+DEFAULT_NAME = "antplus-metrics"
+
+MAGIC = b"ANTM"
+LAYOUT_VERSION = 4
+_HEADER = struct.Struct("<4sIQd")  # magic, layout version, sequence, published at
+_SEQ_OFFSET = 8
+_SEQ = struct.Struct("<Q")
+_LENGTH = struct.Struct("<I")
+
+# capacity in bytes of the JSON blobs
+BLOBS = {
+    "metrics": 16 * 1024,
+    "raw": 4 * 1024,
+    "devices": 32 * 1024,
+    "events": 64 * 1024,
+    "lap": 8 * 1024,
+    "status": 32 * 1024,
+    "workout": 16 * 1024,
+}
+SERIES_LEN = 4096  # samples kept per metric, about 15 min at 4 Hz
+
+# the snapshot is considered gone when the collector stops publishing
+STALE_AFTER_S = 5.0
+
+
+# (metric, raw) of a series, raw for the values before the filter pipelines
+SeriesKey = tuple[MetricsKey, bool]
+SERIES = [(key, raw) for raw in (False, True) for key in MetricsKey]
+
+
+def _layout() -> tuple[dict[str, int], dict[SeriesKey, int], int]:
+    offset = _HEADER.size
+    blobs = {}
+    for name, capacity in BLOBS.items():
+        blobs[name] = offset
+        offset += _LENGTH.size + capacity
+    offset = (offset + 7) & ~7  # the series are read as doubles
+    series = {}
+    for series_key in SERIES:
+        series[series_key] = offset
+        offset += 8 + SERIES_LEN * 16  # written count + (t, value) pairs
+    return blobs, series, offset
+
+
+BLOB_OFFSETS, SERIES_OFFSETS, SEGMENT_SIZE = _layout()
+
+
+# like SessionStore.max_sessions of the collector
+MAX_SESSIONS = 20
+
+
+class CollectorUnavailableError(RuntimeError):
+    """The operation is only possible in the collector process."""
+
+
+class SharedSnapshotWriter:
+    """Publishes snapshots, used by the single collector process."""
+
+    def __init__(self, name: str = DEFAULT_NAME):
+        self.logger = logging.getLogger("app.shared")
+        try:
+            self.shm = SharedMemory(name=name, create=True, size=SEGMENT_SIZE)
+        except FileExistsError:
+            # left over from a collector that didn't shut down cleanly
+            stale = SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.shm = SharedMemory(name=name, create=True, size=SEGMENT_SIZE)
+        self.seq = 0
+        self._series = {
+            key: self.shm.buf[offset + 8 : offset + 8 + SERIES_LEN * 16].cast("d")
+            for key, offset in SERIES_OFFSETS.items()
+        }
+        self._written = {series_key: 0 for series_key in SERIES}
+        _HEADER.pack_into(self.shm.buf, 0, MAGIC, LAYOUT_VERSION, 0, 0.0)
+
+    def publish(
+        self,
+        blobs: dict[str, bytes],
+        samples: Optional[dict[SeriesKey, list[tuple[float, float]]]] = None,
+    ):
+        buf = self.shm.buf
+        self.seq += 1  # odd, readers retry
+        _SEQ.pack_into(buf, _SEQ_OFFSET, self.seq)
+
+        for name, data in blobs.items():
+            if len(data) > BLOBS[name]:
+                self.logger.warning(
+                    "Snapshot %s has %s bytes, more than %s, not updated",
+                    name,
+                    len(data),
+                    BLOBS[name],
+                )
+                continue
+            offset = BLOB_OFFSETS[name]
+            _LENGTH.pack_into(buf, offset, len(data))
+            start = offset + _LENGTH.size
+            buf[start : start + len(data)] = data
+
+        for key, pairs in (samples or {}).items():
+            view = self._series[key]
+            written = self._written[key]
+            for t, value in pairs[-SERIES_LEN:]:
+                index = (written % SERIES_LEN) * 2
+                view[index] = t
+                view[index + 1] = value
+                written += 1
+            self._written[key] = written
+            _SEQ.pack_into(buf, SERIES_OFFSETS[key], written)
+
+        self.seq += 1  # even again, the snapshot is complete
+        _HEADER.pack_into(buf, 0, MAGIC, LAYOUT_VERSION, self.seq, time.time())
+
+    def close(self):
+        for view in self._series.values():
+            view.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedSnapshotReader:
+    """
+    Consistent copies out of the segment. Attaching is retried on every
+    read until the collector has created the segment.
+    """
+
+    def __init__(self, name: str = DEFAULT_NAME, max_retries: int = 100):
+        self.logger = logging.getLogger("app.shared")
+        self.name = name
+        self.max_retries = max_retries
+        self.shm: Optional[SharedMemory] = None
+
+    def _attach(self) -> bool:
+        if self.shm is not None:
+            return True
+        try:
+            try:
+                shm = SharedMemory(name=self.name, track=False)
+            except TypeError:  # Python < 3.13 has no track argument
+                shm = SharedMemory(name=self.name)
+                # the resource tracker would remove the segment when we exit
+                resource_tracker.unregister(shm._name, "shared_memory")
+        except FileNotFoundError:
+            return False
+        magic, version, _, _ = _HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            shm.close()
+            raise RuntimeError(f"Shared memory {self.name} has an unknown layout")
+        self.shm = shm
+        self.logger.info("Attached to collector snapshot %s", self.name)
+        return True
+
+    def read(
+        self, blob_names: tuple[str, ...] = (), series: tuple[SeriesKey, ...] = ()
+    ) -> Optional[tuple[float, dict[str, bytes], dict[SeriesKey, array]]]:
+        """
+        (published at, blobs, series) of one snapshot, None while there is
+        no collector. The series are (t, value) pairs flattened, oldest first.
+        """
+        if not self._attach():
+            return None
+        buf = self.shm.buf
+        for attempt in range(self.max_retries):
+            seq = _SEQ.unpack_from(buf, _SEQ_OFFSET)[0]
+            if seq & 1:
+                time.sleep(0 if attempt < 10 else 0.001)
+                continue
+
+            blobs = {}
+            for name in blob_names:
+                offset = BLOB_OFFSETS[name]
+                length = min(_LENGTH.unpack_from(buf, offset)[0], BLOBS[name])
+                start = offset + _LENGTH.size
+                blobs[name] = bytes(buf[start : start + length])
+
+            pairs = {}
+            for key in series:
+                offset = SERIES_OFFSETS[key]
+                written = _SEQ.unpack_from(buf, offset)[0]
+                count = min(written, SERIES_LEN)
+                start = (written - count) % SERIES_LEN
+                values = array("d")
+                # the ring in the order it was written
+                for lo, hi in ((start, start + count), (0, start + count - SERIES_LEN)):
+                    hi = min(hi, SERIES_LEN)
+                    if hi > lo:
+                        values.frombytes(
+                            buf[offset + 8 + lo * 16 : offset + 8 + hi * 16]
+                        )
+                pairs[key] = values
+
+            _, _, seq_after, published_at = _HEADER.unpack_from(buf, 0)
+            if seq_after == seq:
+                return published_at, blobs, pairs
+        self.logger.warning("No consistent snapshot after %s tries", self.max_retries)
+        return None
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+
+class SharedEventFeed:
+    """The EventFeed interface on top of the events of the snapshot."""
+
+    def __init__(self, reader: "SharedMetricsReader"):
+        self.reader = reader
+
+    @property
+    def last_seq(self) -> int:
+        events = self.reader._events()
+        return events[-1]["seq"] if events else 0
+
+    def since(self, seq: int = 0) -> list[dict]:
+        return [event for event in self.reader._events() if event["seq"] > seq]
+
+
+class SharedMetricsReader:
+    """
+    Stands in for `Metrics` in the API workers of the multi-process mode.
+    Live values, node and pairing state come from the collector's snapshot,
+    settings through the settings file (the collector reloads it) and
+    sessions from the shared SQLite database. Start/stop are sent to the
+    collector's control socket. Pairing and device filter changes raise
+    CollectorUnavailableError.
+    """
+
+    def __init__(
+        self,
+        name: str = DEFAULT_NAME,
+        settings_store: Optional[SettingsStore] = None,
+        database: Optional[SessionDatabase] = None,
+        control: Optional[ControlClient] = None,
+    ):
+        self.snapshot = SharedSnapshotReader(name)
+        self.control = control or ControlClient(
+            errors={"WorkoutRunningError": WorkoutRunningError}
+        )
+        self.settings_store = settings_store or SettingsStore()
+        self.database = database
+        self.events = SharedEventFeed(self)
+        self.summaries = None  # SummaryCache, created on first use
+        # finished sessions never change, rebuilt from the database once
+        self._finished: OrderedDict[str, Session] = OrderedDict()
+
+    def _blob(self, name: str) -> Optional[bytes]:
+        result = self.snapshot.read((name,))
+        if result is None:
+            return None
+        published_at, blobs, _ = result
+        if time.time() - published_at > STALE_AFTER_S:
+            # a restarted collector creates a new segment, attach again
+            self.snapshot.close()
+            return None
+        return blobs[name] or None
+
+    def _events(self) -> list[dict]:
+        data = self._blob("events")
+        return json.loads(data) if data else []
+
+    def get_metrics_json(self) -> str:
+        data = self._blob("metrics")
+        if data is None:
+            return self._collector_down().model_dump_json()
+        return data.decode()
+
+    def get_metrics(self) -> MetricsModel:
+        data = self._blob("metrics")
+        if data is None:
+            return self._collector_down()
+        return MetricsModel.model_validate_json(data)
+
+    @staticmethod
+    def _collector_down() -> MetricsModel:
+        return MetricsModel(
+            is_running=False,
+            state=MetricsState.IDLE,
+            state_message="Collector process is not running",
+        )
+
+    def get_raw_metrics(self) -> dict:
+        data = self._blob("raw")
+        return json.loads(data) if data else {"dropped": {}}
+
+    def get_devices(self) -> list[dict]:
+        data = self._blob("devices")
+        return json.loads(data) if data else []
+
+    def get_current_lap(self) -> Optional[dict]:
+        data = self._blob("lap")
+        return json.loads(data) if data else None
+
+    def _status(self) -> dict:
+        data = self._blob("status")
+        return json.loads(data) if data else {}
+
+    def get_node_stats(self) -> List[dict]:
+        return self._status().get("nodes", [])
+
+    def get_channel_utilization(self) -> dict:
+        return self._status().get(
+            "channels",
+            {"capacity": 0, "reserved": 0, "used": 0, "free": 0, "devices": []},
+        )
+
+    def get_paired_devices(self) -> List[PairedDevice]:
+        return [PairedDevice(**dev) for dev in self._status().get("pairing", [])]
+
+    @property
+    def filter_device_ids(self) -> List[int]:
+        return self._status().get("allow_device_ids", [])
+
+    @property
+    def deny_device_ids(self) -> List[int]:
+        return self._status().get("deny_device_ids", [])
+
+    # ---- sessions, from the database the collector writes ----
+
+    def _database(self) -> SessionDatabase:
+        if self.database is None:
+            raise CollectorUnavailableError("No session database configured")
+        return self.database
+
+    def get_sessions(self) -> List[dict]:
+        current = self._status().get("session_id")
+        now = time.time()
+        sessions = []
+        for row in self._database().sessions(MAX_SESSIONS):
+            end = row["ended_at"] if row["ended_at"] is not None else now
+            sessions.append(
+                {
+                    **row,
+                    "duration_s": round(max(end - row["started_at"], 0.0), 1),
+                    "is_active": row["ended_at"] is None and row["id"] == current,
+                }
+            )
+        # oldest first, like the collector's SessionStore
+        sessions.reverse()
+        return sessions
+
+    def _load_session(self, session_id: str) -> Optional[Session]:
+        session = self._finished.get(session_id)
+        if session is not None:
+            return session
+        database = self._database()
+        row = database.session(session_id)
+        if row is None:
+            return None
+        session = Session(row["id"], row["rider"])
+        session.started_at = row["started_at"]
+        for sample in database.session_rollups(session_id):
+            session.record(MetricsKey(sample["metric"]), sample["avg"], sample["ts"])
+        session.ended_at = row["ended_at"]
+        if session.ended_at is not None:
+            self._finished[session_id] = session
+            while len(self._finished) > MAX_SESSIONS:
+                self._finished.popitem(last=False)
+        return session
+
+    def get_session_summary(self, session_id: str) -> Optional[dict]:
+        """From the 1 s averages of the database, not the raw samples."""
+        session = self._load_session(session_id)
+        if session is None:
+            return None
+        if self.summaries is None:
+            from app.analytics import SummaryCache
+
+            self.summaries = SummaryCache()
+        settings = self.settings_store.current
+        return self.summaries.summary(session, settings.ftp, settings.hr_max)
+
+    def get_laps(self, session_id: str) -> Optional[List[dict]]:
+        database = self._database()
+        if database.session(session_id) is None:
+            return None
+        laps = database.laps(session_id)
+        # the open lap is only written when it ends
+        if self._status().get("session_id") == session_id:
+            lap = self.get_current_lap()
+            if lap is not None and (not laps or lap["number"] > laps[-1]["number"]):
+                laps.append(lap)
+        return laps
+
+    def get_events(self, after_seq: int = 0) -> list[dict]:
+        return self.events.since(after_seq)
+
+    def get_history(
+        self,
+        key: MetricsKey,
+        t_from: Optional[float] = None,
+        t_to: Optional[float] = None,
+        points: int = 500,
+        method: str = "lttb",
+        raw: bool = False,
+    ) -> dict:
+        """
+        Like HistoryStore.query but limited to the series of the snapshot,
+        which has no rollup tiers. Once its ring dropped older samples,
+        `from_ts` is moved to the oldest one left so the answer shows the
+        range it covers.
+        """
+        from app.downsample import lttb, min_max
+
+        t_to = time.time() if t_to is None else t_to
+        t_from = t_to - 1800 if t_from is None else t_from
+        result = self.snapshot.read(series=((key, raw),))
+        flat = result[2][key, raw] if result is not None else array("d")
+        if len(flat) == SERIES_LEN * 2:
+            t_from = min(max(t_from, flat[0]), t_to)
+        times, values = [], []
+        for i in range(0, len(flat), 2):
+            if t_from <= flat[i] <= t_to:
+                times.append(flat[i])
+                values.append(flat[i + 1])
+        if method == "minmax":
+            series = min_max(times, values, values, points)
+        else:
+            series = lttb(times, values, points)
+        return {
+            "key": key,
+            "from_ts": t_from,
+            "to_ts": t_to,
+            "resolution_s": 0,
+            "method": method,
+            "raw": raw,
+            "points": series.round(3).tolist(),
+        }
+
+    def get_metrics_settings(self) -> MetricsSettingsModel:
+        self.settings_store.reload_if_changed()
+        return self.settings_store.current.model
+
+    def set_metrics_settings(
+        self, metrics_settings: MetricsSettingsModel
+    ) -> MetricsSettingsModel:
+        # written to the settings file, the collector picks it up within a second
+        self.settings_store.reload_if_changed()
+        snapshot = self.settings_store.update(
+            metrics_settings, expected_version=metrics_settings.version
+        )
+        return snapshot.model
+
+    # ---- commands, run by the collector ----
+
+    def call(self, command: str, **args):
+        try:
+            return self.control.call(command, **args)
+        except ConnectionError as e:
+            raise CollectorUnavailableError(str(e))
+
+    def start(self) -> MetricsState:
+        return MetricsState(self.call("start"))
+
+    def stop(self) -> MetricsState:
+        return MetricsState(self.call("stop"))
+
+    # ---- only in the collector ----
+
+    def pair_device(self, device_id: int, device_type: int, trans_type: int = 0):
+        raise CollectorUnavailableError("Pairing is only possible in the collector")
+
+    def unpair_device(self, device_id: int) -> List[PairedDevice]:
+        raise CollectorUnavailableError("Pairing is only possible in the collector")
+
+    def set_filter_device_ids(
+        self, filter_device_ids: List[int], deny_device_ids: List[int] = None
+    ):
+        raise CollectorUnavailableError(
+            "The device filter can only be changed in the collector"
+        )
+
+    def close(self):
+        self.snapshot.close()
+
+
+class SharedWorkout:
+    """
+    The Workout interface for the API workers. The timer runs in the
+    collector, the intervals and commands go through its control socket,
+    the progress for the stream comes from the snapshot.
+    """
+
+    def __init__(self, reader: SharedMetricsReader):
+        self.reader = reader
+
+    def get_intervals(self) -> list[IntervalModel]:
+        return [IntervalModel(**i) for i in self.reader.call("get_workout")]
+
+    def set_intervals(self, intervals: list[IntervalModel]) -> list[IntervalModel]:
+        result = self.reader.call(
+            "set_workout", intervals=[i.model_dump(mode="json") for i in intervals]
+        )
+        return [IntervalModel(**i) for i in result]
+
+    def start(self):
+        self.reader.call("start_workout")
+
+    def stop(self):
+        self.reader.call("stop_workout")
+
+    def progress(self) -> Optional[IntervalProgressModel]:
+        data = self.reader._blob("workout")
+        progress = json.loads(data) if data else None
+        return IntervalProgressModel(**progress) if progress else None
@@ -0,0 +1,182 @@
+import gzip
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+from pathlib import Path
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional, without it only gzip variants are built
+    brotli = None
+
+logger = logging.getLogger("app.static")
+
+COMPRESSIBLE_SUFFIXES = {
+    ".css",
+    ".html",
+    ".ico",
+    ".js",
+    ".json",
+    ".map",
+    ".mjs",
+    ".svg",
+    ".txt",
+    ".wasm",
+    ".xml",
+}
+MIN_COMPRESS_SIZE = 1024
+
+# preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# Vite writes the build output to assets/ with an 8 character base64url
+# content hash in the name, e.g. assets/index-BQ3Hk1xZ.js
+HASHED_NAME = re.compile(r"(?:^|/)assets/[^/]+-[A-Za-z0-9_-]{8}\.[A-Za-z0-9]+$")
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=11)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def _replace(target: Path, data: bytes, mode: int):
+    """
+    Atomically replaces `target`. Every uvicorn worker precompresses at
+    startup, so each one writes its own temporary file.
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=target.parent, prefix=target.name + ".", suffix=".tmp", delete=False
+    ) as tmp:
+        tmp.write(data)
+    try:
+        os.chmod(tmp.name, mode & 0o777)  # mkstemp creates it as 0600
+        os.replace(tmp.name, target)
+    except OSError:
+        os.unlink(tmp.name)
+        raise
+
+
+def precompress(directory: Path) -> int:
+    """
+    Writes .br (if brotli is installed) and .gz next to every compressible
+    file that has no up-to-date variant yet. Returns the number written.
+    """
+    encodings = [(e, s) for e, s in ENCODINGS if e != "br" or brotli is not None]
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = Path(root) / name
+            if path.suffix not in COMPRESSIBLE_SUFFIXES:
+                continue
+            try:
+                source_stat = path.stat()
+                if source_stat.st_size < MIN_COMPRESS_SIZE:
+                    continue
+                data = None
+                for encoding, suffix in encodings:
+                    target = path.with_name(name + suffix)
+                    if (
+                        target.exists()
+                        and target.stat().st_mtime >= source_stat.st_mtime
+                    ):
+                        continue
+                    if data is None:
+                        data = path.read_bytes()
+                    compressed = _compress(data, encoding)
+                    if len(compressed) >= len(data):
+                        continue
+                    _replace(target, compressed, source_stat.st_mode)
+                    written += 1
+            except OSError:
+                logger.warning("Could not precompress %s", path, exc_info=True)
+    if written:
+        logger.info("Precompressed %s static files in %s", written, directory)
+    return written
+
+
+def accepted_encodings(headers: Headers) -> set[str]:
+    accepted = set()
+    for part in headers.get("accept-encoding", "").split(","):
+        name, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if name and params not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.lower())
+    return accepted
+
+
+def cache_control(path: str) -> str:
+    """Hashed asset names never change content, everything else revalidates."""
+    if HASHED_NAME.search(path.replace(os.sep, "/")):
+        return CACHE_IMMUTABLE
+    return CACHE_REVALIDATE
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles that serves the .br/.gz variant of a file when the client
+    accepts it. Variants are looked up once when the app is created, a
+    request only does a dict lookup. ETag/304 handling is the one from
+    StaticFiles, based on the file that is actually sent.
+    """
+
+    def __init__(self, *, directory: Path, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        self.variants: dict[str, list[tuple[str, str, os.stat_result]]] = {}
+        for root, _, files in os.walk(os.path.realpath(directory)):
+            names = set(files)
+            for name in files:
+                found = []
+                for encoding, suffix in ENCODINGS:
+                    if name + suffix in names:
+                        variant = os.path.join(root, name + suffix)
+                        found.append((encoding, variant, os.stat(variant)))
+                if found:
+                    self.variants[os.path.join(root, name)] = found
+
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        headers = {
+            "Cache-Control": cache_control(str(full_path)),
+            "Vary": "Accept-Encoding",
+        }
+
+        response = None
+        variants = self.variants.get(str(full_path))
+        if variants:
+            accepted = accepted_encodings(request_headers)
+            for encoding, variant, variant_stat in variants:
+                if encoding in accepted:
+                    response = FileResponse(
+                        variant,
+                        status_code=status_code,
+                        stat_result=variant_stat,
+                        media_type=mimetypes.guess_type(str(full_path))[0],
+                        headers={**headers, "Content-Encoding": encoding},
+                    )
+                    break
+        if response is None:
+            response = FileResponse(
+                full_path,
+                status_code=status_code,
+                stat_result=stat_result,
+                headers=headers,
+            )
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -0,0 +1,515 @@
+import asyncio
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+from app.util import MetricsKey
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    rider TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_rider_started ON sessions (rider, started_at);
+CREATE INDEX IF NOT EXISTS idx_sessions_started ON sessions (started_at);
+
+CREATE TABLE IF NOT EXISTS samples_1s (
+    session_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    sum REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    PRIMARY KEY (session_id, metric, ts)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS session_aggregates (
+    session_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    avg REAL,
+    max REAL,
+    seconds INTEGER NOT NULL,
+    PRIMARY KEY (session_id, metric)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS best_efforts (
+    session_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    duration_s INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (session_id, metric, duration_s)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_best_efforts_metric
+    ON best_efforts (metric, duration_s, value);
+
+CREATE TABLE IF NOT EXISTS laps (
+    session_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    round_number INTEGER NOT NULL,
+    interval_index INTEGER NOT NULL,
+    name TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL,
+    distance REAL,
+    PRIMARY KEY (session_id, number)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS lap_metrics (
+    session_id TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    metric TEXT NOT NULL,
+    avg REAL,
+    max REAL,
+    samples INTEGER NOT NULL,
+    PRIMARY KEY (session_id, number, metric)
+) WITHOUT ROWID;
+"""
+
+# a second that gets samples from two flushes is merged, not overwritten
+UPSERT_SAMPLE = """
+INSERT INTO samples_1s (session_id, metric, ts, count, sum, min, max)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (session_id, metric, ts) DO UPDATE SET
+    count = count + excluded.count,
+    sum = sum + excluded.sum,
+    min = MIN(min, excluded.min),
+    max = MAX(max, excluded.max)
+"""
+
+# durations in seconds of the best efforts kept per session
+BEST_EFFORTS = {
+    MetricsKey.POWER.value: (5, 60, 300, 1200),
+    MetricsKey.SPEED.value: (60, 300, 1200),
+}
+
+TREND_PERIODS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+_STOP = object()
+
+
+def best_average(samples: list[tuple[int, float]], duration_s: int) -> Optional[float]:
+    """Best mean over `duration_s` consecutive seconds, missing seconds are 0."""
+    if not samples:
+        return None
+    first, last = samples[0][0], samples[-1][0]
+    if last - first + 1 < duration_s:
+        return None
+    values = [0.0] * (last - first + 1)
+    for ts, value in samples:
+        values[ts - first] = value
+
+    window = sum(values[:duration_s])
+    best = window
+    for i in range(duration_s, len(values)):
+        window += values[i] - values[i - duration_s]
+        if window > best:
+            best = window
+    return best / duration_s
+
+
+def _lap_statements(session_id: str, lap: dict) -> list[tuple[str, tuple]]:
+    statements = [
+        (
+            "INSERT OR REPLACE INTO laps (session_id, number, round_number,"
+            " interval_index, name, started_at, ended_at, distance)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                session_id,
+                lap["number"],
+                lap["round_number"],
+                lap["interval_index"],
+                lap["name"],
+                lap["started_at"],
+                lap["ended_at"],
+                lap["distance"],
+            ),
+        )
+    ]
+    for metric, stats in lap["metrics"].items():
+        if stats["samples"]:
+            statements.append(
+                (
+                    "INSERT OR REPLACE INTO lap_metrics"
+                    " (session_id, number, metric, avg, max, samples)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        session_id,
+                        lap["number"],
+                        metric,
+                        stats["avg"],
+                        stats["max"],
+                        stats["samples"],
+                    ),
+                )
+            )
+    return statements
+
+
+class ConnectionPool:
+    """A few read-only connections shared by the API threads."""
+
+    def __init__(self, path: Path, size: int = 3):
+        self._pool: queue.Queue[sqlite3.Connection] = queue.Queue()
+        uri = Path(path).resolve().as_uri() + "?mode=ro"
+        for _ in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._pool.put(conn)
+        self.size = size
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def close(self):
+        for _ in range(self.size):
+            self._pool.get().close()
+
+
+class SessionDatabase:
+    """
+    Sessions, 1 s rollups, per-session aggregates and best efforts in
+    SQLite (WAL mode).
+
+    The recording methods only put a tuple on a queue, so they are safe to
+    call from the ANT+ callback threads. A writer thread folds the samples
+    into 1 s buckets and writes them in one transaction every
+    `flush_interval_s`. Queries run on a small pool of read-only
+    connections in worker threads and are awaitable.
+    """
+
+    def __init__(self, path: Path, flush_interval_s: float = 1.0, pool_size: int = 3):
+        self.logger = logging.getLogger("app.store")
+        self.path = Path(path)
+        self.flush_interval_s = flush_interval_s
+        self.pool_size = pool_size
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: Optional[threading.Thread] = None
+        self.pool: Optional[ConnectionPool] = None
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self, writer: bool = True):
+        """
+        Opens the read pool and starts the writer. API workers of the
+        multi-process mode only read, the collector process writes.
+        """
+        if self.pool is None:
+            self.pool = ConnectionPool(self.path, self.pool_size)
+        if not writer or (self.thread is not None and self.thread.is_alive()):
+            return
+        self.thread = threading.Thread(
+            target=self._run, name="session-db-writer", daemon=True
+        )
+        self.thread.start()
+
+    def close(self, timeout: Optional[float] = 5.0):
+        """Write everything still queued and stop the writer."""
+        if self.thread is not None:
+            self.queue.put(_STOP)
+            self.thread.join(timeout)
+            self.thread = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    # ---- recording, never blocks ----
+
+    def start_session(
+        self, session_id: str, started_at: float, rider: Optional[str] = None
+    ):
+        self.queue.put(("start", session_id, started_at, rider))
+
+    def record(self, session_id: str, key: MetricsKey, t: float, value: float):
+        self.queue.put(("sample", session_id, key.value, t, value))
+
+    def end_session(self, session_id: str, ended_at: float):
+        self.queue.put(("end", session_id, ended_at))
+
+    def record_lap(self, session_id: str, lap: dict):
+        """`lap` as returned by `Lap.to_dict`, written with the next flush."""
+        self.queue.put(("lap", session_id, lap))
+
+    # ---- writer thread ----
+
+    def _run(self):
+        conn = self._connect()
+        # (session_id, metric, second) -> [count, sum, min, max]
+        buckets: dict[tuple[str, str, int], list] = {}
+        statements: list[tuple[str, tuple]] = []
+        ended: list[str] = []
+        next_flush = time.monotonic() + self.flush_interval_s
+        running = True
+        while running:
+            try:
+                item = self.queue.get(timeout=max(next_flush - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                running = False
+            elif item is not None:
+                kind = item[0]
+                if kind == "sample":
+                    _, session_id, metric, t, value = item
+                    key = (session_id, metric, int(t))
+                    bucket = buckets.get(key)
+                    if bucket is None:
+                        buckets[key] = [1, value, value, value]
+                    else:
+                        bucket[0] += 1
+                        bucket[1] += value
+                        if value < bucket[2]:
+                            bucket[2] = value
+                        if value > bucket[3]:
+                            bucket[3] = value
+                elif kind == "start":
+                    _, session_id, started_at, rider = item
+                    statements.append(
+                        (
+                            "INSERT OR REPLACE INTO sessions (id, rider, started_at)"
+                            " VALUES (?, ?, ?)",
+                            (session_id, rider, started_at),
+                        )
+                    )
+                elif kind == "end":
+                    _, session_id, ended_at = item
+                    statements.append(
+                        (
+                            "UPDATE sessions SET ended_at = ? WHERE id = ?",
+                            (ended_at, session_id),
+                        )
+                    )
+                    ended.append(session_id)
+                elif kind == "lap":
+                    _, session_id, lap = item
+                    statements.extend(_lap_statements(session_id, lap))
+
+            if running and time.monotonic() < next_flush:
+                continue
+            try:
+                self._flush(conn, statements, buckets, ended)
+            except sqlite3.Error:
+                self.logger.warning("Could not write sessions", exc_info=True)
+            statements, buckets, ended = [], {}, []
+            next_flush = time.monotonic() + self.flush_interval_s
+        conn.close()
+
+    def _flush(self, conn, statements, buckets, ended):
+        if not (statements or buckets or ended):
+            return
+        with conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            conn.executemany(
+                UPSERT_SAMPLE,
+                [(*key, *values) for key, values in buckets.items()],
+            )
+            for session_id in ended:
+                self._write_aggregates(conn, session_id)
+
+    def _write_aggregates(self, conn, session_id: str):
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO session_aggregates
+                (session_id, metric, avg, max, seconds)
+            SELECT session_id, metric, SUM(sum) / SUM(count), MAX(max), COUNT(*)
+            FROM samples_1s WHERE session_id = ? GROUP BY metric
+            """,
+            (session_id,),
+        )
+        for metric, durations in BEST_EFFORTS.items():
+            samples = conn.execute(
+                "SELECT ts, sum / count FROM samples_1s"
+                " WHERE session_id = ? AND metric = ? ORDER BY ts",
+                (session_id, metric),
+            ).fetchall()
+            for duration_s in durations:
+                value = best_average(samples, duration_s)
+                if value is not None:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO best_efforts"
+                        " (session_id, metric, duration_s, value) VALUES (?, ?, ?, ?)",
+                        (session_id, metric, duration_s, value),
+                    )
+
+    # ---- queries ----
+
+    def _fetch(self, sql: str, params: tuple) -> list[dict]:
+        if self.pool is None:
+            raise RuntimeError("Session database is not started")
+        with self.pool.connection() as conn:
+            return [dict(row) for row in conn.execute(sql, params).fetchall()]
+
+    async def fetch(self, sql: str, params: tuple = ()) -> list[dict]:
+        return await asyncio.to_thread(self._fetch, sql, params)
+
+    async def list_sessions(
+        self,
+        rider: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: int = 50,
+    ) -> list[dict]:
+        where, params = self._session_filter(rider, since, until)
+        sessions = await self.fetch(
+            f"SELECT id, rider, started_at, ended_at FROM sessions {where}"
+            " ORDER BY started_at DESC LIMIT ?",
+            (*params, limit),
+        )
+        if not sessions:
+            return sessions
+
+        ids = [s["id"] for s in sessions]
+        marks = ",".join("?" * len(ids))
+        aggregates = await self.fetch(
+            "SELECT session_id, metric, avg, max, seconds FROM session_aggregates"
+            f" WHERE session_id IN ({marks})",
+            tuple(ids),
+        )
+        by_session: dict[str, dict] = {session_id: {} for session_id in ids}
+        for row in aggregates:
+            by_session[row.pop("session_id")][row.pop("metric")] = row
+        for session in sessions:
+            session["aggregates"] = by_session[session["id"]]
+        return sessions
+
+    async def session_samples(self, session_id: str, key: MetricsKey) -> list[dict]:
+        return await self.fetch(
+            "SELECT ts, sum / count AS avg, min, max FROM samples_1s"
+            " WHERE session_id = ? AND metric = ? ORDER BY ts",
+            (session_id, key.value),
+        )
+
+    async def session_laps(self, session_id: str) -> list[dict]:
+        return await asyncio.to_thread(self.laps, session_id)
+
+    # ---- blocking queries, for callers already on a worker thread ----
+
+    def sessions(self, limit: int = 20) -> list[dict]:
+        """The most recent sessions with their number of samples."""
+        return self._fetch(
+            "SELECT id, rider, started_at, ended_at,"
+            " (SELECT COALESCE(SUM(count), 0) FROM samples_1s"
+            "  WHERE session_id = sessions.id) AS samples"
+            " FROM sessions ORDER BY started_at DESC LIMIT ?",
+            (limit,),
+        )
+
+    def session(self, session_id: str) -> Optional[dict]:
+        rows = self._fetch(
+            "SELECT id, rider, started_at, ended_at FROM sessions WHERE id = ?",
+            (session_id,),
+        )
+        return rows[0] if rows else None
+
+    def session_rollups(self, session_id: str) -> list[dict]:
+        """The 1 s averages of every metric, ordered by metric and time."""
+        return self._fetch(
+            "SELECT metric, ts, sum / count AS avg FROM samples_1s"
+            " WHERE session_id = ? ORDER BY metric, ts",
+            (session_id,),
+        )
+
+    def laps(self, session_id: str) -> list[dict]:
+        laps = self._fetch(
+            "SELECT number, round_number, interval_index, name, started_at,"
+            " ended_at, distance FROM laps WHERE session_id = ? ORDER BY number",
+            (session_id,),
+        )
+        metrics = self._fetch(
+            "SELECT number, metric, avg, max, samples FROM lap_metrics"
+            " WHERE session_id = ?",
+            (session_id,),
+        )
+        by_number: dict[int, dict] = {lap["number"]: {} for lap in laps}
+        for row in metrics:
+            number = row.pop("number")
+            if number in by_number:
+                by_number[number][row.pop("metric")] = row
+        for lap in laps:
+            end = lap["ended_at"] if lap["ended_at"] is not None else time.time()
+            lap["duration_s"] = round(max(end - lap["started_at"], 0.0), 1)
+            lap["metrics"] = by_number[lap["number"]]
+        return laps
+
+    async def best_efforts(
+        self,
+        key: MetricsKey,
+        duration_s: int,
+        rider: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: int = 10,
+    ) -> list[dict]:
+        where, params = self._session_filter(rider, since, None, prefix="s.")
+        where = f"{where} AND" if where else "WHERE"
+        return await self.fetch(
+            "SELECT b.session_id, s.rider, s.started_at, b.duration_s, b.value"
+            " FROM best_efforts b JOIN sessions s ON s.id = b.session_id"
+            f" {where} b.metric = ? AND b.duration_s = ?"
+            " ORDER BY b.value DESC LIMIT ?",
+            (*params, key.value, duration_s, limit),
+        )
+
+    async def trend(
+        self,
+        key: MetricsKey,
+        period: str = "week",
+        rider: Optional[str] = None,
+        since: Optional[float] = None,
+    ) -> list[dict]:
+        """Mean of the session averages per day/week/month."""
+        where, params = self._session_filter(rider, since, None, prefix="s.")
+        where = f"{where} AND" if where else "WHERE"
+        return await self.fetch(
+            f"SELECT strftime('{TREND_PERIODS[period]}', s.started_at, 'unixepoch')"
+            " AS period, AVG(a.avg) AS avg, MAX(a.max) AS max,"
+            " COUNT(*) AS sessions, SUM(a.seconds) AS seconds"
+            " FROM session_aggregates a JOIN sessions s ON s.id = a.session_id"
+            f" {where} a.metric = ? GROUP BY period ORDER BY period",
+            (*params, key.value),
+        )
+
+    @staticmethod
+    def _session_filter(
+        rider: Optional[str],
+        since: Optional[float],
+        until: Optional[float],
+        prefix: str = "",
+    ) -> tuple[str, tuple]:
+        clauses, params = [], []
+        if rider is not None:
+            clauses.append(f"{prefix}rider = ?")
+            params.append(rider)
+        if since is not None:
+            clauses.append(f"{prefix}started_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append(f"{prefix}started_at < ?")
+            params.append(until)
+        if not clauses:
+            return "", ()
+        return "WHERE " + " AND ".join(clauses), tuple(params)
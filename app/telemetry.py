@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from app.util import RateCounter
+
+DeviceKey = tuple[int, int]  # (device_id, device_type)
+
+# extended message flag byte and its RSSI bit (ANT message protocol 7.1.1)
+_EXT_FLAG_INDEX = 8
+_EXT_FLAG_CHANNEL_ID = 0x80
+_EXT_FLAG_RSSI = 0x40
+
+
+class DeviceTelemetry:
+    """
+    Link health of one sensor. `on_page` runs for every data page on the
+    ANT+ thread, so it only does a few attribute updates and an O(1)
+    rate counter increment; everything else is derived when read.
+    """
+
+    __slots__ = (
+        "key",
+        "name",
+        "first_seen",
+        "last_seen",
+        "rate_10s",
+        "rate_60s",
+        "gaps",
+        "longest_gap_s",
+        "gap_threshold_s",
+        "battery_status",
+        "battery_voltage",
+        "battery_percent",
+        "rssi",
+        "stale",
+    )
+
+    def __init__(self, key: DeviceKey, name: str, gap_threshold_s: float):
+        self.key = key
+        self.name = name
+        self.first_seen: Optional[float] = None
+        self.last_seen: Optional[float] = None
+        self.rate_10s = RateCounter(window_s=10)
+        self.rate_60s = RateCounter(window_s=60)
+        self.gaps = 0
+        self.longest_gap_s = 0.0
+        self.gap_threshold_s = gap_threshold_s
+        self.battery_status: Optional[str] = None
+        self.battery_voltage: Optional[float] = None
+        self.battery_percent: Optional[int] = None
+        self.rssi: Optional[int] = None
+        self.stale = False
+
+    def on_page(self, now: float):
+        last_seen = self.last_seen
+        if last_seen is None:
+            self.first_seen = now
+        else:
+            gap = now - last_seen
+            if gap > self.gap_threshold_s:
+                self.gaps += 1
+                if gap > self.longest_gap_s:
+                    self.longest_gap_s = gap
+        self.last_seen = now
+        self.rate_10s.add(now)
+        self.rate_60s.add(now)
+
+    def on_raw(self, data):
+        # RSSI is only there when the adapter is configured to append it
+        if len(data) <= _EXT_FLAG_INDEX + 2:
+            return
+        flags = data[_EXT_FLAG_INDEX]
+        if not flags & _EXT_FLAG_RSSI:
+            return
+        # channel id (4 bytes) comes first, then measurement type and RSSI value
+        idx = _EXT_FLAG_INDEX + 1 + (4 if flags & _EXT_FLAG_CHANNEL_ID else 0) + 1
+        if idx < len(data):
+            value = data[idx]
+            self.rssi = value - 256 if value > 127 else value
+
+    def on_battery(self, data):
+        status = getattr(data, "status", None)
+        self.battery_status = getattr(status, "name", None)
+        self.battery_voltage = round(
+            getattr(data, "voltage_coarse", 0) + getattr(data, "voltage_fractional", 0),
+            2,
+        )
+
+    def on_battery_percent(self, percent: Optional[int]):
+        # 0xFF means "not supported" on heart rate straps
+        if percent is not None and 0 <= percent <= 100:
+            self.battery_percent = percent
+
+    def age(self, now: float) -> Optional[float]:
+        if self.last_seen is None:
+            return None
+        return now - self.last_seen
+
+    def to_dict(self, now: float) -> dict:
+        age = self.age(now)
+        return {
+            "last_seen_age_s": round(age, 1) if age is not None else None,
+            "pages_per_second_10s": self.rate_10s.rate(now, self.first_seen),
+            "pages_per_second_60s": self.rate_60s.rate(now, self.first_seen),
+            "pages_total": self.rate_10s.total,
+            "gaps": self.gaps,
+            "longest_gap_s": round(self.longest_gap_s, 1),
+            "battery_status": self.battery_status,
+            "battery_voltage": self.battery_voltage,
+            "battery_percent": self.battery_percent,
+            "rssi": self.rssi,
+            "stale": self.stale,
+        }
+
+
+class TelemetryRegistry:
+    """Telemetry of all sensors seen in this run, keyed by device key."""
+
+    def __init__(self, gap_threshold_s: float = 2.0, stale_after_s: float = 5.0):
+        self.logger = logging.getLogger("app.telemetry")
+        self.gap_threshold_s = gap_threshold_s
+        self.stale_after_s = stale_after_s
+        self.lock = threading.Lock()
+        self._devices: dict[DeviceKey, DeviceTelemetry] = {}
+
+    def device(self, key: DeviceKey, name: str = "unknown") -> DeviceTelemetry:
+        telemetry = self._devices.get(key)
+        if telemetry is None:
+            with self.lock:
+                telemetry = self._devices.setdefault(
+                    key, DeviceTelemetry(key, name, self.gap_threshold_s)
+                )
+        return telemetry
+
+    def get(self, key: DeviceKey) -> Optional[DeviceTelemetry]:
+        return self._devices.get(key)
+
+    def clear(self):
+        with self.lock:
+            self._devices.clear()
+
+    def update_stale(
+        self, now: Optional[float] = None
+    ) -> tuple[list[DeviceTelemetry], list[DeviceTelemetry]]:
+        """
+        Flags sensors without data for `stale_after_s` and returns the ones
+        that just went stale and the ones that are back.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            devices = list(self._devices.values())
+
+        went_stale = []
+        recovered = []
+        for telemetry in devices:
+            age = telemetry.age(now)
+            stale = age is not None and age > self.stale_after_s
+            if stale and not telemetry.stale:
+                went_stale.append(telemetry)
+                self.logger.warning(
+                    "Sensor %s (device_id: %s) silent for %.1fs",
+                    telemetry.name,
+                    telemetry.key[0],
+                    age,
+                )
+            elif not stale and telemetry.stale:
+                recovered.append(telemetry)
+                self.logger.info(
+                    "Sensor %s (device_id: %s) is back",
+                    telemetry.name,
+                    telemetry.key[0],
+                )
+            telemetry.stale = stale
+        return went_stale, recovered
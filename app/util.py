@@ -1,6 +1,8 @@
 from collections import deque
+import math
 import time
 import threading
+from typing import Optional
 
 
 from enum import Enum
@@ -155,3 +157,72 @@ class CumulativeSumMap:
     def __repr__(self):
         with self.lock:
             return str(self.store)
+
+
+class RateCounter:
+    """
+    Events per second over a sliding window of one-second buckets.
+    `add` is O(1) and lock free (callers are single producer threads),
+    `rate` sums the buckets of the window.
+    """
+
+    def __init__(self, window_s: int = 10):
+        self.window_s = window_s
+        self.total = 0
+        # one extra bucket for the second that is still being counted
+        self._seconds = [-1] * (window_s + 1)
+        self._counts = [0] * (window_s + 1)
+
+    def add(self, now: float = None, count: int = 1):
+        if now is None:
+            now = time.time()
+        second = int(now)
+        idx = second % (self.window_s + 1)
+        if self._seconds[idx] != second:
+            self._seconds[idx] = second
+            self._counts[idx] = 0
+        self._counts[idx] += count
+        self.total += count
+
+    def rate(self, now: float = None, since: Optional[float] = None) -> float:
+        """
+        `since` is when counting started, a window that isn't full yet is
+        averaged over the whole seconds since then instead of the window.
+        """
+        if now is None:
+            now = time.time()
+        # only count completed seconds so a fresh bucket doesn't halve the rate
+        current = int(now)
+        oldest = current - self.window_s
+        if since is not None:
+            # the second counting started in is incomplete as well
+            oldest = max(oldest, math.ceil(since))
+        span = current - oldest
+        if span <= 0:
+            return 0.0
+        events = sum(
+            c for s, c in zip(self._seconds, self._counts) if oldest <= s < current
+        )
+        return events / span
+
+
+class ChangeNotifier:
+    """
+    A version counter consumers can block on instead of polling. Producers
+    call `notify` after every change, `wait` returns as soon as the version
+    differs from the one the caller has seen (or on timeout).
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version: int, timeout: float = None) -> int:
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
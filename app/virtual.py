@@ -0,0 +1,125 @@
+import math
+import threading
+from array import array
+from typing import Optional
+
+from app.model import MetricsSettingsModel
+
+GRAVITY = 9.81  # m/s²
+AIR_DENSITY = 1.225  # kg/m³, sea level at 15 °C
+MAX_POWER_W = 2000  # table range, higher power uses the last entry
+
+STEP_S = 0.25  # fixed integration timestep
+# longer gaps (paused, no data) are skipped instead of replayed
+MAX_GAP_S = 10.0
+
+# limits the pedal force P/v when starting from standstill
+_MIN_SPEED = 1.0  # m/s
+
+
+def steady_speed(power: float, a: float, b: float) -> float:
+    """
+    Speed in m/s at which `power` equals the resistance a·v³ + b·v
+    (air drag + rolling and climbing), the positive root of the cubic
+    solved in closed form (Cardano).
+    """
+    p = b / a
+    q = -power / a
+    discriminant = (q / 2) ** 2 + (p / 3) ** 3
+    if discriminant >= 0:
+        root = math.sqrt(discriminant)
+        return max(math.cbrt(-q / 2 + root) + math.cbrt(-q / 2 - root), 0.0)
+    # three real roots (only downhill, b < 0), the largest is the speed
+    cos_arg = 3 * q / (2 * p) * math.sqrt(-3 / p)
+    angle = math.acos(max(-1.0, min(1.0, cos_arg)))
+    return 2 * math.sqrt(-p / 3) * math.cos(angle / 3)
+
+
+class SpeedTable:
+    """
+    Steady-state speed for every watt from 0 to MAX_POWER_W. Built once
+    per settings version, a power update is then a lookup with linear
+    interpolation instead of solving the cubic.
+
+    Resistance in watts at speed v (m/s) is a·v³ + b·v.
+    """
+
+    def __init__(self, mass_kg: float, cda_m2: float, crr: float, grade_percent: float):
+        slope = math.atan(grade_percent / 100)
+        self.mass_kg = mass_kg
+        self.a = 0.5 * AIR_DENSITY * cda_m2
+        self.b = mass_kg * GRAVITY * (crr * math.cos(slope) + math.sin(slope))
+        self.speeds = array(
+            "d", (steady_speed(w, self.a, self.b) for w in range(MAX_POWER_W + 1))
+        )
+
+    @classmethod
+    def from_settings(cls, model: MetricsSettingsModel) -> Optional["SpeedTable"]:
+        if not model.virtual_speed:
+            return None
+        return cls(model.system_mass_kg, model.cda_m2, model.crr, model.grade_percent)
+
+    def speed(self, power: float) -> float:
+        if power <= 0:
+            return self.speeds[0]
+        if power >= MAX_POWER_W:
+            return self.speeds[-1]
+        index = int(power)
+        low = self.speeds[index]
+        return low + (self.speeds[index + 1] - low) * (power - index)
+
+
+class VirtualRide:
+    """
+    Speed and distance of a virtual bike, advanced from the power in fixed
+    steps of `step_s`. Each step accelerates the bike by the net force
+    (m·dv/dt = P/v - a·v² - b) and adds the distance covered. The steady-state
+    speed from the table bounds the step, so it never overshoots and the
+    speed settles exactly on the table value for constant power.
+    """
+
+    def __init__(self, step_s: float = STEP_S):
+        self.step_s = step_s
+        self.lock = threading.Lock()
+        self.speed = 0.0  # m/s
+        self.distance = 0.0  # m
+        self._t: Optional[float] = None
+
+    @property
+    def speed_kmh(self) -> float:
+        return self.speed * 3.6
+
+    def pause(self):
+        with self.lock:
+            self._t = None
+
+    def advance(self, table: SpeedTable, power: float, now: float) -> bool:
+        """Runs the steps up to `now`, returns False if there was none."""
+        with self.lock:
+            if self._t is None or now - self._t > MAX_GAP_S:
+                self._t = now
+                return False
+            steps = int((now - self._t) / self.step_s)
+            if steps <= 0:
+                return False
+            self._t += steps * self.step_s
+
+            target = table.speed(power)
+            speed = self.speed
+            distance = self.distance
+            for _ in range(steps):
+                force = (
+                    power / max(speed, _MIN_SPEED) - table.a * speed * speed - table.b
+                )
+                new_speed = speed + force / table.mass_kg * self.step_s
+                # stay between the current and the steady-state speed
+                if speed <= target:
+                    new_speed = min(max(new_speed, speed), target)
+                else:
+                    new_speed = max(min(new_speed, speed), target)
+                new_speed = max(new_speed, 0.0)
+                distance += (speed + new_speed) / 2 * self.step_s
+                speed = new_speed
+            self.speed = speed
+            self.distance = distance
+            return True
@@ -1,20 +1,39 @@
+import bisect
 import time
-from typing import List, Optional
+from typing import List, NamedTuple, Optional
 from app.model import IntervalModel, IntervalProgressModel
 
 
+class TimerPosition(NamedTuple):
+    round_number: int  # 1-based
+    index: int  # of the interval in the workout
+    started_at: float  # when this interval of this round started
+
+
 class Timer:
     def __init__(self, intervals: List[IntervalModel]):
         """
         Initialize the timer with a list of intervals.
         """
         self._intervals = intervals
+        self._ends = self._interval_ends(intervals)
         self._start_time = None
         self._rounds_completed = 0  # total completed rounds
         self._is_running = False
 
     def set_intervak(self, intervals: List[IntervalModel]):
         self._intervals = intervals
+        self._ends = self._interval_ends(intervals)
+
+    @staticmethod
+    def _interval_ends(intervals: Optional[List[IntervalModel]]) -> List[int]:
+        """Offset of the end of every interval within a round."""
+        ends = []
+        total = 0
+        for interval in intervals or []:
+            total += interval.seconds
+            ends.append(total)
+        return ends
 
     def is_running(self) -> bool:
         return self._is_running
@@ -30,6 +49,30 @@ class Timer:
         self._is_running = False
         self._start_time = None
 
+    def position(self, now: Optional[float] = None) -> Optional[TimerPosition]:
+        """
+        Round and interval at `now`, None when the timer isn't running or
+        the workout has no intervals. A bisect over the precomputed interval
+        ends, cheap enough to call for every sample.
+        """
+        start_time = self._start_time
+        ends = self._ends
+        if start_time is None or not ends or ends[-1] <= 0:
+            return None
+        elapsed = (time.time() if now is None else now) - start_time
+        rounds, time_in_round = divmod(max(elapsed, 0.0), ends[-1])
+        # min() guards against float rounding right at the end of a round
+        index = min(bisect.bisect_right(ends, time_in_round), len(ends) - 1)
+        offset = ends[index - 1] if index else 0
+        return TimerPosition(
+            int(rounds) + 1, index, start_time + rounds * ends[-1] + offset
+        )
+
+    def interval(self, index: int) -> Optional[IntervalModel]:
+        if self._intervals is None or not 0 <= index < len(self._intervals):
+            return None
+        return self._intervals[index]
+
     def current_interval(self) -> Optional[IntervalProgressModel]:
         """
         Return an IntervalProgressModel for the current interval.
@@ -81,3 +124,40 @@ class Timer:
             total_time_spent=total_elapsed,
             is_running=self._is_running,
         )
+
+
+class WorkoutRunningError(RuntimeError):
+    """The intervals can't change while the workout is running."""
+
+
+class Workout:
+    """
+    The intervals of the workout and the timer that runs them. Metrics
+    gets the timer for the laps and the interval rules, so the workout
+    lives in the process that owns the ANT+ nodes.
+    """
+
+    def __init__(self, intervals: Optional[List[IntervalModel]] = None):
+        self.intervals: List[IntervalModel] = list(intervals or [])
+        self.timer = Timer(self.intervals)
+
+    def get_intervals(self) -> List[IntervalModel]:
+        return self.intervals
+
+    def set_intervals(self, intervals: List[IntervalModel]) -> List[IntervalModel]:
+        if self.timer.is_running():
+            raise WorkoutRunningError(
+                "Cannot update workout while the timer is running"
+            )
+        self.intervals = list(intervals)
+        return self.intervals
+
+    def start(self):
+        self.timer.set_intervak(self.intervals)
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def progress(self) -> Optional[IntervalProgressModel]:
+        return self.timer.current_interval()
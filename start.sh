@@ -4,7 +4,8 @@ set -euo pipefail
 # Default values (can be overridden by env vars)
 HOST="${HOST:-0.0.0.0}"
 PORT="${PORT:-8000}"
-RELOAD="${RELOAD:-true}"
+# production by default, RELOAD=true restarts on code changes (development)
+RELOAD="${RELOAD:-false}"
 TIMEOUT_GRACEFUL_SHUTDOWN="${TIMEOUT_GRACEFUL_SHUTDOWN:-1}"
 LOG_CONFIG="${LOG_CONFIG:-logging.conf}"
 APP_MODULE="${APP_MODULE:-app.api:app}"